@@ -0,0 +1,154 @@
+import logging
+from itertools import islice
+
+log = logging.getLogger("__main__." + __name__)
+
+
+class TokenBuckets:
+    """
+    This class keeps a token bucket per key: a key may take up to burst tokens at once, and rate tokens per
+    second on average. A bucket is 2 floats in a dictionary and is refilled when it is used, there is no
+    timer. At most max_keys buckets are kept, in least recently used order: when there are too many, the
+    buckets which are full again are dropped, as a missing bucket is a full one, then the least recently
+    used ones. The keys which are still limited, like the clients sending a storm, keep their bucket.
+    """
+
+    def __init__(self, rate: float, burst: float, max_keys: int = 100000):
+        self.rate = rate
+        self.burst = max(burst, 1)
+        self.max_keys = max_keys
+        self.buckets = {}  # key -> (tokens, time of the last update)
+
+    def __len__(self):
+        return len(self.buckets)
+
+    def _tokens(self, key, now: float) -> float:
+        # the caller puts the bucket back, last as the most recently used
+        bucket = self.buckets.pop(key, None)
+        if bucket is None:
+            if len(self.buckets) >= self.max_keys:
+                self._evict(now)
+            return self.burst
+        tokens, updated = bucket
+        return min(self.burst, tokens + (now - updated) * self.rate)
+
+    def _evict(self, now: float) -> None:
+        buckets = self.buckets
+        rate, burst = self.rate, self.burst
+        for key in [
+            key
+            for key, (tokens, updated) in buckets.items()
+            if tokens + (now - updated) * rate >= burst
+        ]:
+            del buckets[key]
+        # at least a tenth of the buckets, so that the next eviction is max_keys / 10 new keys away
+        excess = len(buckets) - self.max_keys * 9 // 10
+        if excess > 0:
+            for key in list(islice(buckets, excess)):
+                del buckets[key]
+
+    def take(self, key, now: float) -> bool:
+        """
+        :param key: the key of the bucket.
+        :param now: monotonic time.
+        :return: True if a token was taken, False if the bucket is empty.
+        """
+        tokens = self._tokens(key, now)
+        if tokens < 1:
+            self.buckets[key] = (tokens, now)
+            return False
+        self.buckets[key] = (tokens - 1, now)
+        return True
+
+    def reserve(self, key, now: float) -> float:
+        """
+        This method takes a token even if the bucket is empty, the bucket is then in debt and the caller has
+        to wait until the token is there.
+
+        :param key: the key of the bucket.
+        :param now: monotonic time.
+        :return: seconds to wait before using the token, 0 if it is available now.
+        """
+        tokens = self._tokens(key, now) - 1
+        self.buckets[key] = (tokens, now)
+        if tokens >= 0:
+            return 0.0
+        return -tokens / self.rate
+
+
+class AdmissionControl:
+    """
+    This class decides which connections and heartbeats a server accepts, so that a storm of connections or
+    heartbeats from a few misbehaving clients cannot take the event loop from the others:
+    - at most max_connections connections are open at once, and new connections are accepted at
+      accept_rate per second on average with bursts of accept_burst. Connections beyond are closed as soon
+      as they are accepted, before a task or a buffer is allocated for them.
+    - the frames received from one source IP address are read at ip_rate per second with bursts of
+      ip_burst. Beyond, reading from the connection waits for the next token, before the frame is decoded,
+      so the excess waits in the socket buffers and the sender is slowed down by TCP flow control.
+    - the heartbeats of one client identifier are registered at client_rate per second with bursts of
+      client_burst. Beyond, they are coalesced: the client is already known from a recent heartbeat, so the
+      heartbeat is acked from the server's message cache without updating the registry or the database.
+    A rate of 0 disables the corresponding limit, like a max_connections of 0.
+    """
+
+    def __init__(
+        self,
+        max_connections: int = 0,
+        accept_rate: float = 0,
+        accept_burst: float = 100,
+        ip_rate: float = 0,
+        ip_burst: float = 100,
+        client_rate: float = 0,
+        client_burst: float = 10,
+        max_keys: int = 100000,
+    ):
+        self.max_connections = max_connections
+        self.accepts = TokenBuckets(accept_rate, accept_burst) if accept_rate else None
+        self.ips = TokenBuckets(ip_rate, ip_burst, max_keys) if ip_rate else None
+        self.clients = (
+            TokenBuckets(client_rate, client_burst, max_keys) if client_rate else None
+        )
+
+    @property
+    def limits_clients(self) -> bool:
+        return self.clients is not None
+
+    def admit(self, connections: int, now: float) -> bool:
+        """
+        :param connections: the number of open connections, the new one excluded.
+        :param now: monotonic time.
+        :return: True if the new connection is accepted.
+        """
+        if self.max_connections and connections >= self.max_connections:
+            return False
+        return self.accepts is None or self.accepts.take(None, now)
+
+    def frame_delay(self, ip: str, now: float) -> float:
+        """
+        :param ip: the source address of the connection.
+        :param now: monotonic time.
+        :return: seconds to wait before reading the next frame of the connection.
+        """
+        if self.ips is None or ip is None:
+            return 0.0
+        return self.ips.reserve(ip, now)
+
+    def allow_heartbeat(self, identifier: int, now: float) -> bool:
+        """
+        :param identifier: client identifier.
+        :param now: monotonic time.
+        :return: True if the heartbeat is registered, False if it is coalesced with the previous ones.
+        """
+        return self.clients is None or self.clients.take(identifier, now)
+
+
+def peer_ip(transport) -> str:
+    """
+    :param transport: an asyncio transport or StreamWriter.
+    :return: the source address of the connection, None for a unix socket.
+    """
+    peername = transport.get_extra_info("peername")
+    if isinstance(peername, tuple):
+        return peername[0]
+    return None
@@ -17,3 +17,43 @@ class BaseEncoderDecoder(ABC):
     @abstractmethod
     def decode_status(self, binary_data):
         pass
+
+    @abstractmethod
+    def encode_heartbeat_batch(self, msg_dicts):
+        pass
+
+    @abstractmethod
+    def decode_heartbeat_batch(self, binary_data):
+        pass
+
+    @abstractmethod
+    def encode_status_batch(self, msg_dicts):
+        pass
+
+    @abstractmethod
+    def decode_status_batch(self, binary_data):
+        pass
+
+    @abstractmethod
+    def decode_message_type(self, binary_data):
+        pass
+
+    @abstractmethod
+    def peek_heartbeat_identifier(self, binary_data):
+        pass
+
+    @abstractmethod
+    def decode_heartbeat_record(self, binary_data):
+        pass
+
+    @abstractmethod
+    def encode_heartbeat_record(self, record):
+        pass
+
+    @abstractmethod
+    def decode_status_record(self, binary_data):
+        pass
+
+    @abstractmethod
+    def encode_status_record(self, record):
+        pass
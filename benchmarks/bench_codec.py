@@ -0,0 +1,111 @@
+"""
+Benchmark of the encode/decode throughput of the codecs through EncodeDecodeExecutor.
+
+For every codec of codec_negotiation.CODECS it times the heartbeat and status messages, the dict and record
+methods and a batch of --batch-size heartbeats. Run it from the project directory:
+
+    python -m benchmarks.bench_codec --messages 100000
+
+Every result is printed as one JSON line, "json_backend" tells whether orjson or the json module was used.
+"""
+import argparse
+import json
+import time
+
+from codec_negotiation import CODECS, make_encoder_decoder
+import json_encoder_decoder
+import messages_pb2 as messages
+from records import HeartbeatRecord
+
+HEARTBEAT = {
+    "type": messages.MESSAGE_TYPE_HEARTBEAT,
+    "msg": "Heartbeat",
+    "client_host": "10.0.12.34",
+    "client_port": 2034,
+    "identifier": 1234567,
+    "request_id": 0,
+}
+STATUS = {
+    "type": messages.MESSAGE_TYPE_STATUS,
+    "message_count": 4321,
+    "identifier": 1234567,
+    "request_id": 0,
+}
+
+
+def best_rate(function, argument, count: int, repeat: int) -> float:
+    """
+    :return: calls per second of the fastest of repeat runs of count calls.
+    """
+    best = float("inf")
+    for _ in range(repeat):
+        started = time.perf_counter()
+        for _ in range(count):
+            function(argument)
+        best = min(best, time.perf_counter() - started)
+    return count / best
+
+
+def bench_codec(name: str, count: int, batch_size: int, repeat: int) -> list[dict]:
+    encoder_decoder = make_encoder_decoder(name)
+    heartbeat_data = encoder_decoder.encode_heartbeat(HEARTBEAT)
+    status_data = encoder_decoder.encode_status(STATUS)
+    batch = [dict(HEARTBEAT, identifier=identifier) for identifier in range(batch_size)]
+    batch_data = encoder_decoder.encode_heartbeat_batch(batch)
+    operations = [
+        ("encode_heartbeat", encoder_decoder.encode_heartbeat, HEARTBEAT, 1),
+        ("decode_heartbeat", encoder_decoder.decode_heartbeat, heartbeat_data, 1),
+        ("encode_status", encoder_decoder.encode_status, STATUS, 1),
+        ("decode_status", encoder_decoder.decode_status, status_data, 1),
+        (
+            "encode_heartbeat_record",
+            encoder_decoder.encode_heartbeat_record,
+            HeartbeatRecord(**HEARTBEAT),
+            1,
+        ),
+        (
+            "decode_heartbeat_record",
+            encoder_decoder.decode_heartbeat_record,
+            heartbeat_data,
+            1,
+        ),
+        (
+            "encode_heartbeat_batch",
+            encoder_decoder.encode_heartbeat_batch,
+            batch,
+            batch_size,
+        ),
+        (
+            "decode_heartbeat_batch",
+            encoder_decoder.decode_heartbeat_batch,
+            batch_data,
+            batch_size,
+        ),
+    ]
+    return [
+        {
+            "benchmark": "codec",
+            "codec": name,
+            "operation": operation,
+            "json_backend": "orjson" if json_encoder_decoder.orjson else "json",
+            "heartbeat_bytes": len(heartbeat_data),
+            "messages_per_sec": round(
+                best_rate(function, argument, max(count // size, 1), repeat) * size
+            ),
+        }
+        for operation, function, argument, size in operations
+    ]
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument(
+        "--codecs", nargs="+", choices=list(CODECS), default=list(CODECS)
+    )
+    parser.add_argument("--messages", type=int, default=100000)
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    for codec in args.codecs:
+        for result in bench_codec(codec, args.messages, args.batch_size, args.repeat):
+            print(json.dumps(result), flush=True)
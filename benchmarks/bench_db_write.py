@@ -0,0 +1,136 @@
+"""
+Benchmark of AsyncPgPostgresManager.update_changed_clients_to_db() writing every client, against the
+previous implementations of the client write: "insert" is the original one, a new connection, TRUNCATE and
+one INSERT per client, and "executemany" the pooled TRUNCATE and executemany() which replaced it.
+
+It needs a running database configured like main.py (see .env) and writes to its client_record table.
+Run it from the project directory:
+
+    python -m benchmarks.bench_db_write --sizes 1000 10000 100000
+
+Every result is printed as one JSON line.
+"""
+import argparse
+import asyncio
+import json
+import os
+import time
+
+import asyncpg
+from dotenv import load_dotenv
+
+from db_operations import AsyncPgPostgresManager
+
+# how the clients are written: "copy" is the server's COPY into the staging table and upsert
+WRITE_MODES = ("copy", "executemany", "insert")
+
+INSERT_CLIENT = """
+   INSERT INTO client_record(client_identifier, is_connected, client_host, client_port,
+   status_count) VALUES($1, $2, $3, $4, $5)
+"""
+
+
+def make_clients_mapping(size: int, cycle: int) -> dict:
+    """
+    Build a mapping of changed clients like the registry does, the status counts change every cycle.
+    """
+    return {
+        client_id: {
+            "client_identifier": client_id,
+            "is_connected": True,
+            "client_host": f"10.0.{client_id // 256 % 256}.{client_id % 256}",
+            "client_port": 2000 + client_id % 1000,
+            "status_count": client_id + cycle,
+        }
+        for client_id in range(size)
+    }
+
+
+async def write_clients(
+    db_op_manager: AsyncPgPostgresManager, write_mode: str, mapping: dict
+) -> None:
+    if write_mode == "copy":
+        await db_op_manager.update_changed_clients_to_db(mapping, [])
+        return
+    records = [
+        (
+            client_id,
+            True,
+            client["client_host"],
+            client["client_port"],
+            client["status_count"],
+        )
+        for client_id, client in mapping.items()
+    ]
+    if write_mode == "executemany":
+        async with db_op_manager.pool.acquire() as conn:
+            async with conn.transaction():
+                await conn.execute("TRUNCATE client_record")
+                await conn.executemany(INSERT_CLIENT, records)
+        return
+    conn = await asyncpg.connect(
+        user=db_op_manager.user,
+        password=db_op_manager.password,
+        database=db_op_manager.database,
+        host=db_op_manager.host,
+        port=db_op_manager.port,
+    )
+    try:
+        async with conn.transaction():
+            await conn.execute("TRUNCATE client_record")
+            for record in records:
+                await conn.execute(INSERT_CLIENT, *record)
+    finally:
+        await conn.close()
+
+
+async def bench_write_mode(write_mode: str, size: int, repeat: int) -> dict:
+    db_op_manager = AsyncPgPostgresManager(
+        user=os.getenv("POSTGRES_USER", "devuser"),
+        password=os.getenv("POSTGRES_PASSWORD", "devpwd"),
+        database_name=os.getenv("POSTGRES_DB", "devdb"),
+        db_host=os.getenv("DB_HOST", "0.0.0.0"),
+        db_port=int(os.getenv("DB_PORT", 5432)),
+    )
+    if not await db_op_manager.start():
+        raise SystemExit("database is not reachable")
+    try:
+        # start every mode from the same table content
+        await write_clients(db_op_manager, write_mode, make_clients_mapping(size, 0))
+
+        timings = []
+        for cycle in range(1, repeat + 1):
+            mapping = make_clients_mapping(size, cycle)
+            started = time.perf_counter()
+            await write_clients(db_op_manager, write_mode, mapping)
+            timings.append(time.perf_counter() - started)
+        await db_op_manager.update_changed_clients_to_db({}, list(range(size)))
+    finally:
+        await db_op_manager.close()
+
+    best = min(timings)
+    return {
+        "benchmark": "client_write",
+        "write_mode": write_mode,
+        "clients": size,
+        "best_seconds": round(best, 4),
+        "rows_per_sec": round(size / best),
+    }
+
+
+async def run(sizes: list, write_modes: list, repeat: int) -> None:
+    for size in sizes:
+        for write_mode in write_modes:
+            print(json.dumps(await bench_write_mode(write_mode, size, repeat)))
+
+
+if __name__ == "__main__":
+    load_dotenv()
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--sizes", type=int, nargs="+", default=[1000, 10000, 100000])
+    parser.add_argument(
+        "--write-modes", nargs="+", choices=WRITE_MODES, default=list(WRITE_MODES)
+    )
+    parser.add_argument("--repeat", type=int, default=3)
+    args = parser.parse_args()
+    asyncio.run(run(args.sizes, args.write_modes, args.repeat))
@@ -0,0 +1,317 @@
+"""
+Benchmark of heartbeat ingest and status sweeps against a real Server on loopback.
+
+For every fleet size a child process simulates the clients: each one keeps a connection open and sends
+heartbeats at --rate per second (0 sends the next one as soon as the ack arrives), and listens as a
+status responder for the sweep. The responders of all clients are served on --responder-ports ports. The
+Server runs in this process with an in-memory database, so only the server, the codec and the network
+stack are measured. Run it from the project directory:
+
+    python -m benchmarks.bench_server --clients 100 1000 5000 --duration 5
+
+Every result is printed as one JSON line: heartbeats/sec, heartbeats per second of server CPU time and
+p50/p99 ack latency ("heartbeat_ingest"), sweep duration ("status_sweep") and the resident memory added by
+the fleet ("memory"). Every fleet runs against each of the --transports of the Server, e.g. to compare the
+stream and protocol ingest paths:
+
+    python -m benchmarks.bench_server --clients 1000 --rate 0 --transports stream protocol
+"""
+import argparse
+import asyncio
+import json
+import logging
+import multiprocessing
+import os
+import resource
+import time
+
+from encode_decode_executor import EncodeDecodeExecutor
+import framing
+import messages_pb2 as messages
+from protobuf_encode_decoder import ProtobufEncoderDecoder
+from server import TRANSPORTS, Server
+
+HOST = "127.0.0.1"
+
+
+class InMemoryDbManager:
+    """
+    Stands in for AsyncPgPostgresManager, so that the database does not take part in the results.
+    """
+
+    def __init__(self):
+        self.rows = {}
+
+    async def query_saved_clients_from_db(
+        self, shard_count: int = 1, shards=None
+    ) -> list[dict]:
+        return [
+            row
+            for client_id, row in self.rows.items()
+            if shards is None or client_id % shard_count in shards
+        ]
+
+    async def update_changed_clients_to_db(
+        self, changed_clients: dict, removed_client_ids: list
+    ) -> bool:
+        for client_id in removed_client_ids:
+            self.rows.pop(client_id, None)
+        self.rows.update(changed_clients)
+        return True
+
+
+def rss_bytes() -> int:
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except OSError:
+        # peak resident size, in kilobytes on Linux
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def cpu_seconds() -> float:
+    # of this process only, the fleet runs in a child process
+    usage = resource.getrusage(resource.RUSAGE_SELF)
+    return usage.ru_utime + usage.ru_stime
+
+
+def raise_open_files_limit() -> None:
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    if soft < hard:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (hard, hard))
+
+
+def percentile(sorted_values: list, fraction: float) -> float:
+    if not sorted_values:
+        return 0.0
+    return sorted_values[
+        min(int(len(sorted_values) * fraction), len(sorted_values) - 1)
+    ]
+
+
+async def simulate_client(
+    encoder_decoder: EncodeDecodeExecutor,
+    server_port: int,
+    identifier: int,
+    client_port: int,
+    rate: float,
+    stop_at: float,
+    latencies: list,
+) -> None:
+    reader, writer = await asyncio.open_connection(HOST, server_port)
+    msg = {
+        "type": messages.MessageType.MESSAGE_TYPE_HEARTBEAT,
+        "msg": "Heartbeat",
+        "client_host": HOST,
+        "client_port": client_port,
+        "identifier": identifier,
+    }
+    frame = framing.encode_frame(encoder_decoder.encode_heartbeat(msg_dict=msg))
+    interval = 1 / rate if rate else 0
+    next_send = time.perf_counter()
+    try:
+        while next_send < stop_at:
+            started = time.perf_counter()
+            writer.write(frame)
+            if await framing.read_frame(reader) is None:
+                return
+            latencies.append(time.perf_counter() - started)
+            next_send += interval
+            if interval:
+                await asyncio.sleep(max(next_send - time.perf_counter(), 0))
+            else:
+                next_send = time.perf_counter()
+    finally:
+        writer.close()
+
+
+async def respond_to_status_requests(
+    encoder_decoder: EncodeDecodeExecutor,
+    client_reader: asyncio.StreamReader,
+    client_writer: asyncio.StreamWriter,
+) -> None:
+    try:
+        while True:
+            data = await framing.read_frame(client_reader)
+            if data is None:
+                break
+            status = encoder_decoder.decode_status(binary_data=data)
+            client_writer.write(
+                framing.encode_frame(encoder_decoder.encode_status(msg_dict=status))
+            )
+            if await framing.read_frame(client_reader) is None:  # ack
+                break
+    except ConnectionError:
+        pass
+    finally:
+        client_writer.close()
+
+
+async def run_fleet(
+    connection, server_port: int, clients: int, rate: float, duration: float
+) -> None:
+    """
+    The client side, run in a child process: registers the fleet with heartbeats, reports the ack
+    latencies and keeps the status responders up until the parent is done sweeping.
+    """
+    raise_open_files_limit()
+    encoder_decoder = EncodeDecodeExecutor(ProtobufEncoderDecoder())
+    responder_ports = connection.recv()
+    responders = [
+        await asyncio.start_server(
+            lambda reader, writer: respond_to_status_requests(
+                encoder_decoder, reader, writer
+            ),
+            HOST,
+            port,
+            backlog=1024,
+        )
+        for port in responder_ports
+    ]
+
+    latencies = []
+    started = time.perf_counter()
+    await asyncio.gather(
+        *(
+            simulate_client(
+                encoder_decoder,
+                server_port,
+                identifier,
+                responder_ports[identifier % len(responder_ports)],
+                rate,
+                started + duration,
+                latencies,
+            )
+            for identifier in range(1, clients + 1)
+        )
+    )
+    elapsed = time.perf_counter() - started
+    latencies.sort()
+    connection.send(
+        {
+            "heartbeats": len(latencies),
+            "heartbeats_per_sec": round(len(latencies) / elapsed),
+            "ack_p50_ms": round(percentile(latencies, 0.5) * 1000, 3),
+            "ack_p99_ms": round(percentile(latencies, 0.99) * 1000, 3),
+        }
+    )
+
+    # serve the status sweeps until the parent is done
+    await asyncio.get_event_loop().run_in_executor(None, connection.recv)
+    for responder in responders:
+        responder.close()
+
+
+def fleet_process(connection, server_port, clients, rate, duration) -> None:
+    asyncio.run(run_fleet(connection, server_port, clients, rate, duration))
+
+
+async def bench_fleet(
+    args, clients: int, transport: str, server_port: int
+) -> list[dict]:
+    server = Server(
+        encoder_decoder=EncodeDecodeExecutor(ProtobufEncoderDecoder()),
+        db_op_manager=InMemoryDbManager(),
+        query_seconds_interval_lower=0,
+        query_seconds_interval_upper=0,
+        server_ip=HOST,
+        server_port=server_port,
+        sweep_concurrency=args.sweep_concurrency,
+        client_pool_max_connections=args.client_pool_max_connections,
+        transport=transport,
+    )
+    await server.start_server()
+    rss_before = rss_bytes()
+    cpu_before = cpu_seconds()
+
+    # spawn, a forked child would inherit the running event loop
+    context = multiprocessing.get_context("spawn")
+    parent_connection, child_connection = context.Pipe()
+    fleet = context.Process(
+        target=fleet_process,
+        args=(child_connection, server_port, clients, args.rate, args.duration),
+    )
+    fleet.start()
+    responder_ports = [server_port + 1 + i for i in range(args.responder_ports)]
+    parent_connection.send(responder_ports)
+    loop = asyncio.get_event_loop()
+    ingest = await loop.run_in_executor(None, parent_connection.recv)
+    server_cpu_seconds = cpu_seconds() - cpu_before
+    rss_after = rss_bytes()
+
+    timings = []
+    for _ in range(args.sweeps):
+        started = time.perf_counter()
+        await server.sweep()
+        timings.append(time.perf_counter() - started)
+    failures = server.metrics.status_request_failures.value
+    parent_connection.send("stop")
+    await loop.run_in_executor(None, fleet.join)
+    server.client_connections.close()
+
+    best = min(timings)
+    return [
+        dict(
+            benchmark="heartbeat_ingest",
+            clients=clients,
+            transport=transport,
+            rate=args.rate,
+            duration=args.duration,
+            heartbeats_per_cpu_sec=round(
+                ingest["heartbeats"] / max(server_cpu_seconds, 1e-9)
+            ),
+            **ingest,
+        ),
+        {
+            "benchmark": "status_sweep",
+            "clients": clients,
+            "transport": transport,
+            "registered": len(server.registry),
+            "failures": failures,
+            "best_seconds": round(best, 4),
+            "clients_per_sec": round(clients / best),
+        },
+        {
+            "benchmark": "memory",
+            "clients": clients,
+            "transport": transport,
+            "rss_bytes_per_client": round((rss_after - rss_before) / clients),
+        },
+    ]
+
+
+async def run(args) -> None:
+    raise_open_files_limit()
+    fleets = [
+        (clients, transport)
+        for clients in args.clients
+        for transport in args.transports
+    ]
+    for index, (clients, transport) in enumerate(fleets):
+        # fresh ports for every fleet, the previous ones may still be in TIME_WAIT
+        server_port = args.port + index * (args.responder_ports + 1)
+        for result in await bench_fleet(args, clients, transport, server_port):
+            print(json.dumps(result), flush=True)
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.CRITICAL)
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--clients", type=int, nargs="+", default=[100, 1000, 5000])
+    parser.add_argument(
+        "--rate",
+        type=float,
+        default=1.0,
+        help="heartbeats per second and client, 0 for as fast as acks arrive",
+    )
+    parser.add_argument("--duration", type=float, default=5.0)
+    parser.add_argument("--sweeps", type=int, default=3)
+    parser.add_argument(
+        "--transports", nargs="+", choices=TRANSPORTS, default=["stream"]
+    )
+    parser.add_argument("--responder-ports", type=int, default=10)
+    parser.add_argument("--sweep-concurrency", type=int, default=100)
+    parser.add_argument("--client-pool-max-connections", type=int, default=1000)
+    parser.add_argument("--port", type=int, default=14000)
+    args = parser.parse_args()
+    asyncio.run(run(args))
@@ -0,0 +1,90 @@
+"""
+Compare two benchmark result files, e.g. from the previous release and from the current tree:
+
+    python -m benchmarks.bench_server > current.jsonl
+    python -m benchmarks.compare baseline.jsonl current.jsonl --tolerance 0.1
+
+Results are matched on their benchmark name and parameters. Every metric which got worse by more than the
+tolerance is printed as a JSON line, and the exit status is 1 if there is any.
+"""
+import argparse
+import json
+import sys
+
+# what a result is matched on
+PARAMETERS = (
+    "benchmark",
+    "clients",
+    "transport",
+    "write_mode",
+    "rate",
+    "duration",
+    "codec",
+    "operation",
+)
+# metric -> True if higher is better
+METRICS = {
+    "heartbeats_per_sec": True,
+    "heartbeats_per_cpu_sec": True,
+    "clients_per_sec": True,
+    "rows_per_sec": True,
+    "messages_per_sec": True,
+    "ack_p50_ms": False,
+    "ack_p99_ms": False,
+    "best_seconds": False,
+    "rss_bytes_per_client": False,
+}
+
+
+def load_results(path: str) -> dict:
+    """
+    :return: a mapping of the parameters of every result to its metrics.
+    """
+    results = {}
+    with open(path) as results_file:
+        for line in results_file:
+            if not line.strip():
+                continue
+            result = json.loads(line)
+            parameters = tuple(
+                (key, result[key]) for key in PARAMETERS if key in result
+            )
+            results[parameters] = result
+    return results
+
+
+def find_regressions(baseline: dict, current: dict, tolerance: float) -> list[dict]:
+    regressions = []
+    for parameters, result in current.items():
+        previous = baseline.get(parameters)
+        if previous is None:
+            continue
+        for metric, higher_is_better in METRICS.items():
+            if metric not in result or not previous.get(metric):
+                continue
+            change = (result[metric] - previous[metric]) / previous[metric]
+            if (-change if higher_is_better else change) > tolerance:
+                regressions.append(
+                    dict(
+                        parameters,
+                        metric=metric,
+                        baseline=previous[metric],
+                        current=result[metric],
+                        change=round(change, 3),
+                    )
+                )
+    return regressions
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("baseline")
+    parser.add_argument("current")
+    parser.add_argument("--tolerance", type=float, default=0.1)
+    args = parser.parse_args()
+    regressions = find_regressions(
+        load_results(args.baseline), load_results(args.current), args.tolerance
+    )
+    for regression in regressions:
+        print(json.dumps(regression))
+    sys.exit(1 if regressions else 0)
@@ -0,0 +1,104 @@
+import asyncio
+import logging
+import time
+from collections import OrderedDict
+
+log = logging.getLogger("__main__." + __name__)
+
+
+class ClientConnectionPool:
+    """
+    This class keeps connections to clients open between status requests, one idle connection per
+    (host, port). Idle connections are closed after idle_timeout_seconds, and at most max_connections
+    connections are open at the same time: when the limit is reached the least recently used idle
+    connection is closed, or the caller waits until a connection is released.
+    """
+
+    def __init__(self, max_connections: int = 1000, idle_timeout_seconds: float = 120):
+        self.max_connections = max_connections
+        self.idle_timeout_seconds = idle_timeout_seconds
+        # (host, port) -> (reader, writer, released at), least recently used first
+        self._idle = OrderedDict()
+        self._capacity = None  # created on first use, inside the event loop
+
+    async def acquire(
+        self, host: str, port: int, connect_timeout: float
+    ) -> (asyncio.StreamReader, asyncio.StreamWriter, bool):
+        """
+        This method returns an idle connection to the client, or opens a new one.
+
+        :param host: client's host address.
+        :param port: client's port number
+        :param connect_timeout: deadline in seconds for opening a new connection.
+        :return: StreamReader and StreamWriter of the connection, and True if it is a reused connection.
+        """
+        if self._capacity is None:
+            self._capacity = asyncio.Semaphore(self.max_connections)
+        self._evict_expired()
+
+        idle = self._idle.pop((host, port), None)
+        if idle is not None:
+            client_reader, client_writer, _ = idle
+            if not client_writer.is_closing() and not client_reader.at_eof():
+                return client_reader, client_writer, True
+            self._close(client_writer)
+
+        while self._capacity.locked() and self._idle:
+            _, (_, idle_writer, _) = self._idle.popitem(last=False)
+            self._close(idle_writer)
+        await self._capacity.acquire()
+        try:
+            client_reader, client_writer = await asyncio.wait_for(
+                asyncio.open_connection(host, port), timeout=connect_timeout
+            )
+        except BaseException:
+            self._capacity.release()
+            raise
+        return client_reader, client_writer, False
+
+    def release(
+        self,
+        host: str,
+        port: int,
+        client_reader: asyncio.StreamReader,
+        client_writer: asyncio.StreamWriter,
+        reusable: bool,
+    ) -> None:
+        """
+        This method gives a connection back to the pool.
+
+        :param host: client's host address.
+        :param port: client's port number
+        :param client_reader: StreamReader object of the connection.
+        :param client_writer: StreamWriter object of the connection.
+        :param reusable: False if the connection is in an unknown state, e.g. after an error, and has to be
+        closed.
+        """
+        if not reusable or client_writer.is_closing():
+            self._close(client_writer)
+            return
+        replaced = self._idle.pop((host, port), None)
+        if replaced is not None:
+            self._close(replaced[1])
+        self._idle[(host, port)] = (client_reader, client_writer, time.monotonic())
+
+    def close(self) -> None:
+        """
+        This method closes all idle connections.
+        """
+        while self._idle:
+            _, (_, client_writer, _) = self._idle.popitem(last=False)
+            self._close(client_writer)
+
+    def _evict_expired(self) -> None:
+        expired_before = time.monotonic() - self.idle_timeout_seconds
+        while self._idle:
+            key, (_, client_writer, released_at) = next(iter(self._idle.items()))
+            if released_at > expired_before:
+                break
+            del self._idle[key]
+            self._close(client_writer)
+
+    def _close(self, client_writer: asyncio.StreamWriter) -> None:
+        client_writer.close()
+        self._capacity.release()
@@ -0,0 +1,480 @@
+import logging
+import math
+from array import array
+from collections import Counter
+
+log = logging.getLogger("__main__." + __name__)
+
+
+class ClientRegistry:
+    """
+    This class holds every known client, from heartbeats or saved in the database, in compact columns
+    instead of one dict per client. self.index maps a client identifier to its row, every other column
+    holds one value per row:
+
+    identifiers, host_ids, ports, status_counts: the client and its address, hosts are interned in
+    self.hosts and referenced by position. self.host_refs counts the rows of every host, the hosts without
+    a row are dropped by rebuild_hosts() once they are half of the table
+    last_seen: time of the last heartbeat or status reply
+    next_poll: deadline of the next status request, see Server.send_status_request_to_clients(); 0 until
+    scheduled and infinity while a request is running
+    poll_intervals: seconds between the status requests of the client, it adapts to the client's history:
+    doubled (backoff_factor) after every successful request with an unchanged count up to
+    max_poll_interval, and back to min_poll_interval after a failure, a reconnection or a changed count
+    connected: 1 if the client answered the last status request
+    saved: 1 if the client is saved in the database
+    changed: 1 if the row has to be written to the database with the next flush
+    from_heartbeat: 1 if the client sent a heartbeat, its address is then preferred over the saved one
+
+    Flag columns are bytearrays, so scans like "which rows changed" run at C speed with find() and count().
+    """
+
+    def __init__(
+        self,
+        min_poll_interval: float = 10.0,
+        max_poll_interval: float = 300.0,
+        backoff_factor: float = 2.0,
+    ):
+        self.min_poll_interval = min_poll_interval
+        self.max_poll_interval = max(max_poll_interval, min_poll_interval)
+        self.backoff_factor = backoff_factor
+        self.index = {}  # identifier -> row
+        self.hosts = []  # host id -> host
+        self.host_ids_by_host = {}  # host -> host id
+        self.host_refs = array("I")  # host id -> number of rows
+        self.unused_hosts = 0  # hosts without a row
+        self.identifiers = array("I")
+        self.host_ids = array("I")
+        self.ports = array("I")
+        self.status_counts = array("I")
+        self.last_seen = array("d")
+        self.next_poll = array("d")
+        self.poll_intervals = array("d")
+        self.connected = bytearray()
+        self.saved = bytearray()
+        self.changed = bytearray()
+        self.from_heartbeat = bytearray()
+        self.unscheduled = array(
+            "I"
+        )  # identifiers added since the last take_unscheduled()
+
+    def __len__(self):
+        return len(self.identifiers)
+
+    def __contains__(self, identifier):
+        return identifier in self.index
+
+    def __repr__(self):
+        # a summary of constant size, safe to log whatever the number of clients
+        return (
+            f"<ClientRegistry clients={len(self.identifiers)} "
+            f"connected={self.connected.count(1)} changed={self.changed.count(1)} "
+            f"hosts={len(self.hosts)}>"
+        )
+
+    def get(self, identifier: int) -> dict:
+        """
+        :param identifier: client identifier.
+        :return: the client's information as a dictionary, or None for an unknown client.
+        """
+        row = self.index.get(identifier)
+        if row is None:
+            return None
+        return {
+            "client_identifier": identifier,
+            "client_host": self.hosts[self.host_ids[row]],
+            "client_port": self.ports[row],
+            "status_count": self.status_counts[row],
+            "last_seen": self.last_seen[row],
+            "is_connected": bool(self.connected[row]),
+        }
+
+    def status_count(self, identifier: int) -> int:
+        """
+        :param identifier: client identifier.
+        :return: the client's status count, or None for an unknown client.
+        """
+        row = self.index.get(identifier)
+        if row is None:
+            return None
+        return self.status_counts[row]
+
+    def connected_count(self) -> int:
+        """
+        :return: the number of clients which answered their last status request.
+        """
+        return self.connected.count(1)
+
+    def heartbeat(self, identifier: int, host: str, port: int, now: float) -> None:
+        """
+        This method registers a heartbeat from a client.
+
+        :param identifier: client identifier.
+        :param host: client's host address.
+        :param port: client's port number
+        :param now: time of the heartbeat.
+        """
+        host_id = self._host_id(host)
+        row = self.index.get(identifier)
+        if row is None:
+            row = self._add(identifier, host_id, port, 0)
+        elif self.host_ids[row] != host_id or self.ports[row] != port:
+            # the port first, it is the value which may not fit its column
+            self.ports[row] = port
+            self._set_host(row, host_id)
+            self.changed[row] = 1
+            # the client reconnected, poll it soon instead of after its backed off interval
+            if self.poll_intervals[row] > self.min_poll_interval:
+                self.poll_intervals[row] = self.min_poll_interval
+                self.unscheduled.append(identifier)
+        self.from_heartbeat[row] = 1
+        self.last_seen[row] = now
+
+    def heartbeat_batch(self, heartbeats: list[tuple], now: float) -> None:
+        """
+        This method registers the heartbeats of many clients received at once, e.g. from a gateway.
+
+        :param heartbeats: a list of (identifier, host, port) tuples.
+        :param now: time of the heartbeats.
+        """
+        heartbeat = self.heartbeat
+        for identifier, host, port in heartbeats:
+            heartbeat(identifier, host, port, now)
+
+    def merge_saved_clients(self, clients_from_db: list[dict]) -> None:
+        """
+        This method adds the clients saved in the database which are not registered yet. Clients which never
+        sent a heartbeat take the address saved in the database. Rows with values which do not fit the
+        registry are skipped and logged.
+
+        :param clients_from_db: rows of the client_record table.
+        """
+        skipped = 0
+        for client in clients_from_db:
+            identifier = client.get("client_identifier")
+            host_id = self._host_id(client.get("client_host"))
+            port = client.get("client_port")
+            row = self.index.get(identifier)
+            try:
+                if row is None:
+                    row = self._add(
+                        identifier, host_id, port, client.get("status_count") or 0
+                    )
+                    # the database holds it as connected already
+                    self.connected[row] = 1
+                    self.changed[row] = 0
+                elif not self.from_heartbeat[row]:
+                    self.ports[row] = port
+                    self._set_host(row, host_id)
+            except (OverflowError, TypeError) as e:
+                skipped += 1
+                log.debug("Skipped saved client %r %s", identifier, e)
+                continue
+            self.saved[row] = 1
+        if skipped:
+            log.error("Skipped %d saved clients with invalid values", skipped)
+
+    def mark_saved(self, identifiers) -> None:
+        """
+        This method marks clients as saved in the database as connected, e.g. by the heartbeat writer, so
+        that the next failed status request removes them from the database.
+
+        :param identifiers: identifiers of the saved clients.
+        """
+        for identifier in identifiers:
+            row = self.index.get(identifier)
+            if row is not None:
+                self.connected[row] = 1
+                self.saved[row] = 1
+
+    def poll_targets(self) -> list[tuple]:
+        """
+        :return: a list of (client_id, host, port, status_count) tuples for all registered clients.
+        """
+        hosts = self.hosts
+        return [
+            (identifier, hosts[host_id], port, status_count)
+            for identifier, host_id, port, status_count in zip(
+                self.identifiers, self.host_ids, self.ports, self.status_counts
+            )
+        ]
+
+    def take_unscheduled(self) -> array:
+        """
+        :return: the identifiers of the clients added since the last call, which have no poll scheduled.
+        """
+        unscheduled, self.unscheduled = self.unscheduled, array("I")
+        return unscheduled
+
+    def schedule_poll(self, identifier: int, deadline: float) -> bool:
+        """
+        :param identifier: client identifier.
+        :param deadline: time of the next status request.
+        :return: False for an unknown client.
+        """
+        row = self.index.get(identifier)
+        if row is None:
+            return False
+        self.next_poll[row] = deadline
+        return True
+
+    def poll_interval(self, identifier: int) -> float:
+        """
+        :param identifier: client identifier.
+        :return: seconds until the next status request of the client.
+        """
+        row = self.index.get(identifier)
+        if row is None:
+            return self.min_poll_interval
+        return self.poll_intervals[row]
+
+    def due_poll_targets(self, identifiers, until: float) -> list[tuple]:
+        """
+        This method selects the clients to poll among the ones whose poll timer expired: clients removed
+        since or rescheduled after until are skipped. The selected clients are marked as being polled
+        until they are scheduled again.
+
+        :param identifiers: identifiers of the expired timers.
+        :param until: end of the expired period.
+        :return: a list of (client_id, host, port, status_count) tuples.
+        """
+        targets = []
+        hosts = self.hosts
+        for identifier in identifiers:
+            row = self.index.get(identifier)
+            if row is None or self.next_poll[row] > until:
+                continue
+            self.next_poll[row] = math.inf
+            targets.append(
+                (
+                    identifier,
+                    hosts[self.host_ids[row]],
+                    self.ports[row],
+                    self.status_counts[row],
+                )
+            )
+        return targets
+
+    def record_status(
+        self, identifier: int, client_status: bool, count: int, now: float
+    ) -> bool:
+        """
+        This method records the result of a status request and adapts the poll interval of the client.
+
+        :param identifier: client identifier.
+        :param client_status: True if the client answered.
+        :param count: heartbeat message count from the client.
+        :param now: time of the reply.
+        :return: True if the count is different from the one saved in the database.
+        """
+        row = self.index.get(identifier)
+        if row is None:
+            return False
+        if not client_status:
+            if self.connected[row]:
+                self.connected[row] = 0
+                self.changed[row] = 1
+            self.poll_intervals[row] = self.min_poll_interval
+            return False
+
+        mismatch = False
+        stable = True
+        if self.status_counts[row] != count:
+            mismatch = bool(self.saved[row])
+            self.status_counts[row] = count
+            self.changed[row] = 1
+            stable = False
+        if not self.connected[row]:
+            self.connected[row] = 1
+            self.changed[row] = 1
+            stable = False
+        self.last_seen[row] = now
+        if stable:
+            self.poll_intervals[row] = min(
+                self.poll_intervals[row] * self.backoff_factor, self.max_poll_interval
+            )
+        else:
+            self.poll_intervals[row] = self.min_poll_interval
+        return mismatch
+
+    def changes(self) -> (dict, list):
+        """
+        This method collects the rows to write to the database and marks them as saved: connected clients
+        which changed are returned to be upserted, saved clients which are no longer connected are returned
+        to be deleted. If writing them fails, restore_changes() has to be called.
+
+        :return: the new or changed clients as a dictionary like the client_record rows, and the identifiers
+        of the clients to delete.
+        """
+        changed_clients = {}
+        removed_client_ids = []
+        row = self.changed.find(1)
+        while row != -1:
+            identifier = self.identifiers[row]
+            if self.connected[row]:
+                changed_clients[identifier] = {
+                    "client_identifier": identifier,
+                    "is_connected": True,
+                    "client_host": self.hosts[self.host_ids[row]],
+                    "client_port": self.ports[row],
+                    "status_count": self.status_counts[row],
+                }
+                self.saved[row] = 1
+            elif self.saved[row]:
+                removed_client_ids.append(identifier)
+                self.saved[row] = 0
+            row = self.changed.find(1, row + 1)
+        self.changed = bytearray(len(self.changed))
+        return changed_clients, removed_client_ids
+
+    def restore_changes(self, changed_clients: dict, removed_client_ids: list) -> None:
+        """
+        This method marks the rows returned by changes() as changed again, e.g. after a failed write.
+        """
+        for identifier in [*changed_clients, *removed_client_ids]:
+            row = self.index.get(identifier)
+            if row is not None:
+                self.saved[row] = 1
+                self.changed[row] = 1
+
+    def forget_lost_clients(self, identifiers: list) -> None:
+        """
+        This method removes clients which are not connected and were only known from the database.
+
+        :param identifiers: identifiers of the clients to check, e.g. the ones deleted from the database.
+        """
+        for identifier in identifiers:
+            row = self.index.get(identifier)
+            if (
+                row is not None
+                and not self.connected[row]
+                and not self.from_heartbeat[row]
+            ):
+                self._remove(row)
+        self._drop_unused_hosts()
+
+    def remove_clients(self, predicate) -> list[tuple]:
+        """
+        This method removes the clients whose identifier matches a predicate, e.g. the ones owned by
+        another server.
+
+        :param predicate: function called with every identifier.
+        :return: (identifier, host, port, last_seen) of the removed clients which sent a heartbeat.
+        """
+        removed = []
+        for identifier in [
+            identifier for identifier in self.identifiers if predicate(identifier)
+        ]:
+            row = self.index[identifier]
+            if self.from_heartbeat[row]:
+                removed.append(
+                    (
+                        identifier,
+                        self.hosts[self.host_ids[row]],
+                        self.ports[row],
+                        self.last_seen[row],
+                    )
+                )
+            self._remove(row)
+        self._drop_unused_hosts()
+        return removed
+
+    def rebuild_hosts(self) -> None:
+        """
+        This method drops the hosts without a row from self.hosts, numbers the others again and counts
+        their rows, e.g. after the columns were loaded from a snapshot.
+        """
+        host_refs = Counter(self.host_ids)
+        used_host_ids = sorted(host_refs)
+        if used_host_ids != list(range(len(used_host_ids))):
+            new_host_ids = {
+                host_id: new_host_id
+                for new_host_id, host_id in enumerate(used_host_ids)
+            }
+            self.host_ids = array("I", map(new_host_ids.__getitem__, self.host_ids))
+        self.hosts = [self.hosts[host_id] for host_id in used_host_ids]
+        self.host_ids_by_host = {
+            host: host_id for host_id, host in enumerate(self.hosts)
+        }
+        self.host_refs = array("I", [host_refs[host_id] for host_id in used_host_ids])
+        self.unused_hosts = 0
+
+    def _drop_unused_hosts(self) -> None:
+        # rebuilding costs a pass over the rows, so the unused hosts may take as much memory as the used ones
+        if self.unused_hosts > len(self.hosts) // 2:
+            self.rebuild_hosts()
+
+    def _host_id(self, host: str) -> int:
+        host_id = self.host_ids_by_host.get(host)
+        if host_id is None:
+            host_id = len(self.hosts)
+            self.hosts.append(host)
+            self.host_ids_by_host[host] = host_id
+            self.host_refs.append(0)
+            self.unused_hosts += 1
+        return host_id
+
+    def _ref_host(self, host_id: int) -> None:
+        if not self.host_refs[host_id]:
+            self.unused_hosts -= 1
+        self.host_refs[host_id] += 1
+
+    def _unref_host(self, host_id: int) -> None:
+        self.host_refs[host_id] -= 1
+        if not self.host_refs[host_id]:
+            self.unused_hosts += 1
+
+    def _set_host(self, row: int, host_id: int) -> None:
+        previous_host_id = self.host_ids[row]
+        if previous_host_id != host_id:
+            self.host_ids[row] = host_id
+            self._ref_host(host_id)
+            self._unref_host(previous_host_id)
+
+    def _columns(self) -> tuple:
+        return (
+            self.identifiers,
+            self.host_ids,
+            self.ports,
+            self.status_counts,
+            self.last_seen,
+            self.next_poll,
+            self.poll_intervals,
+            self.connected,
+            self.saved,
+            self.changed,
+            self.from_heartbeat,
+        )
+
+    def _add(self, identifier: int, host_id: int, port: int, status_count: int) -> int:
+        # raises OverflowError or TypeError for values which do not fit the columns, before any column is
+        # changed, so that the rows stay aligned
+        values = array("I", (identifier, host_id, port, status_count))
+        row = len(self.identifiers)
+        self.identifiers.append(values[0])
+        self.host_ids.append(values[1])
+        self.ports.append(values[2])
+        self.status_counts.append(values[3])
+        self.last_seen.append(0.0)
+        self.next_poll.append(0.0)
+        self.poll_intervals.append(self.min_poll_interval)
+        self.connected.append(0)
+        self.saved.append(0)
+        self.changed.append(1)
+        self.from_heartbeat.append(0)
+        self.unscheduled.append(identifier)
+        self.index[identifier] = row
+        self._ref_host(host_id)
+        return row
+
+    def _remove(self, row: int) -> None:
+        # move the last row into the hole so that rows stay contiguous
+        last = len(self.identifiers) - 1
+        del self.index[self.identifiers[row]]
+        self._unref_host(self.host_ids[row])
+        for column in self._columns():
+            if row != last:
+                column[row] = column[last]
+            column.pop()
+        if row != last:
+            self.index[self.identifiers[row]] = row
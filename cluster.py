@@ -0,0 +1,157 @@
+import asyncio
+import hashlib
+import logging
+import time
+
+from db_operations import AsyncPgPostgresManager
+
+log = logging.getLogger("__main__." + __name__)
+
+
+def shard_weight(node_id: str, shard: int) -> int:
+    # a stable hash, the same on every node unlike hash()
+    digest = hashlib.blake2b(f"{node_id}/{shard}".encode("utf-8"), digest_size=8)
+    return int.from_bytes(digest.digest(), "big")
+
+
+def assign_shards(node_id: str, node_ids: list, shard_count: int) -> list[int]:
+    """
+    This function assigns every shard to the node with the highest weight for it (rendezvous hashing):
+    every node computes the same assignment from the same list of nodes, and when a node joins or leaves
+    only the shards it takes or had move.
+
+    :param node_id: the node to return the shards of.
+    :param node_ids: all live nodes.
+    :param shard_count: number of shards.
+    :return: the shards assigned to node_id.
+    """
+    return [
+        shard
+        for shard in range(shard_count)
+        if max(node_ids, key=lambda node: (shard_weight(node, shard), node)) == node_id
+    ]
+
+
+class ShardCluster:
+    """
+    This class lets several server nodes share the clients: the identifiers are split into shard_count
+    shards (identifier % shard_count), and every node only keeps, polls and saves the clients of the
+    shards it holds a lease on.
+
+    Leases are rows in Postgres and are compared with the database clock. Every lease_seconds / 3 a node
+    renews its own lease, computes its shards from the live nodes with assign_shards(), releases the
+    shards it is not assigned anymore and claims the assigned ones. A shard still leased by another node
+    is only taken over once that node released it or its lease expired, so a shard is never polled by
+    two nodes at once, except for the status requests already sent during the handover: the Server hands
+    over the clients of a lost shard at its next poll tick. A node which cannot renew its leases stops
+    owning any shard when they expire.
+
+    It is used like a workers.HeartbeatRouter by the Server: heartbeats of clients owned by another node
+    are saved in the database with announce_clients(), where the owner reads them at its next refresh.
+    """
+
+    def __init__(
+        self,
+        db_op_manager: AsyncPgPostgresManager,
+        node_id: str,
+        shard_count: int = 256,
+        lease_seconds: float = 15.0,
+    ):
+        self.db_op_manager = db_op_manager
+        self.node_id = node_id
+        self.shard_count = shard_count
+        self.lease_seconds = lease_seconds
+        self.shards = frozenset()
+        self.lease_valid_until = 0.0  # time.monotonic() when self.shards expire
+        self.announced_clients = {}  # client_id -> (host, port), waiting to be saved
+        self.tables_created = False
+        self.task = None
+
+    def owned_shards(self) -> frozenset:
+        """
+        :return: the shards this node holds a valid lease on.
+        """
+        if time.monotonic() >= self.lease_valid_until:
+            return frozenset()
+        return self.shards
+
+    def owns(self, identifier: int) -> bool:
+        """
+        :param identifier: client identifier.
+        :return: True if this node owns the client.
+        """
+        return identifier % self.shard_count in self.owned_shards()
+
+    def forward(self, identifier: int, host: str, port: int, now: float) -> None:
+        """
+        This method queues the heartbeat of a client owned by another node, it is saved with the next
+        refresh().
+
+        :param identifier: client identifier.
+        :param host: client's host address.
+        :param port: client's port number
+        :param now: time of the heartbeat.
+        """
+        self.announced_clients[identifier] = (host, port)
+
+    def start(self, registry, heartbeat_writer=None) -> None:
+        """
+        This method starts renewing the leases in the background, from the running event loop.
+
+        :param registry: the server's ClientRegistry, not used.
+        :param heartbeat_writer: the server's HeartbeatWriteBehind, not used: heartbeats of other nodes'
+        clients are saved by refresh().
+        """
+        self.task = asyncio.ensure_future(self.run())
+
+    async def run(self) -> None:
+        while True:
+            await self.refresh()
+            await asyncio.sleep(self.lease_seconds / 3)
+
+    async def refresh(self) -> None:
+        """
+        This method renews the node's lease, claims its shards and saves the announced clients.
+        """
+        if not self.tables_created:
+            self.tables_created = await self.db_op_manager.create_cluster_tables()
+        # the leases are valid for lease_seconds from some time after this
+        started = time.monotonic()
+        node_ids = await self.db_op_manager.renew_node_lease(
+            self.node_id, self.lease_seconds
+        )
+        if node_ids is not None:
+            if self.node_id not in node_ids:
+                node_ids.append(self.node_id)
+            shards = await self.db_op_manager.claim_shards(
+                self.node_id,
+                assign_shards(self.node_id, node_ids, self.shard_count),
+                self.lease_seconds,
+            )
+            if shards is not None:
+                if frozenset(shards) != self.shards:
+                    log.info(
+                        "Node %s owns %d of %d shards, %d live nodes",
+                        self.node_id,
+                        len(shards),
+                        self.shard_count,
+                        len(node_ids),
+                    )
+                self.shards = frozenset(shards)
+                self.lease_valid_until = started + self.lease_seconds
+
+        if self.announced_clients:
+            announced_clients, self.announced_clients = self.announced_clients, {}
+            if not await self.db_op_manager.announce_clients(announced_clients):
+                # newer heartbeats win
+                announced_clients.update(self.announced_clients)
+                self.announced_clients = announced_clients
+
+    async def leave(self) -> None:
+        """
+        This method stops renewing the leases and releases them.
+        """
+        if self.task is not None:
+            self.task.cancel()
+        self.shards = frozenset()
+        await self.db_op_manager.leave_cluster(self.node_id)
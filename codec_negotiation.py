@@ -0,0 +1,25 @@
+"""
+One byte codec negotiation for heartbeat connections: when it is enabled on the server, a client starts every
+connection with the byte of the codec it uses, before its first frame, and the connection then uses that
+codec in both directions. Connections starting with an unknown byte are closed.
+"""
+from encode_decode_executor import EncodeDecodeExecutor
+from json_encoder_decoder import JsonEncoderDecoder
+from protobuf_encode_decoder import ProtobufEncoderDecoder
+
+PROTOBUF = b"P"
+JSON = b"J"
+# codec name, e.g. in the CODEC setting -> codec byte
+CODECS = {"protobuf": PROTOBUF, "json": JSON}
+
+
+def make_encoder_decoder(name: str) -> EncodeDecodeExecutor:
+    """
+    :param name: a codec name, see CODECS.
+    :return: the codec's EncodeDecodeExecutor.
+    """
+    if name not in CODECS:
+        raise ValueError(f"Unknown codec {name}, expected one of {tuple(CODECS)}")
+    if CODECS[name] == JSON:
+        return EncodeDecodeExecutor(JsonEncoderDecoder())
+    return EncodeDecodeExecutor(ProtobufEncoderDecoder())
@@ -1,26 +1,335 @@
+import asyncio
+import datetime
+import json
 import logging
+import re
+import time
 
 import asyncpg
 
+import migrations
+
 log = logging.getLogger("__main__." + __name__)
 
+# the client_record table is created and upgraded by migrations.py. The predicate is written out, not a
+# parameter, so that the plans can use the partial index of the connected clients
+SELECT_CLIENTS = "SELECT * FROM client_record WHERE is_connected"
+
+# the clients of some shards of the identifiers, see workers.HeartbeatRouter and cluster.ShardCluster
+SELECT_SHARD_CLIENTS = """
+   SELECT * FROM client_record
+   WHERE is_connected AND client_identifier % $1 = ANY($2::bigint[])
+"""
+
+CLIENT_RECORD_COLUMNS = [
+    "client_identifier",
+    "is_connected",
+    "client_host",
+    "client_port",
+    "status_count",
+]
+
+# rows are copied into this per connection table first and merged into client_record from there
+CREATE_STAGING_TABLE = """
+   CREATE TEMP TABLE IF NOT EXISTS client_record_staging
+   (LIKE client_record INCLUDING DEFAULTS) ON COMMIT DELETE ROWS
+"""
+
+UPSERT_STAGED_CLIENTS = """
+   INSERT INTO client_record(client_identifier, is_connected, client_host, client_port,
+   status_count, last_seen)
+   SELECT client_identifier, is_connected, client_host, client_port, status_count, last_seen
+   FROM client_record_staging
+   ON CONFLICT (client_identifier) DO UPDATE SET
+     is_connected = EXCLUDED.is_connected,
+     client_host = EXCLUDED.client_host,
+     client_port = EXCLUDED.client_port,
+     status_count = EXCLUDED.status_count,
+     last_seen = EXCLUDED.last_seen
+"""
+
+DELETE_CLIENTS = "DELETE FROM client_record WHERE client_identifier = ANY($1::bigint[])"
+
+# cluster mode, see cluster.ShardCluster: the lease of a node or a shard is valid until lease_expires_at,
+# compared with the database clock only
+CREATE_CLUSTER_TABLES = """
+   CREATE TABLE IF NOT EXISTS cluster_node (
+     node_id TEXT PRIMARY KEY,
+     lease_expires_at TIMESTAMPTZ NOT NULL
+   );
+   CREATE TABLE IF NOT EXISTS cluster_shard (
+     shard INTEGER PRIMARY KEY,
+     node_id TEXT NOT NULL,
+     lease_expires_at TIMESTAMPTZ NOT NULL
+   )
+"""
+
+RENEW_NODE_LEASE = """
+   INSERT INTO cluster_node(node_id, lease_expires_at)
+   VALUES($1, NOW() + $2 * INTERVAL '1 second')
+   ON CONFLICT (node_id) DO UPDATE SET lease_expires_at = EXCLUDED.lease_expires_at
+"""
+
+SELECT_LIVE_NODES = "SELECT node_id FROM cluster_node WHERE lease_expires_at > NOW()"
+
+# a shard is taken over only when its lease expired or was released
+CLAIM_SHARDS = """
+   INSERT INTO cluster_shard(shard, node_id, lease_expires_at)
+   SELECT shard, $1, NOW() + $3 * INTERVAL '1 second' FROM UNNEST($2::integer[]) AS shard
+   ON CONFLICT (shard) DO UPDATE SET
+     node_id = EXCLUDED.node_id,
+     lease_expires_at = EXCLUDED.lease_expires_at
+   WHERE cluster_shard.node_id = EXCLUDED.node_id OR cluster_shard.lease_expires_at <= NOW()
+   RETURNING shard
+"""
+
+RELEASE_SHARDS = """
+   DELETE FROM cluster_shard WHERE node_id = $1 AND NOT shard = ANY($2::integer[])
+"""
+
+DELETE_NODE = "DELETE FROM cluster_node WHERE node_id = $1"
+
+# clients which sent a heartbeat to a node which does not own them, the owner polls them from there
+ANNOUNCE_CLIENT = """
+   INSERT INTO client_record(client_identifier, is_connected, client_host, client_port, status_count)
+   VALUES($1, TRUE, $2, $3, 0)
+   ON CONFLICT (client_identifier) DO UPDATE SET
+     is_connected = TRUE,
+     client_host = EXCLUDED.client_host,
+     client_port = EXCLUDED.client_port
+"""
+
+# the latest heartbeat of clients owned by this server, see write_behind.HeartbeatWriteBehind
+SAVE_HEARTBEATS = """
+   INSERT INTO client_record(client_identifier, is_connected, client_host, client_port, status_count,
+   last_seen)
+   SELECT client_identifier, TRUE, client_host, client_port, 0, to_timestamp(last_seen)
+   FROM UNNEST($1::bigint[], $2::text[], $3::bigint[], $4::float8[])
+     AS heartbeat(client_identifier, client_host, client_port, last_seen)
+   ON CONFLICT (client_identifier) DO UPDATE SET
+     is_connected = TRUE,
+     client_host = EXCLUDED.client_host,
+     client_port = EXCLUDED.client_port,
+     last_seen = EXCLUDED.last_seen
+"""
+
+# with the client cache, every change of a client_record row is sent to the listeners of this channel, see
+# AsyncPgPostgresManager.saved_clients_from_cache(). Updates which only touch last_seen, like the
+# saved heartbeats, are not sent
+CLIENT_RECORD_CHANNEL = "client_record_changes"
+
+CREATE_CLIENT_RECORD_TRIGGERS = """
+   CREATE OR REPLACE FUNCTION notify_client_record() RETURNS trigger AS $$
+   DECLARE
+     client client_record;
+   BEGIN
+     IF TG_OP = 'TRUNCATE' THEN
+       PERFORM pg_notify('client_record_changes', json_build_object('op', TG_OP)::text);
+       RETURN NULL;
+     ELSIF TG_OP = 'DELETE' THEN
+       client := OLD;
+     ELSE
+       client := NEW;
+     END IF;
+     PERFORM pg_notify('client_record_changes', json_build_object(
+       'op', TG_OP,
+       'client_identifier', client.client_identifier,
+       'is_connected', client.is_connected,
+       'client_host', client.client_host,
+       'client_port', client.client_port,
+       'status_count', client.status_count
+     )::text);
+     RETURN NULL;
+   END;
+   $$ LANGUAGE plpgsql;
+
+   DO $$
+   BEGIN
+     IF NOT EXISTS (SELECT 1 FROM pg_trigger WHERE tgname = 'client_record_notify') THEN
+       CREATE TRIGGER client_record_notify AFTER INSERT OR DELETE ON client_record
+       FOR EACH ROW EXECUTE PROCEDURE notify_client_record();
+       CREATE TRIGGER client_record_notify_update AFTER UPDATE ON client_record
+       FOR EACH ROW WHEN (
+         OLD.is_connected IS DISTINCT FROM NEW.is_connected
+         OR OLD.client_host IS DISTINCT FROM NEW.client_host
+         OR OLD.client_port IS DISTINCT FROM NEW.client_port
+         OR OLD.status_count IS DISTINCT FROM NEW.status_count
+       ) EXECUTE PROCEDURE notify_client_record();
+       CREATE TRIGGER client_record_notify_truncate AFTER TRUNCATE ON client_record
+       FOR EACH STATEMENT EXECUTE PROCEDURE notify_client_record();
+     END IF;
+   END
+   $$
+"""
+
+# the columns of the saved clients used by the server
+SELECT_CACHED_CLIENTS = """
+   SELECT client_identifier, is_connected, client_host, client_port, status_count
+   FROM client_record WHERE is_connected
+"""
+
+# the result of every status request, see migrations.py for the tables. The rows are copied into a per
+# connection staging table, from where they are appended to the history and added to the rollups
+STATUS_HISTORY_COLUMNS = [
+    "client_identifier",
+    "recorded_at",
+    "connected",
+    "status_count",
+    "previous_count",
+]
+
+CREATE_STATUS_STAGING_TABLE = """
+   CREATE TEMP TABLE IF NOT EXISTS client_status_staging
+   (LIKE client_status_history) ON COMMIT DELETE ROWS
+"""
+
+INSERT_STAGED_STATUS_HISTORY = (
+    "INSERT INTO client_status_history SELECT * FROM client_status_staging"
+)
+
+# buckets are cut in UTC whatever the time zone of the session
+ROLLUP_STAGED_STATUS_HISTORY = """
+   INSERT INTO {table} AS rollup(client_identifier, bucket, samples, failures, mismatches, min_count,
+   max_count)
+   SELECT client_identifier, date_trunc('{unit}', recorded_at AT TIME ZONE 'UTC') AT TIME ZONE 'UTC',
+     count(*),
+     count(*) FILTER (WHERE NOT connected),
+     count(*) FILTER (WHERE connected AND status_count <> previous_count),
+     min(status_count) FILTER (WHERE connected),
+     max(status_count) FILTER (WHERE connected)
+   FROM client_status_staging
+   GROUP BY 1, 2
+   ON CONFLICT (client_identifier, bucket) DO UPDATE SET
+     samples = rollup.samples + EXCLUDED.samples,
+     failures = rollup.failures + EXCLUDED.failures,
+     mismatches = rollup.mismatches + EXCLUDED.mismatches,
+     min_count = LEAST(rollup.min_count, EXCLUDED.min_count),
+     max_count = GREATEST(rollup.max_count, EXCLUDED.max_count)
+"""
+
+# resolution -> (rollup table, unit of its buckets), "raw" reads the history itself
+STATUS_ROLLUPS = {
+    "minute": ("client_status_minute", "minute"),
+    "hour": ("client_status_hour", "hour"),
+}
+STATUS_RESOLUTIONS = ("raw", *STATUS_ROLLUPS)
+
+SELECT_STATUS_HISTORY = """
+   SELECT recorded_at, connected, status_count, previous_count FROM client_status_history
+   WHERE client_identifier = $1 AND recorded_at >= $2 AND recorded_at < $3
+   ORDER BY recorded_at
+"""
+
+SELECT_STATUS_ROLLUP = """
+   SELECT bucket, samples, failures, mismatches, min_count, max_count FROM {table}
+   WHERE client_identifier = $1 AND bucket >= $2 AND bucket < $3
+   ORDER BY bucket
+"""
+
+SELECT_STATUS_MISMATCHES = """
+   SELECT client_identifier, sum(mismatches) AS mismatches, sum(samples) AS samples FROM {table}
+   WHERE bucket >= $1 AND bucket < $2 AND mismatches > 0
+   GROUP BY client_identifier
+   ORDER BY mismatches DESC, client_identifier
+   LIMIT $3
+"""
+
+SELECT_STATUS_PARTITIONS = """
+   SELECT child.relname FROM pg_inherits
+   JOIN pg_class child ON child.oid = pg_inherits.inhrelid
+   WHERE pg_inherits.inhparent = 'client_status_history'::regclass
+"""
+
+# one partition per UTC day, named after it
+STATUS_PARTITION_PREFIX = "client_status_history_p"
+STATUS_PARTITION_NAME = re.compile(STATUS_PARTITION_PREFIX + r"(\d{8})")
+CREATE_STATUS_PARTITION = """
+   CREATE TABLE IF NOT EXISTS {name} PARTITION OF client_status_history
+   FOR VALUES FROM ('{start}') TO ('{end}')
+"""
+
+DELETE_EXPIRED_ROLLUP = "DELETE FROM {table} WHERE bucket < $1"
+
+
+def utc_datetime(timestamp: float) -> datetime.datetime:
+    return datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc)
+
+
+def status_partition_day(name: str):
+    """
+    :param name: name of a partition of client_status_history.
+    :return: the day of a partition created by maintain_status_history(), None for any other partition.
+    """
+    match = STATUS_PARTITION_NAME.fullmatch(name)
+    if match is None:
+        return None
+    try:
+        return datetime.datetime.strptime(match.group(1), "%Y%m%d").date()
+    except ValueError:
+        return None
+
 
 class AsyncPgPostgresManager:
-    def __init__(self, user, password, database_name, db_host, db_port):
+    def __init__(
+        self,
+        user,
+        password,
+        database_name,
+        db_host,
+        db_port,
+        min_pool_size=2,
+        max_pool_size=10,
+        cache_clients=False,
+        history_retention_days=7,
+        minute_rollup_retention_days=30,
+        hour_rollup_retention_days=365,
+    ):
         self.user = user
         self.password = password
         self.database = database_name
         self.host = db_host
         self.port = db_port
+        self.min_pool_size = min_pool_size
+        self.max_pool_size = max_pool_size
+        self.pool = None
+        # the saved clients are read once and then kept up to date, see saved_clients_from_cache()
+        self.cache_clients = cache_clients
+        self.saved_clients = None  # client_id -> row of client_record, None until read
+        self.listener = None  # connection listening to CLIENT_RECORD_CHANNEL
+        self.notifications = None  # changes received while the saved clients are read
+        self.cache_lock = None  # created on first use, inside the event loop
+        self.start_lock = None  # held while the pool is opened, created like cache_lock
+        # days the status history is kept, see maintain_status_history()
+        self.history_retention_days = history_retention_days
+        self.minute_rollup_retention_days = minute_rollup_retention_days
+        self.hour_rollup_retention_days = hour_rollup_retention_days
+        self.history_maintained_until = 0.0  # time.time() of the next maintenance
+        self.history_partition_days = (
+            set()
+        )  # dates of the partitions seen by the last maintenance
 
-    async def query_saved_clients_from_db(self) -> list[dict]:
+    async def start(self) -> bool:
         """
-        This function retrieves all active clients from the database.
-        :return: a list of all active clients
+        This method migrates the schema to the latest version (see migrations.py) and then opens the
+        connection pool.
+        The pool opens min_pool_size connections upfront and prepares the statements on each of them, so
+        the first queries do not pay for connection setup.
+        If the database is not reachable, the next query calls this method again. Concurrent calls wait for
+        the first one and use its pool instead of opening their own.
+
+        :return: True if the pool is ready to use.
         """
+        if self.start_lock is None:
+            self.start_lock = asyncio.Lock()
+        async with self.start_lock:
+            if self.pool is not None:
+                return True
+            return await self.open_pool()
+
+    async def open_pool(self) -> bool:
         conn = None
         try:
-            log.info("query_saved_clients_from_db()")
+            log.info("start()")
             conn = await asyncpg.connect(
                 user=self.user,
                 password=self.password,
@@ -28,86 +337,609 @@ class AsyncPgPostgresManager:
                 host=self.host,
                 port=self.port,
             )
-
-            # Execute a statement to create a new table if necessary
-            await conn.execute(
-                """
-               CREATE TABLE IF NOT EXISTS client_record (
-                 client_identifier INTEGER NOT NULL,
-                 status_count INTEGER,
-                 is_connected BOOLEAN NOT NULL,
-                 PRIMARY KEY (client_identifier , is_connected),             
-                 client_host  CHAR(200) NOT NULL,             
-                 client_port INTEGER NOT NULL,
-                 connection_time  TIMESTAMP NOT NULL DEFAULT NOW()
-                 )
-           """
+            await migrations.migrate(
+                conn, CREATE_CLIENT_RECORD_TRIGGERS if self.cache_clients else None
             )
+            await conn.close()
 
-            # get all active clients
-            rows = await conn.fetch(
-                "SELECT * FROM client_record WHERE is_connected = $1", True
+            self.pool = await asyncpg.create_pool(
+                user=self.user,
+                password=self.password,
+                database=self.database,
+                host=self.host,
+                port=self.port,
+                min_size=self.min_pool_size,
+                max_size=self.max_pool_size,
+                init=self.init_connection,
             )
+            return True
+        except Exception as e:
+            if conn:
+                await conn.close()
+            log.error(f"Database exception happened {e}")
+            return False
 
-            active_clients = [dict(row) for row in rows]
+    @staticmethod
+    async def init_connection(conn: asyncpg.Connection) -> None:
+        """
+        This method is called by the pool once for every new connection. It creates the connection's
+        staging tables of the COPY writes. asyncpg prepares a statement the first time it runs on a
+        connection and keeps it prepared in the connection's statement cache, so the select and write
+        statements are run here without touching any row.
 
-            # Close the connection
-            await conn.close()
+        :param conn: the new connection.
+        """
+        # the transaction releases the locks taken while preparing, idle connections must not block DDL
+        async with conn.transaction():
+            await conn.execute(CREATE_STAGING_TABLE)
+            await conn.execute(CREATE_STATUS_STAGING_TABLE)
+            await conn.fetch(SELECT_SHARD_CLIENTS, 1, [])  # no shard never matches
+            await conn.execute(DELETE_CLIENTS, [])
+
+    async def close(self) -> None:
+        """
+        This method closes all connections of the pool.
+        """
+        if self.listener is not None:
+            listener, self.listener = self.listener, None
+            self.saved_clients = None
+            await listener.close()
+        if self.pool:
+            log.info("close()")
+            await self.pool.close()
+            self.pool = None
+
+    async def query_saved_clients_from_db(
+        self, shard_count: int = 1, shards=None
+    ) -> list[dict]:
+        """
+        This function retrieves all active clients from the database.
+        :param shard_count: number of shards splitting the clients.
+        :param shards: only the clients with client_identifier % shard_count in shards are returned, all
+        clients if None.
+        :return: a list of all active clients
+        """
+        if self.pool is None and not await self.start():
+            return []
+        if self.cache_clients:
+            saved_clients = await self.saved_clients_from_cache()
+            if saved_clients is not None:
+                if shards is None:
+                    return list(saved_clients.values())
+                return [
+                    client
+                    for client_id, client in saved_clients.items()
+                    if client_id % shard_count in shards
+                ]
+        try:
+            log.info("query_saved_clients_from_db()")
+            async with self.pool.acquire() as conn:
+                # get all active clients
+                if shards is None:
+                    rows = await conn.fetch(SELECT_CLIENTS)
+                else:
+                    rows = await conn.fetch(
+                        SELECT_SHARD_CLIENTS, shard_count, list(shards)
+                    )
+
+            active_clients = [dict(row) for row in rows]
             return active_clients
         except Exception as e:
-            if conn:
-                await conn.close()
             log.error(f"Database exception happened {e}")
             return []
 
-    async def update_client_list_to_db(self, updated_clients_mapping: dict) -> None:
+    async def saved_clients_from_cache(self) -> dict:
         """
-        This method updates clients information to the database.
+        This method returns the saved clients from memory. They are read from the database once, after
+        listening to the changes of client_record sent by its triggers; these changes, from any writer,
+        are then applied to the cached rows one by one, and the writes of this manager update them too.
+        When the listening connection is lost the clients are read again.
 
-        :param updated_clients_mapping: a dictionary of all active clients information.
-        :return:
+        :return: a mapping of client_id to its row, None if the database is not reachable.
         """
-        conn = None
+        if self.saved_clients is not None:
+            return self.saved_clients
+        if self.cache_lock is None:
+            self.cache_lock = asyncio.Lock()
+        async with self.cache_lock:
+            if self.saved_clients is not None:
+                return self.saved_clients
+            try:
+                if self.listener is None:
+                    self.listener = await asyncpg.connect(
+                        user=self.user,
+                        password=self.password,
+                        database=self.database,
+                        host=self.host,
+                        port=self.port,
+                    )
+                    self.listener.add_termination_listener(self.listener_lost)
+                    await self.listener.add_listener(
+                        CLIENT_RECORD_CHANNEL, self.client_record_changed
+                    )
+                # the changes committed while reading are applied afterwards, in order
+                self.notifications = []
+                log.info("saved_clients_from_cache() reading the saved clients")
+                async with self.pool.acquire() as conn:
+                    rows = await conn.fetch(SELECT_CACHED_CLIENTS)
+                self.saved_clients = {
+                    row["client_identifier"]: dict(row) for row in rows
+                }
+                notifications, self.notifications = self.notifications, None
+                for change in notifications:
+                    self.apply_client_change(change)
+                return self.saved_clients
+            except Exception as e:
+                log.error(f"Database exception happened {e}")
+                self.notifications = None
+                return None
+
+    def client_record_changed(self, conn, pid: int, channel: str, payload: str) -> None:
+        change = json.loads(payload)
+        if self.notifications is not None:
+            self.notifications.append(change)
+        elif self.saved_clients is not None:
+            self.apply_client_change(change)
+
+    def listener_lost(self, conn) -> None:
+        if conn is self.listener:
+            log.error("Connection listening to client_record changes lost")
+            # changes may be missed from now on
+            self.listener = None
+            self.saved_clients = None
+
+    def apply_client_change(self, change: dict) -> None:
+        """
+        :param change: a notification of the client_record triggers.
+        """
+        op = change["op"]
+        if op == "TRUNCATE":
+            self.saved_clients.clear()
+        elif op == "DELETE" or not change["is_connected"]:
+            self.saved_clients.pop(change["client_identifier"], None)
+        else:
+            del change["op"]
+            self.saved_clients[change["client_identifier"]] = change
+
+    def cache_clients_saved(self, clients: dict, keep_status_count: bool) -> None:
+        """
+        This method applies the clients written by this manager to the cached rows, without waiting for the
+        notifications of the write.
+
+        :param clients: a mapping of client_id to (host, port, status_count).
+        :param keep_status_count: True if the status count of a saved client is not written.
+        """
+        saved_clients = self.saved_clients
+        if saved_clients is None:
+            return
+        for client_id, (host, port, status_count) in clients.items():
+            client = saved_clients.get(client_id)
+            if client is not None and keep_status_count:
+                status_count = client["status_count"]
+            saved_clients[client_id] = {
+                "client_identifier": client_id,
+                "is_connected": True,
+                "client_host": host,
+                "client_port": port,
+                "status_count": status_count,
+            }
 
+    @staticmethod
+    def _client_records(clients_mapping: dict) -> list[tuple]:
+        return [
+            (
+                client_id,
+                True,
+                client.get("client_host"),
+                client.get("client_port"),
+                client.get("status_count"),
+            )
+            for client_id, client in clients_mapping.items()
+        ]
+
+    @staticmethod
+    def _client_values(clients_mapping: dict) -> dict:
+        return {
+            client_id: (
+                client.get("client_host"),
+                client.get("client_port"),
+                client.get("status_count"),
+            )
+            for client_id, client in clients_mapping.items()
+        }
+
+    async def update_changed_clients_to_db(
+        self, changed_clients: dict, removed_client_ids: list
+    ) -> bool:
+        """
+        This method writes only what changed since the last update: the new or changed clients are copied
+        and upserted, the removed ones are deleted, in one transaction.
+
+        :param changed_clients: a dictionary of the new or changed clients information.
+        :param removed_client_ids: identifiers of the clients to delete.
+        :return: True if the changes are saved.
+        """
+        if not changed_clients and not removed_client_ids:
+            return True
+        if self.pool is None and not await self.start():
+            return False
         try:
-            log.info("update_client_list_to_db")
-            conn = await asyncpg.connect(
-                user=self.user,
-                password=self.password,
-                database=self.database,
-                host=self.host,
-                port=self.port,
+            log.info(
+                f"update_changed_clients_to_db {len(changed_clients)} changed "
+                f"{len(removed_client_ids)} removed"
             )
+            async with self.pool.acquire() as conn:
+                async with conn.transaction():
+                    if removed_client_ids:
+                        await conn.execute(DELETE_CLIENTS, removed_client_ids)
+                    if changed_clients:
+                        await conn.copy_records_to_table(
+                            "client_record_staging",
+                            records=self._client_records(changed_clients),
+                            columns=CLIENT_RECORD_COLUMNS,
+                        )
+                        await conn.execute(UPSERT_STAGED_CLIENTS)
+            if self.saved_clients is not None:
+                for client_id in removed_client_ids:
+                    self.saved_clients.pop(client_id, None)
+                self.cache_clients_saved(self._client_values(changed_clients), False)
+            return True
+        except Exception as e:
+            log.error(f"Database exception happened {e}")
+            return False
+
+    async def create_cluster_tables(self) -> bool:
+        """
+        This method creates the lease tables of the cluster mode.
+
+        :return: True if the tables exist.
+        """
+        if self.pool is None and not await self.start():
+            return False
+        try:
+            async with self.pool.acquire() as conn:
+                await conn.execute(CREATE_CLUSTER_TABLES)
+            return True
+        except Exception as e:
+            log.error(f"Database exception happened {e}")
+            return False
+
+    async def renew_node_lease(self, node_id: str, lease_seconds: float) -> list:
+        """
+        This method extends the lease of a cluster node.
+
+        :param node_id: the node.
+        :param lease_seconds: the lease is valid for this many seconds from now.
+        :return: the identifiers of all nodes with a valid lease, or None if the lease is not renewed.
+        """
+        if self.pool is None and not await self.start():
+            return None
+        try:
+            async with self.pool.acquire() as conn:
+                async with conn.transaction():
+                    await conn.execute(RENEW_NODE_LEASE, node_id, lease_seconds)
+                    rows = await conn.fetch(SELECT_LIVE_NODES)
+            return [row["node_id"] for row in rows]
+        except Exception as e:
+            log.error(f"Database exception happened {e}")
+            return None
+
+    async def claim_shards(
+        self, node_id: str, shards: list, lease_seconds: float
+    ) -> list:
+        """
+        This method claims or extends the leases of the given shards for a node and releases the other
+        shards it holds. A shard held by another node is only claimed once its lease expired.
+
+        :param node_id: the node.
+        :param shards: the shards the node should own.
+        :param lease_seconds: the leases are valid for this many seconds from now.
+        :return: the shards the node holds now, or None if the leases are not renewed.
+        """
+        if self.pool is None and not await self.start():
+            return None
+        try:
+            async with self.pool.acquire() as conn:
+                async with conn.transaction():
+                    await conn.execute(RELEASE_SHARDS, node_id, shards)
+                    rows = await conn.fetch(
+                        CLAIM_SHARDS, node_id, shards, lease_seconds
+                    )
+            return [row["shard"] for row in rows]
+        except Exception as e:
+            log.error(f"Database exception happened {e}")
+            return None
+
+    async def leave_cluster(self, node_id: str) -> bool:
+        """
+        This method removes a node and releases its shards, so that the other nodes take them over
+        without waiting for the leases to expire.
+
+        :param node_id: the node.
+        :return: True if the node left.
+        """
+        if self.pool is None and not await self.start():
+            return False
+        try:
+            async with self.pool.acquire() as conn:
+                async with conn.transaction():
+                    await conn.execute(RELEASE_SHARDS, node_id, [])
+                    await conn.execute(DELETE_NODE, node_id)
+            return True
+        except Exception as e:
+            log.error(f"Database exception happened {e}")
+            return False
+
+    async def announce_clients(self, clients: dict) -> bool:
+        """
+        This method saves the address of clients owned by another node, which then polls them. The status
+        count of a client already saved is kept.
+
+        :param clients: a mapping of client_id to (host, port).
+        :return: True if the clients are saved.
+        """
+        if self.pool is None and not await self.start():
+            return False
+        try:
+            async with self.pool.acquire() as conn:
+                await conn.executemany(
+                    ANNOUNCE_CLIENT,
+                    [
+                        (client_id, host, port)
+                        for client_id, (host, port) in clients.items()
+                    ],
+                )
+            self.cache_clients_saved(
+                {
+                    client_id: (host, port, 0)
+                    for client_id, (host, port) in clients.items()
+                },
+                True,
+            )
+            return True
+        except Exception as e:
+            log.error(f"Database exception happened {e}")
+            return False
 
-            # better to use a transaction since we are removing everything and saving fresh clients information
-            async with conn.transaction():
+    async def save_heartbeats(self, heartbeats: dict) -> bool:
+        """
+        This method saves the address and the time of the latest heartbeat of clients in one statement.
+        The status count of a client already saved is kept. If the statement is rejected because of the
+        values, the heartbeats are saved one by one and the ones which cannot be saved are dropped, so they
+        are not retried forever.
+
+        :param heartbeats: a mapping of client_id to (host, port, time of the heartbeat).
+        :return: True if the heartbeats are saved or dropped, False if the database is unavailable.
+        """
+        if not heartbeats:
+            return True
+        if self.pool is None and not await self.start():
+            return False
+        try:
+            hosts, ports, times = zip(*heartbeats.values())
+            async with self.pool.acquire() as conn:
+                try:
+                    await conn.execute(
+                        SAVE_HEARTBEATS, list(heartbeats), hosts, ports, times
+                    )
+                except asyncpg.DataError as e:
+                    log.error(f"Saving heartbeats one by one after {e}")
+                    heartbeats = await self._save_heartbeats_one_by_one(
+                        conn, heartbeats
+                    )
+            self.cache_clients_saved(
+                {
+                    client_id: (host, port, 0)
+                    for client_id, (host, port, _) in heartbeats.items()
+                },
+                True,
+            )
+            return True
+        except Exception as e:
+            log.error(f"Database exception happened {e}")
+            return False
 
+    @staticmethod
+    async def _save_heartbeats_one_by_one(
+        conn: asyncpg.Connection, heartbeats: dict
+    ) -> dict:
+        saved = {}
+        for client_id, (host, port, last_seen) in heartbeats.items():
+            try:
                 await conn.execute(
-                    """
-                               TRUNCATE client_record
-                           """
+                    SAVE_HEARTBEATS, [client_id], [host], [port], [last_seen]
                 )
+            except asyncpg.DataError as e:
+                log.error(f"Dropped the heartbeat of client {client_id!r}: {e}")
+                continue
+            saved[client_id] = (host, port, last_seen)
+        return saved
+
+    async def save_status_history(self, statuses: list[tuple]) -> bool:
+        """
+        This method appends the results of status requests to client_status_history with one COPY, and adds
+        them to the per minute and per hour rollups, in one transaction. The partitions of the days of the
+        statuses are created first, as statuses buffered during an outage may be days old; the statuses
+        older than history_retention_days are dropped like their partitions.
 
-                for client_id in updated_clients_mapping:
-                    host = updated_clients_mapping[client_id].get("client_host")
-                    port = updated_clients_mapping[client_id].get("client_port")
-                    status_count = updated_clients_mapping[client_id].get(
-                        "status_count"
+        :param statuses: a list of (client_id, time.time() of the request, True if the client answered,
+        status count, status count before the request) tuples.
+        :return: True if the statuses are saved.
+        """
+        if not statuses:
+            return True
+        oldest_day = utc_datetime(time.time()).date() - datetime.timedelta(
+            days=self.history_retention_days
+        )
+        records = []
+        days = set()
+        for client_id, recorded_at, *status in statuses:
+            recorded_at = utc_datetime(recorded_at)
+            day = recorded_at.date()
+            if day < oldest_day:
+                continue
+            days.add(day)
+            records.append((client_id, recorded_at, *status))
+        if len(records) < len(statuses):
+            log.warning(
+                "Dropping %d statuses older than %d days",
+                len(statuses) - len(records),
+                self.history_retention_days,
+            )
+        if not records:
+            return True
+        if self.pool is None and not await self.start():
+            return False
+        if not await self.maintain_status_history(
+            days=days - self.history_partition_days
+        ):
+            return False
+        try:
+            async with self.pool.acquire() as conn:
+                async with conn.transaction():
+                    await conn.copy_records_to_table(
+                        "client_status_staging",
+                        records=records,
+                        columns=STATUS_HISTORY_COLUMNS,
                     )
+                    await conn.execute(INSERT_STAGED_STATUS_HISTORY)
+                    for table, unit in STATUS_ROLLUPS.values():
+                        await conn.execute(
+                            ROLLUP_STAGED_STATUS_HISTORY.format(table=table, unit=unit)
+                        )
+            return True
+        except Exception as e:
+            log.error(f"Database exception happened {e}")
+            return False
+
+    async def maintain_status_history(self, force: bool = False, days=()) -> bool:
+        """
+        This method creates the partitions of client_status_history from yesterday to 2 days ahead and for
+        the given days, drops the partitions older than history_retention_days and deletes the expired
+        rollups. It runs once per hour unless forced or given days without a partition.
+
+        :param force: True to run it now.
+        :param days: the dates of statuses about to be saved.
+        :return: True if the partitions are ready.
+        """
+        now = time.time()
+        if not force and not days and now < self.history_maintained_until:
+            return True
+        if self.pool is None and not await self.start():
+            return False
+        today = utc_datetime(now).date()
+        oldest_day = today - datetime.timedelta(days=self.history_retention_days)
+        new_days = {today + datetime.timedelta(days=offset) for offset in range(-1, 3)}
+        new_days.update(days)
+        partition_days = set()
+        try:
+            async with self.pool.acquire() as conn:
+                async with conn.transaction():
+                    # with several servers, one at a time
                     await conn.execute(
-                        """
-                       INSERT INTO client_record(client_identifier, is_connected, client_host, client_port, 
-                       status_count) VALUES($1, $2, $3, $4, $5)
-                   """,
-                        client_id,
-                        True,
-                        host,
-                        port,
-                        status_count,
+                        "SELECT pg_advisory_xact_lock($1)", migrations.MIGRATION_LOCK_ID
                     )
+                    for day in sorted(new_days):
+                        if day < oldest_day:
+                            continue
+                        await conn.execute(
+                            CREATE_STATUS_PARTITION.format(
+                                name=f"{STATUS_PARTITION_PREFIX}{day:%Y%m%d}",
+                                start=f"{day.isoformat()} 00:00+00",
+                                end=f"{day + datetime.timedelta(days=1)} 00:00+00",
+                            )
+                        )
+                    for row in await conn.fetch(SELECT_STATUS_PARTITIONS):
+                        name = row["relname"]
+                        day = status_partition_day(name)
+                        if day is None:
+                            # e.g. a DEFAULT partition, not managed here
+                            continue
+                        if day < oldest_day:
+                            log.info("Dropping status history partition %s", name)
+                            await conn.execute(f"DROP TABLE {name}")
+                        else:
+                            partition_days.add(day)
+                    for resolution, retention_days in (
+                        ("minute", self.minute_rollup_retention_days),
+                        ("hour", self.hour_rollup_retention_days),
+                    ):
+                        table, _ = STATUS_ROLLUPS[resolution]
+                        await conn.execute(
+                            DELETE_EXPIRED_ROLLUP.format(table=table),
+                            utc_datetime(now - retention_days * 86400),
+                        )
+            self.history_partition_days = partition_days
+            self.history_maintained_until = now + 3600
+            return True
+        except Exception as e:
+            log.error(f"Database exception happened {e}")
+            return False
 
-            await conn.close()
+    async def query_status_history(
+        self, client_id: int, start: float, end: float, resolution: str = None
+    ) -> list[dict]:
+        """
+        This method reads the status history of a client. The rollups are read by default, so that long
+        periods are read from a few rows per hour or per day instead of every status request; the raw
+        history is only read when asked for, from the partitions of the period only.
+
+        :param client_id: client identifier.
+        :param start: time.time() of the beginning of the period.
+        :param end: time.time() of the end of the period, excluded.
+        :param resolution: "raw", "minute" or "hour", None for "minute" up to 2 days and "hour" beyond.
+        :return: the status requests as dicts with recorded_at, connected, status_count and
+        previous_count for "raw", otherwise one dict per minute or hour with bucket, samples, failures,
+        mismatches, min_count and max_count.
+        """
+        if resolution is None:
+            resolution = "minute" if end - start <= 2 * 86400 else "hour"
+        if resolution not in STATUS_RESOLUTIONS:
+            raise ValueError(
+                f"resolution must be one of {STATUS_RESOLUTIONS}, got {resolution}"
+            )
+        if self.pool is None and not await self.start():
+            return []
+        if resolution == "raw":
+            query = SELECT_STATUS_HISTORY
+        else:
+            table, _ = STATUS_ROLLUPS[resolution]
+            query = SELECT_STATUS_ROLLUP.format(table=table)
+        try:
+            async with self.pool.acquire() as conn:
+                rows = await conn.fetch(
+                    query, client_id, utc_datetime(start), utc_datetime(end)
+                )
+            return [dict(row) for row in rows]
         except Exception as e:
-            if conn:
-                await conn.close()
             log.error(f"Database exception happened {e}")
+            return []
+
+    async def query_status_mismatches(
+        self, start: float, end: float, limit: int = 100, resolution: str = "hour"
+    ) -> list[dict]:
+        """
+        This method finds the clients whose status count differed most often from the saved one, from the
+        rollups.
+
+        :param start: time.time() of the beginning of the period.
+        :param end: time.time() of the end of the period, excluded.
+        :param limit: maximum number of clients returned.
+        :param resolution: the rollup to read, "minute" or "hour".
+        :return: dicts with client_identifier, mismatches and samples, most mismatches first.
+        """
+        table, _ = STATUS_ROLLUPS[resolution]
+        if self.pool is None and not await self.start():
+            return []
+        try:
+            async with self.pool.acquire() as conn:
+                rows = await conn.fetch(
+                    SELECT_STATUS_MISMATCHES.format(table=table),
+                    utc_datetime(start),
+                    utc_datetime(end),
+                    limit,
+                )
+            return [dict(row) for row in rows]
+        except Exception as e:
+            log.error(f"Database exception happened {e}")
+            return []
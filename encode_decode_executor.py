@@ -13,3 +13,33 @@ class EncodeDecodeExecutor:
 
     def decode_status(self, binary_data):
         return self.executor.decode_status(binary_data)
+
+    def encode_heartbeat_batch(self, msg_dicts):
+        return self.executor.encode_heartbeat_batch(msg_dicts)
+
+    def decode_heartbeat_batch(self, binary_data):
+        return self.executor.decode_heartbeat_batch(binary_data)
+
+    def encode_status_batch(self, msg_dicts):
+        return self.executor.encode_status_batch(msg_dicts)
+
+    def decode_status_batch(self, binary_data):
+        return self.executor.decode_status_batch(binary_data)
+
+    def decode_message_type(self, binary_data):
+        return self.executor.decode_message_type(binary_data)
+
+    def peek_heartbeat_identifier(self, binary_data):
+        return self.executor.peek_heartbeat_identifier(binary_data)
+
+    def decode_heartbeat_record(self, binary_data):
+        return self.executor.decode_heartbeat_record(binary_data)
+
+    def encode_heartbeat_record(self, record):
+        return self.executor.encode_heartbeat_record(record)
+
+    def decode_status_record(self, binary_data):
+        return self.executor.decode_status_record(binary_data)
+
+    def encode_status_record(self, record):
+        return self.executor.encode_status_record(record)
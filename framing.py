@@ -0,0 +1,112 @@
+"""
+Length-delimited framing for messages sent over a stream connection. Every message is preceded by its
+length encoded as a varint, the same layout protobuf uses for delimited messages, so any number of
+messages can follow each other on one connection and a message may arrive in any number of segments.
+"""
+import asyncio
+
+MAX_FRAME_SIZE = 64 * 1024
+MAX_VARINT_SIZE = 10  # bytes needed for a 64 bit varint
+
+
+class FrameError(Exception):
+    """
+    Raised when the data on a connection is not a valid frame.
+    """
+
+
+def encode_varint(value: int) -> bytes:
+    """
+    Encode a non-negative integer as a protobuf varint.
+    :param value: the integer to encode.
+    :return: the varint bytes.
+    """
+    if value < 0:
+        raise ValueError(f"varint must not be negative, got {value}")
+    data = bytearray()
+    while value > 0x7F:
+        data.append((value & 0x7F) | 0x80)
+        value >>= 7
+    data.append(value)
+    return bytes(data)
+
+
+def encode_frame(payload: bytes) -> bytes:
+    """
+    Prefix a serialized message with its length.
+    :param payload: the serialized message.
+    :return: the frame to write to the connection.
+    """
+    return encode_varint(len(payload)) + payload
+
+
+async def read_frame(
+    reader: asyncio.StreamReader, max_frame_size: int = MAX_FRAME_SIZE
+) -> bytes:
+    """
+    Read the next frame from a connection.
+    :param reader: StreamReader object to read data from.
+    :param max_frame_size: frames with a longer payload are rejected with FrameError.
+    :return: the frame's payload, or None if the connection was closed before a new frame started.
+    """
+    length = 0
+    for index in range(MAX_VARINT_SIZE):
+        byte = await reader.read(1)
+        if not byte:
+            if index == 0:
+                return None
+            raise FrameError("connection closed in the middle of a frame length")
+        length |= (byte[0] & 0x7F) << (7 * index)
+        if not byte[0] & 0x80:
+            break
+    else:
+        raise FrameError("varint is too long")
+
+    if length > max_frame_size:
+        raise FrameError(f"frame of {length} bytes exceeds {max_frame_size} bytes")
+    try:
+        return await reader.readexactly(length)
+    except asyncio.IncompleteReadError:
+        raise FrameError("connection closed in the middle of a frame")
+
+
+def find_frame(buffer, start: int, end: int, max_frame_size: int = MAX_FRAME_SIZE):
+    """
+    Find the next frame in data received into a buffer, without copying it.
+    :param buffer: a bytearray or memoryview holding the received data.
+    :param start: position of the next frame in buffer.
+    :param end: end of the received data in buffer.
+    :param max_frame_size: frames with a longer payload are rejected with FrameError.
+    :return: (payload start, payload end) positions in buffer, or None if the frame is not complete yet.
+    """
+    frame = frame_bounds(buffer, start, end, max_frame_size)
+    if frame is None or frame[1] > end:
+        return None
+    return frame
+
+
+def frame_bounds(buffer, start: int, end: int, max_frame_size: int = MAX_FRAME_SIZE):
+    """
+    Read the length of the next frame in a buffer, the frame may not be complete yet.
+    :param buffer: a bytearray or memoryview holding the received data.
+    :param start: position of the next frame in buffer.
+    :param end: end of the received data in buffer.
+    :param max_frame_size: frames with a longer payload are rejected with FrameError.
+    :return: (payload start, payload end) positions in buffer, payload end may be beyond end, or None if
+    the length itself is not complete yet.
+    """
+    length = 0
+    for index in range(MAX_VARINT_SIZE):
+        position = start + index
+        if position >= end:
+            return None
+        byte = buffer[position]
+        length |= (byte & 0x7F) << (7 * index)
+        if not byte & 0x80:
+            break
+    else:
+        raise FrameError("varint is too long")
+
+    if length > max_frame_size:
+        raise FrameError(f"frame of {length} bytes exceeds {max_frame_size} bytes")
+    return position + 1, position + 1 + length
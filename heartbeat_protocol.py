@@ -0,0 +1,204 @@
+import asyncio
+import logging
+import time
+
+from admission import peer_ip
+import framing
+
+log = logging.getLogger("__main__." + __name__)
+
+
+class HeartbeatProtocol(asyncio.BufferedProtocol):
+    """
+    This class serves the heartbeats of one client connection like Server.handle_client(), but on the low
+    level transport API instead of StreamReader and StreamWriter: the event loop reads straight into a
+    receive buffer of the connection, the frames are found in place with framing.find_frame() and decoded
+    from a memoryview of the buffer, so received data is never copied into new bytes objects. Heartbeats
+    are tens of bytes, so the buffer starts at initial_buffer_size; it grows when the length of a frame says
+    it does not fit, up to max_frame_size, and shrinks back once it is empty.
+    The acks of all frames of one read are written at once. With codec negotiation, the first byte of the
+    connection selects its codec, see codec_negotiation.py.
+
+    When the client does not read its acks and the transport's write buffer is full, reading from the
+    client is paused until the buffer drained. It is paused as well while the server's heartbeat writer is
+    full, see write_behind.HeartbeatWriteBehind.wait_for_room(), and while the source address of the
+    connection is over its rate limit, see admission.AdmissionControl.frame_delay().
+    """
+
+    def __init__(
+        self,
+        server,
+        max_frame_size: int = framing.MAX_FRAME_SIZE,
+        initial_buffer_size: int = 4096,
+    ):
+        self.server = server
+        self.max_frame_size = max_frame_size
+        # room for the largest frame and its length
+        self.max_buffer_size = max_frame_size + framing.MAX_VARINT_SIZE
+        self.initial_buffer_size = min(initial_buffer_size, self.max_buffer_size)
+        self.start = 0  # first byte of the next frame
+        self.end = 0  # end of the received data
+        # allocated once the connection is admitted, see connection_made()
+        self.buffer = None
+        self.view = None
+        self.transport = None
+        self.negotiating = server.codec_negotiation  # waiting for the codec byte
+        self.codec = None
+        self.writing_paused = False
+        self.waiting_for_room = (
+            None  # task resuming reading when the heartbeat writer has room
+        )
+        self.ip = None  # source address, when its frame rate is limited
+        self.throttled = None  # timer resuming reading when the next frame may be read
+        self.reserved = False  # the next frame has its token already
+
+    def connection_made(self, transport: asyncio.Transport) -> None:
+        log.debug("client connected")
+        self.transport = transport
+        if not self.server.admit_connection():
+            transport.close()
+            return
+        self.allocate(self.initial_buffer_size)
+        self.server.clients[self] = transport
+        if self.server.admission is not None:
+            self.ip = peer_ip(transport)
+
+    def connection_lost(self, exc) -> None:
+        log.debug("client disconnected")
+        self.server.clients.pop(self, None)
+        if self.waiting_for_room is not None:
+            self.waiting_for_room.cancel()
+        if self.throttled is not None:
+            self.throttled.cancel()
+
+    def get_buffer(self, sizehint: int) -> memoryview:
+        return self.view[self.end :]
+
+    def buffer_updated(self, nbytes: int) -> None:
+        self.end += nbytes
+        if self.negotiating:
+            self.codec = bytes(self.buffer[self.start : self.start + 1])
+            if self.codec not in self.server.codecs:
+                log.error("Unknown codec %r from client", self.codec)
+                self.transport.close()
+                return
+            self.start += 1
+            self.negotiating = False
+        acks = []
+        while True:
+            try:
+                frame = framing.find_frame(
+                    self.buffer, self.start, self.end, self.max_frame_size
+                )
+            except framing.FrameError as e:
+                log.error("Invalid frame from client %s", e)
+                self.transport.close()
+                return
+            if frame is None:
+                break
+            if self.throttled is not None:
+                break
+            if self.ip is not None and not self.reserved:
+                delay = self.server.admission.frame_delay(self.ip, time.monotonic())
+                if delay:
+                    # the frame is read once its token is there
+                    self.reserved = True
+                    self.throttle(delay)
+                    break
+            self.reserved = False
+            payload_start, payload_end = frame
+            acks.append(
+                framing.encode_frame(
+                    self.server.ingest_heartbeat(
+                        self.view[payload_start:payload_end], self.codec
+                    )
+                )
+            )
+            self.start = payload_end
+
+        if acks:
+            written = time.perf_counter()
+            self.transport.write(b"".join(acks))
+            self.server.metrics.heartbeat_ack_seconds.observe(
+                time.perf_counter() - written
+            )
+            heartbeat_writer = self.server.heartbeat_writer
+            if (
+                heartbeat_writer is not None
+                and heartbeat_writer.full
+                and self.waiting_for_room is None
+            ):
+                self.transport.pause_reading()
+                self.waiting_for_room = asyncio.ensure_future(
+                    self.resume_when_room(heartbeat_writer)
+                )
+
+        # move the beginning of an incomplete frame to the front, there is then room for the rest of it
+        if self.start == self.end:
+            self.start = self.end = 0
+            if len(self.buffer) > self.initial_buffer_size:
+                self.allocate(self.initial_buffer_size)
+            return
+        if self.start:
+            remaining = self.end - self.start
+            self.buffer[:remaining] = self.buffer[self.start : self.end]
+            self.start, self.end = 0, remaining
+        frame = framing.frame_bounds(self.buffer, 0, self.end, self.max_frame_size)
+        if frame is not None and frame[1] > len(self.buffer):
+            self.allocate(
+                min(max(frame[1], 2 * len(self.buffer)), self.max_buffer_size)
+            )
+
+    def allocate(self, size: int) -> None:
+        """
+        This method replaces the receive buffer with one of size bytes, the received data is kept.
+
+        :param size: the size of the new buffer.
+        """
+        buffer = bytearray(size)
+        if self.end:
+            buffer[: self.end] = self.buffer[: self.end]
+        self.buffer = buffer
+        self.view = memoryview(buffer)
+
+    def eof_received(self) -> bool:
+        # client closed the connection, close it too
+        return False
+
+    def reading_allowed(self) -> bool:
+        return (
+            not self.writing_paused
+            and self.waiting_for_room is None
+            and self.throttled is None
+        )
+
+    async def resume_when_room(self, heartbeat_writer) -> None:
+        await heartbeat_writer.wait_for_room()
+        self.waiting_for_room = None
+        if self.reading_allowed():
+            self.transport.resume_reading()
+
+    def throttle(self, delay: float) -> None:
+        self.server.metrics.heartbeat_frames_throttled.inc()
+        self.transport.pause_reading()
+        self.throttled = asyncio.get_event_loop().call_later(
+            delay, self.resume_throttled
+        )
+
+    def resume_throttled(self) -> None:
+        self.throttled = None
+        if self.transport.is_closing():
+            return
+        if self.reading_allowed():
+            self.transport.resume_reading()
+        # the frames received before reading was paused
+        self.buffer_updated(0)
+
+    def pause_writing(self) -> None:
+        self.writing_paused = True
+        self.transport.pause_reading()
+
+    def resume_writing(self) -> None:
+        self.writing_paused = False
+        if self.reading_allowed():
+            self.transport.resume_reading()
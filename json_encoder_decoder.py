@@ -1,19 +1,291 @@
+import json
 import logging
+import re
 
 from base_enc_dec import BaseEncoderDecoder
+import messages_pb2 as messages
+from records import HeartbeatRecord, StatusRecord
+
+try:
+    # optional, several times faster than the json module
+    import orjson
+except ImportError:
+    orjson = None
 
 log = logging.getLogger("__main__." + __name__)
 
+# the keys cannot appear unescaped inside a string value, so they are only found where they are keys
+IDENTIFIER_FIELD = re.compile(rb'"identifier"\s*:\s*(\d+)\s*[,}]')
+REQUEST_ID_FIELD = re.compile(rb'"request_id"\s*:\s*(\d+)\s*[,}]')
+REQUEST_ID_KEY = re.compile(rb'"request_id"')
+
+
+def dumps(obj) -> bytes:
+    if orjson is not None:
+        return orjson.dumps(obj)
+    return json.dumps(obj, separators=(",", ":")).encode("utf-8")
+
+
+def loads(binary_data):
+    if orjson is not None:
+        return orjson.loads(binary_data)
+    if isinstance(binary_data, memoryview):
+        binary_data = binary_data.tobytes()
+    return json.loads(binary_data)
+
+
+# the values of the fields missing from a decoded message, like protobuf
+HEARTBEAT_DEFAULTS = {
+    "type": messages.MESSAGE_TYPE_HEARTBEAT,
+    "msg": "",
+    "client_host": "",
+    "client_port": 0,
+    "identifier": 0,
+}
+STATUS_DEFAULTS = {
+    "type": messages.MESSAGE_TYPE_HEARTBEAT,
+    "message_count": 0,
+    "identifier": 0,
+}
+
+
+def text(value) -> str:
+    # like a protobuf string field
+    if not isinstance(value, str):
+        raise TypeError(f"{value!r} has type {type(value).__name__}, but expected str")
+    return value
+
+
+def uint32(value) -> int:
+    # like a protobuf uint32 field
+    value = int(value)
+    if not 0 <= value <= 0xFFFFFFFF:
+        raise ValueError(f"Value out of range: {value}")
+    return value
+
+
+def heartbeat_dict(msg_dict: dict) -> dict:
+    return {
+        "type": int(msg_dict.get("type")),
+        "msg": text(msg_dict.get("msg")),
+        "client_host": text(msg_dict.get("client_host")),
+        "client_port": uint32(msg_dict.get("client_port")),
+        "identifier": uint32(msg_dict.get("identifier")),
+        "request_id": uint32(msg_dict.get("request_id", 0)),
+    }
+
+
+def status_dict(msg_dict: dict) -> dict:
+    return {
+        "type": int(msg_dict.get("type")),
+        "message_count": uint32(msg_dict.get("message_count")),
+        "identifier": uint32(msg_dict.get("identifier")),
+        "request_id": uint32(msg_dict.get("request_id", 0)),
+    }
+
+
+def error_message(error: Exception) -> bytes:
+    return dumps({"type": messages.MESSAGE_TYPE_ERROR, "error": str(error)})
+
 
 class JsonEncoderDecoder(BaseEncoderDecoder):
-    def encode_heartbeat(self, msg_dict):
-        raise NotImplementedError("JSON encode_heartbeat will be implemented in future")
+    """
+    The messages of messages.proto as JSON objects with the same field names, one object per frame. The
+    type field is the number of the MessageType and every field is written, batches hold their messages in
+    a "heartbeats" or "statuses" array. orjson is used when it is installed, the json module otherwise.
+    """
+
+    def encode_heartbeat(self, msg_dict: dict) -> bytes:
+        """
+        Serialize a heartbeat message.
+        :param msg_dict: the data to serialize
+        :return: binary string format data.
+        """
+        try:
+            return dumps(heartbeat_dict(msg_dict))
+        except (TypeError, ValueError) as e:
+            log.error(f"encode_heartbeat exception happened")
+            return error_message(e)
+
+    def decode_heartbeat(self, binary_data) -> dict:
+        """
+        Deserialize binary data for a heartbeat message.
+        :param binary_data: the data to deserialize.
+        :return: a decoded dict format message.
+        """
+        deserialized = loads(binary_data)
+        if deserialized.get("type", 0) == messages.MESSAGE_TYPE_HEARTBEAT:
+            return heartbeat_dict({**HEARTBEAT_DEFAULTS, **deserialized})
+        else:
+            log.error(f"decode_heartbeat exception happened")
+            return {
+                "type": messages.MessageType.MESSAGE_TYPE_ERROR,
+                "msg": "incorrect decoder",
+            }
+
+    def encode_status(self, msg_dict: dict) -> bytes:
+        """
+        Serialize a status message.
+        :param msg_dict: the data to serialize
+        :return: binary string format data.
+        """
+        try:
+            return dumps(status_dict(msg_dict))
+        except (TypeError, ValueError) as e:
+            log.error(f"encode_status exception happened")
+            return error_message(e)
+
+    def decode_status(self, binary_data) -> dict:
+        """
+        Deserialize binary data for a status message.
+        :param binary_data: the data to deserialize.
+        :return: a decoded dict format message.
+        """
+        deserialized = loads(binary_data)
+        if deserialized.get("type", 0) == messages.MESSAGE_TYPE_STATUS:
+            return status_dict({**STATUS_DEFAULTS, **deserialized})
+        else:
+            log.error(f"decode_status exception happened")
+            return {
+                "type": messages.MessageType.MESSAGE_TYPE_ERROR,
+                "msg": "incorrect decoder",
+            }
+
+    def encode_heartbeat_batch(self, msg_dicts: list[dict]) -> bytes:
+        """
+        Serialize the heartbeat messages of many clients as one BatchHeartbeat message.
+        :param msg_dicts: the heartbeat messages to serialize, like for encode_heartbeat().
+        :return: binary string format data.
+        """
+        try:
+            return dumps(
+                {
+                    "type": messages.MESSAGE_TYPE_BATCH_HEARTBEAT,
+                    "heartbeats": [heartbeat_dict(msg_dict) for msg_dict in msg_dicts],
+                }
+            )
+        except (TypeError, ValueError) as e:
+            log.error(f"encode_heartbeat_batch exception happened")
+            return error_message(e)
+
+    def decode_heartbeat_batch(self, binary_data) -> list[dict]:
+        """
+        Deserialize binary data for a BatchHeartbeat message.
+        :param binary_data: the data to deserialize.
+        :return: the decoded heartbeat messages, an empty list if the data is not a BatchHeartbeat.
+        """
+        deserialized = loads(binary_data)
+        if deserialized.get("type", 0) == messages.MESSAGE_TYPE_BATCH_HEARTBEAT:
+            return [
+                heartbeat_dict({**HEARTBEAT_DEFAULTS, **heartbeat})
+                for heartbeat in deserialized.get("heartbeats", [])
+            ]
+        else:
+            log.error(f"decode_heartbeat_batch exception happened")
+            return []
+
+    def encode_status_batch(self, msg_dicts: list[dict]) -> bytes:
+        """
+        Serialize the status messages of many clients as one BatchStatus message.
+        :param msg_dicts: the status messages to serialize, like for encode_status().
+        :return: binary string format data.
+        """
+        try:
+            return dumps(
+                {
+                    "type": messages.MESSAGE_TYPE_BATCH_STATUS,
+                    "statuses": [status_dict(msg_dict) for msg_dict in msg_dicts],
+                }
+            )
+        except (TypeError, ValueError) as e:
+            log.error(f"encode_status_batch exception happened")
+            return error_message(e)
+
+    def decode_status_batch(self, binary_data) -> list[dict]:
+        """
+        Deserialize binary data for a BatchStatus message.
+        :param binary_data: the data to deserialize.
+        :return: the decoded status messages, an empty list if the data is not a BatchStatus.
+        """
+        deserialized = loads(binary_data)
+        if deserialized.get("type", 0) == messages.MESSAGE_TYPE_BATCH_STATUS:
+            return [
+                status_dict({**STATUS_DEFAULTS, **status})
+                for status in deserialized.get("statuses", [])
+            ]
+        else:
+            log.error(f"decode_status_batch exception happened")
+            return []
+
+    def decode_message_type(self, binary_data) -> int:
+        """
+        Read the type of a message.
+        :param binary_data: a serialized message of any type.
+        :return: the messages_pb2.MessageType of the message.
+        """
+        # the type is the first field written by encode_*(), look for it before parsing the whole message
+        start = bytes(binary_data[:16])
+        if start.startswith(b'{"type":'):
+            end = start.find(b",", 8)
+            if end != -1 and start[8:end].isdigit():
+                return int(start[8:end])
+        return loads(binary_data).get("type", 0)
+
+    def peek_heartbeat_identifier(self, binary_data) -> tuple:
+        """
+        Read the identifier and request_id of a heartbeat message without parsing it.
+        :param binary_data: a serialized heartbeat message, bytes or a memoryview.
+        :return: (identifier, request_id), None if they cannot be read this way.
+        """
+        identifiers = IDENTIFIER_FIELD.findall(binary_data)
+        if len(identifiers) != 1:
+            return None
+        request_ids = REQUEST_ID_FIELD.findall(binary_data)
+        if request_ids:
+            if len(request_ids) > 1:
+                return None
+            return int(identifiers[0]), int(request_ids[0])
+        if REQUEST_ID_KEY.search(binary_data):
+            # e.g. null
+            return None
+        return int(identifiers[0]), 0
+
+    def decode_heartbeat_record(self, binary_data) -> HeartbeatRecord:
+        """
+        Deserialize binary data for a heartbeat message.
+        :param binary_data: the data to deserialize, bytes or a memoryview.
+        :return: the decoded message, None if it is not a heartbeat message.
+        """
+        deserialized = loads(binary_data)
+        if deserialized.get("type", 0) != messages.MESSAGE_TYPE_HEARTBEAT:
+            log.error(f"decode_heartbeat_record exception happened")
+            return None
+        return HeartbeatRecord(**heartbeat_dict({**HEARTBEAT_DEFAULTS, **deserialized}))
 
-    def decode_heartbeat(self, binary_data):
-        raise NotImplementedError("JSON decode_heartbeat will be implemented in future")
+    def encode_heartbeat_record(self, record: HeartbeatRecord) -> bytes:
+        """
+        Serialize a heartbeat message.
+        :param record: the message to serialize.
+        :return: binary string format data.
+        """
+        return dumps(record._asdict())
 
-    def encode_status(self, msg_dict):
-        raise NotImplementedError("JSON encode_status will be implemented in future")
+    def decode_status_record(self, binary_data) -> StatusRecord:
+        """
+        Deserialize binary data for a status message.
+        :param binary_data: the data to deserialize, bytes or a memoryview.
+        :return: the decoded message, None if it is not a status message.
+        """
+        deserialized = loads(binary_data)
+        if deserialized.get("type", 0) != messages.MESSAGE_TYPE_STATUS:
+            log.error(f"decode_status_record exception happened")
+            return None
+        return StatusRecord(**status_dict({**STATUS_DEFAULTS, **deserialized}))
 
-    def decode_status(self, binary_data):
-        raise NotImplementedError("JSON decode_status will be implemented in future")
+    def encode_status_record(self, record: StatusRecord) -> bytes:
+        """
+        Serialize a status message.
+        :param record: the message to serialize.
+        :return: binary string format data.
+        """
+        return dumps(record._asdict())
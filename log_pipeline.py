@@ -0,0 +1,130 @@
+import logging
+import logging.handlers
+import os
+import queue
+
+LOG_FORMAT = "%(asctime)s %(levelname)s [%(module)s:%(lineno)d] %(message)s"
+LOG_MODES = ("queue", "sync")
+
+
+class NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """
+    This handler only puts records on a bounded queue, the handlers doing the actual I/O run in the thread
+    of a QueueListener. Unlike logging.handlers.QueueHandler it does not format the record before putting it
+    on the queue: message and arguments are formatted by the listener thread, so the arguments of a log call
+    should not be mutated afterwards. When the queue is full the record is dropped and counted instead of
+    blocking the caller.
+    """
+
+    def __init__(self, log_queue: queue.Queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    This filter lets through at most max_records records per interval_seconds for every call site
+    (source file and line), the others are suppressed. The first record let through after suppressed ones
+    mentions how many were suppressed. The decision is kept on the record, so one filter can be shared by
+    several handlers.
+    """
+
+    def __init__(self, max_records: int = 10, interval_seconds: float = 1.0):
+        super().__init__()
+        self.max_records = max_records
+        self.interval_seconds = interval_seconds
+        self.call_sites = (
+            {}
+        )  # (pathname, lineno) -> [window start, records, suppressed]
+
+    def filter(self, record: logging.LogRecord) -> bool:
+        passed = getattr(record, "rate_limit_passed", None)
+        if passed is None:
+            passed = record.rate_limit_passed = self._admit(record)
+        return passed
+
+    def _admit(self, record: logging.LogRecord) -> bool:
+        key = (record.pathname, record.lineno)
+        site = self.call_sites.get(key)
+        if site is None or record.created - site[0] >= self.interval_seconds:
+            suppressed = site[2] if site is not None else 0
+            self.call_sites[key] = [record.created, 1, 0]
+            if suppressed:
+                record.msg = f"{record.msg} ({suppressed} similar messages suppressed)"
+            return True
+        if site[1] < self.max_records:
+            site[1] += 1
+            return True
+        site[2] += 1
+        return False
+
+
+def setup_logging(
+    filename: str,
+    level: str = "INFO",
+    mode: str = "queue",
+    queue_size: int = 10000,
+    rate_limit: int = 10,
+    rate_limit_interval_seconds: float = 1.0,
+):
+    """
+    This function configures the root logger to write to a file and to the console, replacing its
+    handlers.
+
+    In "queue" mode the root logger only gets a NonBlockingQueueHandler, the file and console handlers run
+    in a background thread so that the event loop never waits on log I/O. In "sync" mode the handlers are
+    attached to the root logger directly. In both modes every call site is rate limited, see
+    RateLimitFilter; a rate_limit of 0 disables it.
+
+    :param filename: log file.
+    :param level: name of the log level, e.g. "INFO".
+    :param mode: "queue" or "sync".
+    :param queue_size: max number of records waiting to be written in "queue" mode.
+    :param rate_limit: max number of records per call site and interval.
+    :param rate_limit_interval_seconds: length of the rate limiting interval.
+    :return: the started QueueListener in "queue" mode, it has to be stopped on shutdown, None otherwise.
+    """
+    if mode not in LOG_MODES:
+        raise ValueError(f"Unknown log mode {mode}, expected one of {LOG_MODES}")
+
+    directory = os.path.dirname(filename)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    formatter = logging.Formatter(LOG_FORMAT)
+    handlers = [
+        logging.FileHandler(filename, encoding="utf-8"),
+        logging.StreamHandler(),
+    ]
+    for handler in handlers:
+        handler.setFormatter(formatter)
+
+    root = logging.getLogger()
+    root.setLevel(level)
+    # e.g. the handlers inherited by a forked worker process
+    for handler in root.handlers[:]:
+        root.removeHandler(handler)
+
+    listener = None
+    if mode == "queue":
+        queue_handler = NonBlockingQueueHandler(queue.Queue(queue_size))
+        listener = logging.handlers.QueueListener(
+            queue_handler.queue, *handlers, respect_handler_level=True
+        )
+        handlers = [queue_handler]
+        listener.start()
+
+    rate_limit_filter = RateLimitFilter(rate_limit, rate_limit_interval_seconds)
+    for handler in handlers:
+        if rate_limit:
+            handler.addFilter(rate_limit_filter)
+        root.addHandler(handler)
+    return listener
@@ -1,33 +1,96 @@
 import asyncio
+import functools
 import logging
+import socket
 
+from admission import AdmissionControl
+from cluster import ShardCluster
+from codec_negotiation import CODECS, make_encoder_decoder
 from db_operations import AsyncPgPostgresManager
-from encode_decode_executor import EncodeDecodeExecutor
-from protobuf_encode_decoder import ProtobufEncoderDecoder
+from log_pipeline import setup_logging
+from metrics import start_metrics_server
 
 from dotenv import load_dotenv
 import os
 
 from server import Server
+from workers import Supervisor
+from write_behind import HeartbeatWriteBehind
 
 load_dotenv()
 
 log = logging.getLogger()
 
 
-def main():
-    loop = asyncio.get_event_loop()
+def build_server(heartbeat_router=None) -> tuple:
+    """
+    Builds the server and its dependencies from the environment, see .env.
+
+    :param heartbeat_router: the worker's HeartbeatRouter with several worker processes.
+    :return: (server, cluster, metrics_host, metrics_port), cluster is None unless CLUSTER_ENABLED and
+    metrics_port is 0 when the metrics are disabled.
+    """
     db_host = os.getenv("DB_HOST", "0.0.0.0")
     db_user = os.getenv("POSTGRES_USER", "devuser")
     password = os.getenv("POSTGRES_PASSWORD", "devpwd")
     db_name = os.getenv("POSTGRES_DB", "devdb")
     db_port = int(os.getenv("DB_PORT", 5432))
+    db_pool_min_size = int(os.getenv("DB_POOL_MIN_SIZE", 2))
+    db_pool_max_size = int(os.getenv("DB_POOL_MAX_SIZE", 10))
+    db_client_cache = os.getenv("DB_CLIENT_CACHE", "true").lower() == "true"
     query_seconds_interval_lower = int(
         os.getenv("QUERY_CLIENTS_INTERVAL_SECONDS_LOWER", 10)
     )
     query_seconds_interval_upper = int(
         os.getenv("QUERY_CLIENTS_INTERVAL_SECONDS_UPPER", 30)
     )
+    sweep_concurrency = int(os.getenv("SWEEP_CONCURRENCY", 100))
+    poll_tick_seconds = float(os.getenv("POLL_TICK_SECONDS", 0.1))
+    max_poll_interval_seconds = float(os.getenv("MAX_POLL_INTERVAL_SECONDS", 300))
+    poll_backoff_factor = float(os.getenv("POLL_BACKOFF_FACTOR", 2))
+    client_timeout_seconds = float(os.getenv("CLIENT_TIMEOUT_SECONDS", 5))
+    sweep_timeout_seconds = float(os.getenv("SWEEP_TIMEOUT_SECONDS", 60))
+    client_pool_max_connections = int(os.getenv("CLIENT_POOL_MAX_CONNECTIONS", 1000))
+    client_pool_idle_timeout_seconds = float(
+        os.getenv("CLIENT_POOL_IDLE_TIMEOUT_SECONDS", 120)
+    )
+    pipeline_status_requests = (
+        os.getenv("PIPELINE_STATUS_REQUESTS", "false").lower() == "true"
+    )
+    batch_status_requests = (
+        os.getenv("BATCH_STATUS_REQUESTS", "false").lower() == "true"
+    )
+    server_transport = os.getenv("SERVER_TRANSPORT", "stream")
+    message_cache_size = int(os.getenv("MESSAGE_CACHE_SIZE", 100000))
+    codec = os.getenv("CODEC", "protobuf")
+    codec_negotiation = os.getenv("CODEC_NEGOTIATION", "false").lower() == "true"
+    heartbeat_write_behind = (
+        os.getenv("HEARTBEAT_WRITE_BEHIND", "true").lower() == "true"
+    )
+    heartbeat_write_batch_size = int(os.getenv("HEARTBEAT_WRITE_BATCH_SIZE", 1000))
+    heartbeat_write_interval_seconds = float(
+        os.getenv("HEARTBEAT_WRITE_INTERVAL_SECONDS", 1)
+    )
+    heartbeat_write_max_pending = int(os.getenv("HEARTBEAT_WRITE_MAX_PENDING", 100000))
+    snapshot_path = os.getenv("REGISTRY_SNAPSHOT_PATH")
+    snapshot_interval_seconds = float(
+        os.getenv("REGISTRY_SNAPSHOT_INTERVAL_SECONDS", 60)
+    )
+    max_connections = int(os.getenv("MAX_CONNECTIONS", 0))
+    accept_rate = float(os.getenv("ACCEPT_RATE", 0))
+    accept_burst = float(os.getenv("ACCEPT_BURST", 1000))
+    ip_heartbeat_rate = float(os.getenv("IP_HEARTBEAT_RATE", 0))
+    ip_heartbeat_burst = float(os.getenv("IP_HEARTBEAT_BURST", 1000))
+    client_heartbeat_rate = float(os.getenv("CLIENT_HEARTBEAT_RATE", 0))
+    client_heartbeat_burst = float(os.getenv("CLIENT_HEARTBEAT_BURST", 20))
+    status_history = os.getenv("STATUS_HISTORY", "true").lower() == "true"
+    status_history_retention_days = int(os.getenv("STATUS_HISTORY_RETENTION_DAYS", 7))
+    status_history_minute_retention_days = int(
+        os.getenv("STATUS_HISTORY_MINUTE_RETENTION_DAYS", 30)
+    )
+    status_history_hour_retention_days = int(
+        os.getenv("STATUS_HISTORY_HOUR_RETENTION_DAYS", 365)
+    )
 
     db_op_manager = AsyncPgPostgresManager(
         user=db_user,
@@ -35,11 +98,64 @@ def main():
         database_name=db_name,
         db_host=db_host,
         db_port=db_port,
+        min_pool_size=db_pool_min_size,
+        max_pool_size=db_pool_max_size,
+        cache_clients=db_client_cache,
+        history_retention_days=status_history_retention_days,
+        minute_rollup_retention_days=status_history_minute_retention_days,
+        hour_rollup_retention_days=status_history_hour_retention_days,
     )
     server_ip = os.getenv("SERVER_IP", "0.0.0.0")
     server_port = int(os.getenv("SERVER_PORT", 4000))
+    metrics_host = os.getenv("METRICS_HOST", "127.0.0.1")
+    metrics_port = int(os.getenv("METRICS_PORT", 4001))
+    cluster_enabled = os.getenv("CLUSTER_ENABLED", "false").lower() == "true"
+    cluster_node_id = os.getenv("CLUSTER_NODE_ID") or socket.gethostname()
+    cluster_shards = int(os.getenv("CLUSTER_SHARDS", 256))
+    cluster_lease_seconds = float(os.getenv("CLUSTER_LEASE_SECONDS", 15))
 
-    encoder_decoder = EncodeDecodeExecutor(ProtobufEncoderDecoder())
+    worker_index = 0
+    if heartbeat_router is not None:
+        worker_index = heartbeat_router.worker_index
+    reuse_port = heartbeat_router is not None
+    if snapshot_path and heartbeat_router is not None:
+        # one snapshot per worker
+        snapshot_path = f"{snapshot_path}.{worker_index}"
+    cluster = None
+    if cluster_enabled:
+        # the workers of a node are nodes of the cluster too
+        cluster = ShardCluster(
+            db_op_manager,
+            node_id=f"{cluster_node_id}-{os.getpid()}",
+            shard_count=cluster_shards,
+            lease_seconds=cluster_lease_seconds,
+        )
+        heartbeat_router = cluster
+
+    encoder_decoder = make_encoder_decoder(codec)
+    negotiated_codecs = None
+    if codec_negotiation:
+        negotiated_codecs = {
+            codec_byte: encoder_decoder if name == codec else make_encoder_decoder(name)
+            for name, codec_byte in CODECS.items()
+        }
+    heartbeat_writer = None
+    if heartbeat_write_behind:
+        heartbeat_writer = HeartbeatWriteBehind(
+            db_op_manager,
+            batch_size=heartbeat_write_batch_size,
+            flush_interval_seconds=heartbeat_write_interval_seconds,
+            max_pending=heartbeat_write_max_pending,
+        )
+    admission = AdmissionControl(
+        max_connections=max_connections,
+        accept_rate=accept_rate,
+        accept_burst=accept_burst,
+        ip_rate=ip_heartbeat_rate,
+        ip_burst=ip_heartbeat_burst,
+        client_rate=client_heartbeat_rate,
+        client_burst=client_heartbeat_burst,
+    )
     server = Server(
         encoder_decoder=encoder_decoder,
         db_op_manager=db_op_manager,
@@ -47,34 +163,125 @@ def main():
         query_seconds_interval_upper=query_seconds_interval_upper,
         server_ip=server_ip,
         server_port=server_port,
+        sweep_concurrency=sweep_concurrency,
+        client_timeout_seconds=client_timeout_seconds,
+        sweep_timeout_seconds=sweep_timeout_seconds,
+        client_pool_max_connections=client_pool_max_connections,
+        client_pool_idle_timeout_seconds=client_pool_idle_timeout_seconds,
+        pipeline_status_requests=pipeline_status_requests,
+        batch_status_requests=batch_status_requests,
+        transport=server_transport,
+        message_cache_size=message_cache_size,
+        negotiated_codecs=negotiated_codecs,
+        heartbeat_writer=heartbeat_writer,
+        snapshot_path=snapshot_path,
+        snapshot_interval_seconds=snapshot_interval_seconds,
+        status_history=status_history,
+        admission=admission,
+        reuse_port=reuse_port,
+        heartbeat_router=heartbeat_router,
+        poll_tick_seconds=poll_tick_seconds,
+        max_poll_interval_seconds=max_poll_interval_seconds,
+        poll_backoff_factor=poll_backoff_factor,
     )
+    if metrics_port:
+        # one metrics port per worker
+        metrics_port += worker_index
+    return server, cluster, metrics_host, metrics_port
 
-    log.info(f"server ip is {server_ip} port is {server_port}")
+
+def serve(heartbeat_router=None):
+    """
+    Runs the server until it is interrupted. With several worker processes, this runs in every worker
+    with the worker's HeartbeatRouter. In cluster mode every server process is a node of the cluster.
+    """
+    loop = asyncio.get_event_loop()
+    server, cluster, metrics_host, metrics_port = build_server(heartbeat_router)
+    db_op_manager = server.db_op_manager
+    heartbeat_writer = server.heartbeat_writer
+
+    log.info("server ip is %s port is %s", server.server_ip, server.server_port)
+
+    # the clients known before the restart, reconciled with the database by the first refresh
+    server.load_snapshot()
+
+    # create the schema and open the database connection pool before anything queries it
+    loop.run_until_complete(db_op_manager.start())
+    if cluster is not None:
+        # claim the shards before the first sweep
+        loop.run_until_complete(cluster.refresh())
 
     # start Async server to handle client requests.
     f1 = server.start_server()
     f2 = asyncio.ensure_future(server.send_status_request_to_clients())
 
-    loop.run_until_complete(db_op_manager.query_saved_clients_from_db())
-
     loop.run_until_complete(f1)
-    loop.run_until_complete(f2)
-    loop.run_forever()
+    # serve the metrics to a local Prometheus scraper, port 0 disables it
+    if metrics_port:
+        loop.run_until_complete(
+            start_metrics_server(server.metrics, metrics_host, metrics_port)
+        )
+    try:
+        loop.run_until_complete(f2)
+        loop.run_forever()
+    finally:
+        server.client_connections.close()
+        if heartbeat_writer is not None:
+            # save the heartbeats received since the last flush
+            loop.run_until_complete(heartbeat_writer.close())
+        # and the status requests
+        loop.run_until_complete(server.flush_status_history())
+        if server.snapshot_path:
+            loop.run_until_complete(server.save_snapshot())
+        if cluster is not None:
+            loop.run_until_complete(cluster.leave())
+        loop.run_until_complete(db_op_manager.close())
 
 
-if __name__ == "__main__":
-    logging.basicConfig(
-        filename="log/server.log", encoding="utf-8", level=logging.DEBUG
-    )
-    formatter = logging.Formatter(
-        "%(asctime)s %(levelname)s " + "[%(module)s:%(lineno)d] %(message)s"
-    )
+def run_worker(heartbeat_router, log_config: dict) -> None:
+    # the forked worker writes its own logs, the supervisor's log thread is not running in it
+    log_listener = setup_logging(**log_config)
+    try:
+        serve(heartbeat_router)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        if log_listener:
+            log_listener.stop()
+
 
-    # setup console logging
-    log.setLevel(logging.DEBUG)
-    ch = logging.StreamHandler()
-    ch.setLevel(logging.DEBUG)
+def main(log_config: dict):
+    # SERVER_WORKERS > 1 forks that many servers sharing SERVER_PORT with SO_REUSEPORT
+    server_workers = int(os.getenv("SERVER_WORKERS", 1))
+    if server_workers > 1:
+        worker_restart_delay_seconds = float(
+            os.getenv("WORKER_RESTART_DELAY_SECONDS", 1)
+        )
+        supervisor = Supervisor(
+            server_workers,
+            functools.partial(run_worker, log_config=log_config),
+            restart_delay_seconds=worker_restart_delay_seconds,
+        )
+        supervisor.run()
+    else:
+        serve()
 
-    ch.setFormatter(formatter)
-    log.addHandler(ch)
-    main()
+
+if __name__ == "__main__":
+    # setup file and console logging, written from a background thread in "queue" mode
+    log_config = dict(
+        filename=os.getenv("LOG_FILE", "log/server.log"),
+        level=os.getenv("LOG_LEVEL", "INFO"),
+        mode=os.getenv("LOG_MODE", "queue"),
+        queue_size=int(os.getenv("LOG_QUEUE_SIZE", 10000)),
+        rate_limit=int(os.getenv("LOG_RATE_LIMIT", 10)),
+        rate_limit_interval_seconds=float(
+            os.getenv("LOG_RATE_LIMIT_INTERVAL_SECONDS", 1)
+        ),
+    )
+    log_listener = setup_logging(**log_config)
+    try:
+        main(log_config)
+    finally:
+        if log_listener:
+            log_listener.stop()
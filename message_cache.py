@@ -0,0 +1,96 @@
+from collections import OrderedDict
+
+import messages_pb2 as messages
+from records import HeartbeatRecord, StatusRecord
+
+
+class MessageCache:
+    """
+    This class keeps the serialized acks and status requests of every client identifier. They hardly
+    change from one heartbeat or poll to the next, so a message is only encoded again when its host, port,
+    count or request_id differ from the cached one; otherwise sending it costs a dictionary lookup.
+
+    At most max_entries identifiers are kept per kind of message, about 300 bytes each, and the least
+    recently used one is dropped for a new one when it is full. Every client is polled in turn, so with
+    more clients than max_entries the status requests are always encoded again: max_entries should be
+    above the number of clients when the memory allows it.
+    """
+
+    def __init__(self, encoder_decoder, max_entries: int = 100000):
+        self.encoder_decoder = encoder_decoder
+        self.max_entries = max_entries
+        # identifier -> ((host, port, request_id), serialized ack), least recently used first
+        self.acks = OrderedDict()
+        # identifier -> ((count, request_id), serialized request), least recently used first
+        self.status_requests = OrderedDict()
+
+    def ack(self, identifier: int, host: str, port: int, request_id: int = 0) -> bytes:
+        """
+        :param identifier: client identifier.
+        :param host: client's host address.
+        :param port: client's port number
+        :param request_id: request_id of the acked message.
+        :return: the serialized ack of a heartbeat or status reply.
+        """
+        key = (host, port, request_id)
+        entry = self.acks.get(identifier)
+        if entry is not None and entry[0] == key:
+            self.acks.move_to_end(identifier)
+            return entry[1]
+        data = self.encoder_decoder.encode_heartbeat_record(
+            HeartbeatRecord(
+                messages.MESSAGE_TYPE_HEARTBEAT,
+                "ack",
+                host,
+                port,
+                identifier,
+                request_id,
+            )
+        )
+        if self.max_entries:
+            if identifier in self.acks:
+                self.acks.move_to_end(identifier)
+            elif len(self.acks) >= self.max_entries:
+                self.acks.popitem(last=False)
+            self.acks[identifier] = (key, data)
+        return data
+
+    def cached_ack(self, identifier: int, request_id: int = 0) -> bytes:
+        """
+        :param identifier: client identifier.
+        :param request_id: request_id of the acked message.
+        :return: the last ack sent to the client if it has the same request_id, whatever its address, None
+        if there is none.
+        """
+        entry = self.acks.get(identifier)
+        if entry is None or entry[0][2] != request_id:
+            return None
+        self.acks.move_to_end(identifier)
+        return entry[1]
+
+    def status_request(
+        self, identifier: int, message_count: int, request_id: int = 0
+    ) -> bytes:
+        """
+        :param identifier: client identifier.
+        :param message_count: the client's status count.
+        :param request_id: request_id of the request.
+        :return: the serialized status request.
+        """
+        key = (message_count, request_id)
+        entry = self.status_requests.get(identifier)
+        if entry is not None and entry[0] == key:
+            self.status_requests.move_to_end(identifier)
+            return entry[1]
+        data = self.encoder_decoder.encode_status_record(
+            StatusRecord(
+                messages.MESSAGE_TYPE_STATUS, message_count, identifier, request_id
+            )
+        )
+        if self.max_entries:
+            if identifier in self.status_requests:
+                self.status_requests.move_to_end(identifier)
+            elif len(self.status_requests) >= self.max_entries:
+                self.status_requests.popitem(last=False)
+            self.status_requests[identifier] = (key, data)
+        return data
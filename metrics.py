@@ -0,0 +1,211 @@
+import asyncio
+import logging
+import math
+import time
+from bisect import bisect_left
+
+log = logging.getLogger("__main__." + __name__)
+
+# seconds, from sub-millisecond encode/decode times to multi-second sweeps
+DEFAULT_BUCKETS = (
+    0.0001,
+    0.00025,
+    0.0005,
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+)
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+
+def format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    if isinstance(value, int) or float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+class Counter:
+    """
+    A value which only goes up, e.g. a number of messages.
+    """
+
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str):
+        self.name = name
+        self.documentation = documentation
+        self.value = 0
+
+    def inc(self, amount: float = 1) -> None:
+        self.value += amount
+
+    def samples(self) -> list[tuple]:
+        return [(self.name, "", self.value)]
+
+
+class Gauge:
+    """
+    A value which goes up and down. With a callback the value is only computed when the metrics are
+    collected, e.g. the size of a collection, so that keeping it up to date costs nothing.
+    """
+
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str, callback=None):
+        self.name = name
+        self.documentation = documentation
+        self.callback = callback
+        self.value = 0
+
+    def set(self, value: float) -> None:
+        self.value = value
+
+    def samples(self) -> list[tuple]:
+        value = self.callback() if self.callback is not None else self.value
+        return [(self.name, "", value)]
+
+
+class Histogram:
+    """
+    Distribution of observed values, e.g. latencies in seconds, in fixed buckets. Observing a value is a
+    binary search and an increment; the cumulative bucket counts are only computed when collected.
+    """
+
+    type = "histogram"
+
+    def __init__(self, name: str, documentation: str, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(sorted(buckets))
+        self.counts = [0] * (len(self.buckets) + 1)  # the last one is +Inf
+        self.sum = 0.0
+
+    def observe(self, value: float) -> None:
+        # a bucket counts the values lower or equal to its bound
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+    def time(self) -> "Timer":
+        """
+        :return: a context manager observing the time spent in its block.
+        """
+        return Timer(self)
+
+    def samples(self) -> list[tuple]:
+        samples = []
+        cumulative = 0
+        for bound, count in zip((*self.buckets, math.inf), self.counts):
+            cumulative += count
+            samples.append(
+                (f"{self.name}_bucket", f'{{le="{format_value(bound)}"}}', cumulative)
+            )
+        samples.append((f"{self.name}_sum", "", self.sum))
+        samples.append((f"{self.name}_count", "", cumulative))
+        return samples
+
+
+class Timer:
+    def __init__(self, histogram: Histogram):
+        self.histogram = histogram
+        self.start = 0.0
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.histogram.observe(time.perf_counter() - self.start)
+
+
+class MetricsRegistry:
+    """
+    This class holds the metrics of a process and renders them in the Prometheus text exposition format.
+    """
+
+    def __init__(self):
+        self.metrics = {}  # name -> metric
+
+    def register(self, metric):
+        if metric.name in self.metrics:
+            raise ValueError(f"Metric {metric.name} is already registered")
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str) -> Counter:
+        return self.register(Counter(name, documentation))
+
+    def gauge(self, name: str, documentation: str, callback=None) -> Gauge:
+        return self.register(Gauge(name, documentation, callback))
+
+    def histogram(
+        self, name: str, documentation: str, buckets=DEFAULT_BUCKETS
+    ) -> Histogram:
+        return self.register(Histogram(name, documentation, buckets))
+
+    def expose(self) -> str:
+        """
+        :return: all metrics in the Prometheus text exposition format.
+        """
+        lines = []
+        for metric in self.metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.documentation}")
+            lines.append(f"# TYPE {metric.name} {metric.type}")
+            for name, labels, value in metric.samples():
+                lines.append(f"{name}{labels} {format_value(value)}")
+        return "\n".join(lines) + "\n"
+
+
+async def start_metrics_server(
+    metrics: MetricsRegistry, host: str, port: int
+) -> asyncio.AbstractServer:
+    """
+    This function serves the metrics over HTTP: any GET request is answered with metrics.expose(). Nothing
+    is computed between two scrapes.
+
+    :param metrics: the metrics to serve.
+    :param host: address to listen on, e.g. 127.0.0.1 to only serve local scrapers.
+    :param port: port to listen on.
+    :return: the asyncio server.
+    """
+
+    async def handle_scrape(
+        reader: asyncio.StreamReader, writer: asyncio.StreamWriter
+    ) -> None:
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), timeout=5)
+            # skip the headers
+            while (await asyncio.wait_for(reader.readline(), timeout=5)).strip():
+                pass
+            if request_line.split(b" ", 1)[0] == b"GET":
+                status, content_type = "200 OK", CONTENT_TYPE
+                body = metrics.expose().encode("utf-8")
+            else:
+                status, content_type = "405 Method Not Allowed", "text/plain"
+                body = b""
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: {content_type}\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode()
+                + body
+            )
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError) as e:
+            log.debug("Metrics scrape failed %r", e)
+        finally:
+            writer.close()
+
+    log.info("Serving metrics on %s:%s", host, port)
+    return await asyncio.start_server(handle_scrape, host, port)
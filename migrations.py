@@ -0,0 +1,162 @@
+import logging
+
+import asyncpg
+
+log = logging.getLogger("__main__." + __name__)
+
+# taken for the duration of the migration transaction, so that servers starting together migrate one by one
+MIGRATION_LOCK_ID = 0x636C69656E74  # "client"
+
+CREATE_SCHEMA_MIGRATIONS = """
+   CREATE TABLE IF NOT EXISTS schema_migrations (
+     version INTEGER PRIMARY KEY,
+     description TEXT NOT NULL,
+     applied_at TIMESTAMPTZ NOT NULL DEFAULT NOW()
+   )
+"""
+
+# (version, description, statements), in order. A migration is never changed once released: changes of the
+# schema are made by appending a new one. Deployments which predate the migrations have the table of
+# version 1 and are upgraded from there like new ones.
+MIGRATIONS = [
+    (
+        1,
+        "client_record table",
+        """
+        CREATE TABLE IF NOT EXISTS client_record (
+          client_identifier INTEGER NOT NULL,
+          status_count INTEGER,
+          is_connected BOOLEAN NOT NULL,
+          PRIMARY KEY (client_identifier , is_connected),
+          client_host  CHAR(200) NOT NULL,
+          client_port INTEGER NOT NULL,
+          connection_time  TIMESTAMP NOT NULL DEFAULT NOW()
+        )
+        """,
+    ),
+    (
+        2,
+        "client_record keyed by identifier, unpadded hosts, last_seen, index of the connected clients",
+        """
+        -- the client_record_changes triggers refer to the columns changed here, they are created again by
+        -- AsyncPgPostgresManager.start()
+        DROP TRIGGER IF EXISTS client_record_notify ON client_record;
+        DROP TRIGGER IF EXISTS client_record_notify_update ON client_record;
+        DROP TRIGGER IF EXISTS client_record_notify_truncate ON client_record;
+
+        -- one row per client, the connected one wins
+        DELETE FROM client_record disconnected USING client_record connected
+        WHERE disconnected.client_identifier = connected.client_identifier
+          AND connected.is_connected AND NOT disconnected.is_connected;
+        ALTER TABLE client_record DROP CONSTRAINT client_record_pkey;
+        ALTER TABLE client_record ADD PRIMARY KEY (client_identifier);
+
+        ALTER TABLE client_record ALTER COLUMN client_host TYPE VARCHAR(255) USING rtrim(client_host);
+        UPDATE client_record SET status_count = 0 WHERE status_count IS NULL;
+        ALTER TABLE client_record
+          ALTER COLUMN status_count SET DEFAULT 0,
+          ALTER COLUMN status_count SET NOT NULL,
+          ALTER COLUMN is_connected SET DEFAULT TRUE;
+        ALTER TABLE client_record RENAME COLUMN connection_time TO last_seen;
+        ALTER TABLE client_record ALTER COLUMN last_seen TYPE TIMESTAMPTZ;
+
+        CREATE INDEX client_record_connected ON client_record (client_identifier) WHERE is_connected;
+        """,
+    ),
+    (
+        3,
+        "client_status_history partitioned by day, per minute and per hour rollups",
+        """
+        -- one row per status request, the daily partitions are created and dropped by
+        -- AsyncPgPostgresManager.maintain_status_history()
+        CREATE TABLE client_status_history (
+          client_identifier INTEGER NOT NULL,
+          recorded_at TIMESTAMPTZ NOT NULL,
+          connected BOOLEAN NOT NULL,
+          status_count INTEGER NOT NULL,
+          previous_count INTEGER NOT NULL
+        ) PARTITION BY RANGE (recorded_at);
+        CREATE INDEX client_status_history_client ON client_status_history (client_identifier, recorded_at);
+
+        CREATE TABLE client_status_minute (
+          client_identifier INTEGER NOT NULL,
+          bucket TIMESTAMPTZ NOT NULL,
+          samples INTEGER NOT NULL,
+          failures INTEGER NOT NULL,
+          mismatches INTEGER NOT NULL,
+          min_count INTEGER,
+          max_count INTEGER,
+          PRIMARY KEY (client_identifier, bucket)
+        );
+        CREATE INDEX client_status_minute_bucket ON client_status_minute (bucket);
+        CREATE TABLE client_status_hour (LIKE client_status_minute INCLUDING ALL);
+        """,
+    ),
+    (
+        4,
+        "BIGINT identifiers, ports and status counts, which are uint32 on the wire",
+        """
+        -- the client_record_changes triggers refer to the columns changed here, they are created again by
+        -- AsyncPgPostgresManager.start()
+        DROP TRIGGER IF EXISTS client_record_notify ON client_record;
+        DROP TRIGGER IF EXISTS client_record_notify_update ON client_record;
+        DROP TRIGGER IF EXISTS client_record_notify_truncate ON client_record;
+
+        ALTER TABLE client_record
+          ALTER COLUMN client_identifier TYPE BIGINT,
+          ALTER COLUMN client_port TYPE BIGINT,
+          ALTER COLUMN status_count TYPE BIGINT;
+        ALTER TABLE client_status_history
+          ALTER COLUMN client_identifier TYPE BIGINT,
+          ALTER COLUMN status_count TYPE BIGINT,
+          ALTER COLUMN previous_count TYPE BIGINT;
+        ALTER TABLE client_status_minute
+          ALTER COLUMN client_identifier TYPE BIGINT,
+          ALTER COLUMN min_count TYPE BIGINT,
+          ALTER COLUMN max_count TYPE BIGINT;
+        ALTER TABLE client_status_hour
+          ALTER COLUMN client_identifier TYPE BIGINT,
+          ALTER COLUMN min_count TYPE BIGINT,
+          ALTER COLUMN max_count TYPE BIGINT;
+        """,
+    ),
+]
+
+
+async def migrate(conn: asyncpg.Connection, setup: str = None) -> int:
+    """
+    This function brings the database schema to the latest version: the migrations which are not recorded in
+    the schema_migrations table are applied in order, in one transaction with the migration lock held, so a
+    failed migration leaves the schema unchanged.
+
+    :param conn: a connection to the database.
+    :param setup: statements run after the migrations in the same transaction, for the optional objects
+    which are created again by every server using them.
+    :return: the schema version.
+    """
+    async with conn.transaction():
+        await conn.execute("SELECT pg_advisory_xact_lock($1)", MIGRATION_LOCK_ID)
+        await conn.execute(CREATE_SCHEMA_MIGRATIONS)
+        applied = {
+            row["version"]
+            for row in await conn.fetch("SELECT version FROM schema_migrations")
+        }
+        for version, description, statements in MIGRATIONS:
+            if version in applied:
+                continue
+            log.info("Applying schema migration %d: %s", version, description)
+            await conn.execute(statements)
+            await conn.execute(
+                "INSERT INTO schema_migrations(version, description) VALUES($1, $2)",
+                version,
+                description,
+            )
+        if setup:
+            await conn.execute(setup)
+    latest = MIGRATIONS[-1][0]
+    if applied and max(applied) > latest:
+        log.warning(
+            "The database schema version %d is newer than %d", max(applied), latest
+        )
+        return max(applied)
+    return latest
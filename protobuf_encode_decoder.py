@@ -2,10 +2,54 @@ import logging
 
 from base_enc_dec import BaseEncoderDecoder
 import messages_pb2 as messages
+from records import HeartbeatRecord, StatusRecord
 
 log = logging.getLogger("__main__." + __name__)
 
 
+def fill_heartbeat(proto_message, msg_dict: dict) -> None:
+    proto_message.type = msg_dict.get("type")
+    proto_message.msg = msg_dict.get("msg")
+    proto_message.client_host = msg_dict.get("client_host")
+    proto_message.identifier = int(msg_dict.get("identifier"))
+    proto_message.client_port = int(msg_dict.get("client_port"))
+    proto_message.request_id = int(msg_dict.get("request_id", 0))
+
+
+def heartbeat_dict(proto_message) -> dict:
+    return {
+        "type": proto_message.type,
+        "msg": proto_message.msg,
+        "client_host": proto_message.client_host,
+        "identifier": proto_message.identifier,
+        "client_port": proto_message.client_port,
+        "request_id": proto_message.request_id,
+    }
+
+
+def fill_status(proto_message, msg_dict: dict) -> None:
+    proto_message.type = msg_dict.get("type")
+    proto_message.identifier = int(msg_dict.get("identifier"))
+    proto_message.message_count = int(msg_dict.get("message_count"))
+    proto_message.request_id = int(msg_dict.get("request_id", 0))
+
+
+def status_dict(proto_message) -> dict:
+    return {
+        "type": proto_message.type,
+        "message_count": proto_message.message_count,
+        "identifier": proto_message.identifier,
+        "request_id": proto_message.request_id,
+    }
+
+
+def error_message(error: Exception) -> bytes:
+    proto_message = messages.ErrorMessage()
+    proto_message.type = messages.MessageType.MESSAGE_TYPE_ERROR
+    proto_message.error = str(error)
+    return proto_message.SerializeToString()  # serialize
+
+
 class ProtobufEncoderDecoder(BaseEncoderDecoder):
     def encode_heartbeat(self, msg_dict: dict) -> bytes:
         """
@@ -15,18 +59,11 @@ class ProtobufEncoderDecoder(BaseEncoderDecoder):
         """
         try:
             proto_message = messages.HeartBeatMessage()
-            proto_message.type = msg_dict.get("type")
-            proto_message.msg = msg_dict.get("msg")
-            proto_message.client_host = msg_dict.get("client_host")
-            proto_message.identifier = int(msg_dict.get("identifier"))
-            proto_message.client_port = int(msg_dict.get("client_port"))
+            fill_heartbeat(proto_message, msg_dict)
             return proto_message.SerializeToString()  # serialize
         except TypeError as e:
             log.error(f"encode_heartbeat exception happened")
-            proto_message = messages.ErrorMessage()
-            proto_message.type = messages.MessageType.MESSAGE_TYPE_ERROR
-            proto_message.error = str(e)
-            return proto_message.SerializeToString()  # serialize
+            return error_message(e)
 
     def decode_heartbeat(self, binary_data):
         """
@@ -39,13 +76,7 @@ class ProtobufEncoderDecoder(BaseEncoderDecoder):
             binary_data
         )  # deserialize, input will be bytes
         if deserialized.type == messages.MessageType.MESSAGE_TYPE_HEARTBEAT:
-            return {
-                "type": deserialized.type,
-                "msg": deserialized.msg,
-                "client_host": deserialized.client_host,
-                "identifier": deserialized.identifier,
-                "client_port": deserialized.client_port,
-            }
+            return heartbeat_dict(deserialized)
         else:
             log.error(f"decode_heartbeat exception happened")
             return {
@@ -61,16 +92,11 @@ class ProtobufEncoderDecoder(BaseEncoderDecoder):
         """
         try:
             proto_message = messages.StatusMessage()
-            proto_message.type = msg_dict.get("type")
-            proto_message.identifier = int(msg_dict.get("identifier"))
-            proto_message.message_count = int(msg_dict.get("message_count"))
+            fill_status(proto_message, msg_dict)
             return proto_message.SerializeToString()  # serialize
         except TypeError as e:
             log.error(f"encode_status exception happened")
-            proto_message = messages.ErrorMessage()
-            proto_message.type = messages.MessageType.MESSAGE_TYPE_ERROR
-            proto_message.error = str(e)
-            return proto_message.SerializeToString()  # serialize
+            return error_message(e)
 
     def decode_status(self, binary_data: bytes) -> dict:
         """
@@ -83,14 +109,184 @@ class ProtobufEncoderDecoder(BaseEncoderDecoder):
             binary_data
         )  # deserialize, input will be bytes
         if deserialized.type == messages.MessageType.MESSAGE_TYPE_STATUS:
-            return {
-                "type": deserialized.type,
-                "message_count": deserialized.message_count,
-                "identifier": deserialized.identifier,
-            }
+            return status_dict(deserialized)
         else:
             log.error(f"decode_status exception happened")
             return {
                 "type": messages.MessageType.MESSAGE_TYPE_ERROR,
                 "msg": "incorrect decoder",
             }
+
+    def encode_heartbeat_batch(self, msg_dicts: list[dict]) -> bytes:
+        """
+        Serialize the heartbeat messages of many clients as one BatchHeartbeat message.
+        :param msg_dicts: the heartbeat messages to serialize, like for encode_heartbeat().
+        :return: binary string format data.
+        """
+        try:
+            proto_message = messages.BatchHeartbeat()
+            proto_message.type = messages.MessageType.MESSAGE_TYPE_BATCH_HEARTBEAT
+            for msg_dict in msg_dicts:
+                fill_heartbeat(proto_message.heartbeats.add(), msg_dict)
+            return proto_message.SerializeToString()  # serialize
+        except TypeError as e:
+            log.error(f"encode_heartbeat_batch exception happened")
+            return error_message(e)
+
+    def decode_heartbeat_batch(self, binary_data: bytes) -> list[dict]:
+        """
+        Deserialize binary data for a BatchHeartbeat message.
+        :param binary_data: the data to deserialize.
+        :return: the decoded heartbeat messages, an empty list if the data is not a BatchHeartbeat.
+        """
+        deserialized = messages.BatchHeartbeat.FromString(binary_data)
+        if deserialized.type == messages.MessageType.MESSAGE_TYPE_BATCH_HEARTBEAT:
+            return [heartbeat_dict(heartbeat) for heartbeat in deserialized.heartbeats]
+        else:
+            log.error(f"decode_heartbeat_batch exception happened")
+            return []
+
+    def encode_status_batch(self, msg_dicts: list[dict]) -> bytes:
+        """
+        Serialize the status messages of many clients as one BatchStatus message.
+        :param msg_dicts: the status messages to serialize, like for encode_status().
+        :return: binary string format data.
+        """
+        try:
+            proto_message = messages.BatchStatus()
+            proto_message.type = messages.MessageType.MESSAGE_TYPE_BATCH_STATUS
+            for msg_dict in msg_dicts:
+                fill_status(proto_message.statuses.add(), msg_dict)
+            return proto_message.SerializeToString()  # serialize
+        except TypeError as e:
+            log.error(f"encode_status_batch exception happened")
+            return error_message(e)
+
+    def decode_status_batch(self, binary_data: bytes) -> list[dict]:
+        """
+        Deserialize binary data for a BatchStatus message.
+        :param binary_data: the data to deserialize.
+        :return: the decoded status messages, an empty list if the data is not a BatchStatus.
+        """
+        deserialized = messages.BatchStatus.FromString(binary_data)
+        if deserialized.type == messages.MessageType.MESSAGE_TYPE_BATCH_STATUS:
+            return [status_dict(status) for status in deserialized.statuses]
+        else:
+            log.error(f"decode_status_batch exception happened")
+            return []
+
+    def decode_message_type(self, binary_data: bytes) -> int:
+        """
+        Read the type of a message without decoding it.
+        :param binary_data: a serialized message of any type.
+        :return: the messages_pb2.MessageType of the message.
+        """
+        # serializers write the known fields in field number order, so the type comes first if it is set:
+        # tag 0x08 followed by a varint, one byte for every type so far
+        if binary_data[:1] != b"\x08":
+            # the default type is not written at all
+            return messages.MESSAGE_TYPE_HEARTBEAT
+        if len(binary_data) > 1 and binary_data[1] < 0x80:
+            return binary_data[1]
+        return messages.Envelope.FromString(binary_data).type
+
+    def peek_heartbeat_identifier(self, binary_data) -> tuple:
+        """
+        Read the identifier and request_id of a heartbeat message without decoding it.
+        :param binary_data: a serialized heartbeat message, bytes or a memoryview.
+        :return: (identifier, request_id), None if they cannot be read this way.
+        """
+        # like decode_message_type(): the fields come in field number order, the type of a heartbeat is
+        # not written, and msg and client_host are shorter than 128 bytes in practice
+        end = len(binary_data)
+        position = 0
+        for tag in (0x12, 0x1A):  # msg, client_host
+            if position < end and binary_data[position] == tag:
+                if position + 1 >= end or binary_data[position + 1] > 0x7F:
+                    return None
+                position += 2 + binary_data[position + 1]
+        values = [0, 0]  # identifier, request_id
+        for tag in (0x20, 0x28, 0x30):  # client_port, identifier, request_id
+            if position >= end or binary_data[position] != tag:
+                continue
+            position += 1
+            value = shift = 0
+            while True:
+                if position >= end:
+                    return None
+                byte = binary_data[position]
+                position += 1
+                value |= (byte & 0x7F) << shift
+                if byte < 0x80:
+                    break
+                shift += 7
+            if tag != 0x20:
+                values[(tag >> 3) - 5] = value
+        if position != end:
+            # unknown fields or another order
+            return None
+        return values[0], values[1]
+
+    def decode_heartbeat_record(self, binary_data) -> HeartbeatRecord:
+        """
+        Deserialize binary data for a heartbeat message, without building a dictionary.
+        :param binary_data: the data to deserialize, bytes or a memoryview.
+        :return: the decoded message, None if it is not a heartbeat message.
+        """
+        deserialized = messages.HeartBeatMessage.FromString(binary_data)
+        if deserialized.type != messages.MESSAGE_TYPE_HEARTBEAT:
+            log.error(f"decode_heartbeat_record exception happened")
+            return None
+        return HeartbeatRecord(
+            deserialized.type,
+            deserialized.msg,
+            deserialized.client_host,
+            deserialized.client_port,
+            deserialized.identifier,
+            deserialized.request_id,
+        )
+
+    def encode_heartbeat_record(self, record: HeartbeatRecord) -> bytes:
+        """
+        Serialize a heartbeat message.
+        :param record: the message to serialize.
+        :return: binary string format data.
+        """
+        return messages.HeartBeatMessage(
+            type=record.type,
+            msg=record.msg,
+            client_host=record.client_host,
+            client_port=record.client_port,
+            identifier=record.identifier,
+            request_id=record.request_id,
+        ).SerializeToString()
+
+    def decode_status_record(self, binary_data) -> StatusRecord:
+        """
+        Deserialize binary data for a status message, without building a dictionary.
+        :param binary_data: the data to deserialize, bytes or a memoryview.
+        :return: the decoded message, None if it is not a status message.
+        """
+        deserialized = messages.StatusMessage.FromString(binary_data)
+        if deserialized.type != messages.MESSAGE_TYPE_STATUS:
+            log.error(f"decode_status_record exception happened")
+            return None
+        return StatusRecord(
+            deserialized.type,
+            deserialized.message_count,
+            deserialized.identifier,
+            deserialized.request_id,
+        )
+
+    def encode_status_record(self, record: StatusRecord) -> bytes:
+        """
+        Serialize a status message.
+        :param record: the message to serialize.
+        :return: binary string format data.
+        """
+        return messages.StatusMessage(
+            type=record.type,
+            message_count=record.message_count,
+            identifier=record.identifier,
+            request_id=record.request_id,
+        ).SerializeToString()
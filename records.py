@@ -0,0 +1,21 @@
+"""
+Typed records of the messages for the codecs' fast path, see BaseEncoderDecoder.decode_heartbeat_record().
+The fields are the ones of the dictionaries of the dict based methods.
+"""
+from typing import NamedTuple
+
+
+class HeartbeatRecord(NamedTuple):
+    type: int
+    msg: str
+    client_host: str
+    client_port: int
+    identifier: int
+    request_id: int = 0
+
+
+class StatusRecord(NamedTuple):
+    type: int
+    message_count: int
+    identifier: int
+    request_id: int = 0
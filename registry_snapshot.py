@@ -0,0 +1,146 @@
+import logging
+import mmap
+import os
+import struct
+import sys
+from array import array
+
+from client_registry import ClientRegistry
+
+log = logging.getLogger("__main__." + __name__)
+
+MAGIC = b"CRSN"
+VERSION = 1
+# magic, version, byte order, rows, hosts, length of the host names
+HEADER = struct.Struct("=4sHcxQQQ")
+BYTE_ORDER = b"l" if sys.byteorder == "little" else b"b"
+
+# the ClientRegistry columns kept in a snapshot with their array type codes, bytearrays have none. next_poll
+# is not kept, every client is scheduled again after a restart
+COLUMNS = (
+    ("identifiers", "I"),
+    ("host_ids", "I"),
+    ("ports", "I"),
+    ("status_counts", "I"),
+    ("last_seen", "d"),
+    ("poll_intervals", "d"),
+    ("connected", None),
+    ("saved", None),
+    ("changed", None),
+    ("from_heartbeat", None),
+)
+
+
+def dump(registry: ClientRegistry) -> list[bytes]:
+    """
+    This function copies the registry into the snapshot format: a header, every column as raw machine
+    values, the length of every host name and the host names in UTF-8. Only memory is copied, so it is cheap
+    to call from the event loop and the result can be written from another thread, see write().
+
+    :param registry: the registry to copy.
+    :return: the snapshot in chunks.
+    """
+    hosts = [host.encode("utf-8") for host in registry.hosts]
+    host_lengths = array("I", map(len, hosts))
+    host_names = b"".join(hosts)
+    chunks = [
+        HEADER.pack(
+            MAGIC, VERSION, BYTE_ORDER, len(registry), len(hosts), len(host_names)
+        )
+    ]
+    chunks.extend(bytes(getattr(registry, name)) for name, _ in COLUMNS)
+    chunks.append(host_lengths.tobytes())
+    chunks.append(host_names)
+    return chunks
+
+
+def write(path: str, chunks: list[bytes]) -> None:
+    """
+    This function writes a snapshot next to path and renames it over path, so a crash while writing leaves
+    the previous snapshot.
+
+    :param path: the snapshot file.
+    :param chunks: the snapshot from dump().
+    """
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    temporary_path = f"{path}.{os.getpid()}.tmp"
+    with open(temporary_path, "wb") as snapshot_file:
+        snapshot_file.writelines(chunks)
+        snapshot_file.flush()
+        os.fsync(snapshot_file.fileno())
+    os.replace(temporary_path, path)
+
+
+def load(path: str, registry: ClientRegistry) -> int:
+    """
+    This function fills an empty registry from a snapshot, the file is memory mapped and every column is
+    copied in one piece. The clients are not scheduled and have to be polled like new ones.
+
+    :param path: the snapshot file.
+    :param registry: an empty registry.
+    :return: the number of clients loaded, 0 when there is no valid snapshot.
+    """
+    if len(registry):
+        raise ValueError("The registry is not empty")
+    try:
+        with open(path, "rb") as snapshot_file:
+            if os.fstat(snapshot_file.fileno()).st_size < HEADER.size:
+                log.error("Snapshot %s is truncated", path)
+                return 0
+            with mmap.mmap(
+                snapshot_file.fileno(), 0, access=mmap.ACCESS_READ
+            ) as snapshot:
+                return _load(path, snapshot, registry)
+    except FileNotFoundError:
+        return 0
+    except (OSError, ValueError, UnicodeDecodeError) as e:
+        log.error("Snapshot %s cannot be loaded %s", path, e)
+        return 0
+
+
+def _load(path: str, snapshot: mmap.mmap, registry: ClientRegistry) -> int:
+    magic, version, byte_order, rows, host_count, host_names_size = HEADER.unpack_from(
+        snapshot
+    )
+    if magic != MAGIC or version != VERSION or byte_order != BYTE_ORDER:
+        log.error("Snapshot %s has an unknown format", path)
+        return 0
+    sizes = [
+        rows * (array(typecode).itemsize if typecode else 1) for _, typecode in COLUMNS
+    ]
+    host_lengths_size = host_count * array("I").itemsize
+    if HEADER.size + sum(sizes) + host_lengths_size + host_names_size != len(snapshot):
+        log.error("Snapshot %s is truncated", path)
+        return 0
+
+    columns = {}
+    offset = HEADER.size
+    for (name, typecode), size in zip(COLUMNS, sizes):
+        if typecode is None:
+            columns[name] = bytearray(snapshot[offset : offset + size])
+        else:
+            column = array(typecode)
+            column.frombytes(snapshot[offset : offset + size])
+            columns[name] = column
+        offset += size
+    host_lengths = array("I")
+    host_lengths.frombytes(snapshot[offset : offset + host_lengths_size])
+    offset += host_lengths_size
+    hosts = []
+    for length in host_lengths:
+        hosts.append(snapshot[offset : offset + length].decode("utf-8"))
+        offset += length
+    if rows and max(columns["host_ids"]) >= host_count:
+        log.error("Snapshot %s is corrupted", path)
+        return 0
+
+    for name, column in columns.items():
+        setattr(registry, name, column)
+    registry.next_poll = array("d", bytes(rows * array("d").itemsize))
+    registry.hosts = hosts
+    registry.rebuild_hosts()
+    registry.index = dict(zip(registry.identifiers, range(rows)))
+    registry.unscheduled = array("I", registry.identifiers)
+    return rows
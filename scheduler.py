@@ -0,0 +1,77 @@
+import math
+from array import array
+
+
+class TimingWheel:
+    """
+    A hashed timing wheel of client identifiers: time is cut in ticks of tick_seconds, and a timer due in
+    tick t is appended to slot t % len(self.slots) with its tick. With enough slots for span_seconds, the
+    usual longest delay, a slot only holds timers of one tick and scheduling or expiring a timer is O(1)
+    whatever the number of timers; a later timer stays in its slot until the wheel came round to its tick.
+    Past deadlines expire at the next tick.
+
+    Timers cannot be cancelled: the caller keeps the deadline of every identifier and ignores expired
+    timers which were rescheduled since, see ClientRegistry.due_poll_targets().
+    """
+
+    def __init__(self, tick_seconds: float, span_seconds: float, now: float):
+        self.tick_seconds = tick_seconds
+        slot_count = max(math.ceil(span_seconds / tick_seconds), 1) + 1
+        # slot -> (identifiers, ticks)
+        self.slots = [(array("I"), array("q")) for _ in range(slot_count)]
+        # timers are expired up to and including this tick
+        self.current_tick = int(now // tick_seconds)
+        self.size = 0
+
+    def __len__(self):
+        return self.size
+
+    def schedule(self, identifier: int, deadline: float) -> None:
+        """
+        :param identifier: client identifier.
+        :param deadline: time at which the timer expires, on the clock given to advance().
+        """
+        tick = max(int(deadline // self.tick_seconds), self.current_tick + 1)
+        identifiers, ticks = self.slots[tick % len(self.slots)]
+        identifiers.append(identifier)
+        ticks.append(tick)
+        self.size += 1
+
+    def advance(self, now: float) -> array:
+        """
+        This method expires the timers of all ticks up to now.
+
+        :param now: the current time.
+        :return: the identifiers of the expired timers.
+        """
+        expired = array("I")
+        last_tick = int(now // self.tick_seconds)
+        # after a long stall every slot is visited once
+        first_tick = max(self.current_tick + 1, last_tick - len(self.slots) + 1)
+        for tick in range(first_tick, last_tick + 1):
+            slot = tick % len(self.slots)
+            identifiers, ticks = self.slots[slot]
+            if not identifiers:
+                continue
+            if max(ticks) <= last_tick:
+                expired.extend(identifiers)
+                self.slots[slot] = (array("I"), array("q"))
+                continue
+            # some timers are for a later round of the wheel
+            later = [
+                (identifier, timer_tick)
+                for identifier, timer_tick in zip(identifiers, ticks)
+                if timer_tick > last_tick
+            ]
+            expired.extend(
+                identifier
+                for identifier, timer_tick in zip(identifiers, ticks)
+                if timer_tick <= last_tick
+            )
+            self.slots[slot] = (
+                array("I", [identifier for identifier, _ in later]),
+                array("q", [timer_tick for _, timer_tick in later]),
+            )
+        self.current_tick = max(self.current_tick, last_tick)
+        self.size -= len(expired)
+        return expired
@@ -1,13 +1,127 @@
 import asyncio
 import logging
 import random
+import time
 
+from admission import peer_ip
+from client_connections import ClientConnectionPool
+from client_registry import ClientRegistry
 from db_operations import AsyncPgPostgresManager
 from encode_decode_executor import EncodeDecodeExecutor
+import framing
+from heartbeat_protocol import HeartbeatProtocol
+from message_cache import MessageCache
 import messages_pb2 as messages
+from metrics import MetricsRegistry
+import registry_snapshot
+from scheduler import TimingWheel
 
 log = logging.getLogger("__main__." + __name__)
 
+# how heartbeat connections are served: StreamReader/StreamWriter or heartbeat_protocol.HeartbeatProtocol
+TRANSPORTS = ("stream", "protocol")
+
+
+def log_task_failure(task: asyncio.Future) -> None:
+    """
+    Done callback of the background tasks, which nothing awaits: their exceptions are logged.
+    """
+    if not task.cancelled() and task.exception() is not None:
+        log.error(
+            "Background task failed %r", task.exception(), exc_info=task.exception()
+        )
+
+
+class ServerMetrics(MetricsRegistry):
+    """
+    The metrics of a Server, see metrics.py. Sizes are gauges computed when the metrics are collected.
+    """
+
+    def __init__(self, server: "Server"):
+        super().__init__()
+        self.heartbeats = self.counter(
+            "heartbeats_total", "Heartbeat messages received from clients"
+        )
+        self.heartbeats_coalesced = self.counter(
+            "heartbeats_coalesced_total",
+            "Heartbeats over the rate limit of their client, acked without being registered",
+        )
+        self.heartbeat_frames_throttled = self.counter(
+            "heartbeat_frames_throttled_total",
+            "Frames read late because their source address was over its rate limit",
+        )
+        self.connections_rejected = self.counter(
+            "connections_rejected_total",
+            "Connections closed when accepted, over the connection or accept rate limit",
+        )
+        self.heartbeat_decode_seconds = self.histogram(
+            "heartbeat_decode_seconds", "Time to decode a heartbeat message"
+        )
+        self.heartbeat_encode_seconds = self.histogram(
+            "heartbeat_encode_seconds", "Time to encode a heartbeat ack"
+        )
+        self.heartbeat_ack_seconds = self.histogram(
+            "heartbeat_ack_seconds", "Time to write and drain a heartbeat ack"
+        )
+        self.client_connect_seconds = self.histogram(
+            "client_connect_seconds", "Time to open a new connection to a client"
+        )
+        self.status_rtt_seconds = self.histogram(
+            "status_rtt_seconds",
+            "Time from sending status requests on a connection to the last acked reply",
+        )
+        self.status_requests = self.counter(
+            "status_requests_total", "Status requests sent to clients"
+        )
+        self.status_request_failures = self.counter(
+            "status_request_failures_total", "Status requests without a reply"
+        )
+        self.sweep_seconds = self.histogram(
+            "sweep_seconds",
+            "Duration of a round of status requests: the clients due at one poll tick, or every client "
+            "with Server.sweep()",
+        )
+        self.db_query_seconds = self.histogram(
+            "db_query_seconds", "Time to query the saved clients from the database"
+        )
+        self.db_write_seconds = self.histogram(
+            "db_write_seconds", "Time to write the changed clients to the database"
+        )
+        self.status_history_dropped = self.counter(
+            "status_history_dropped_total",
+            "Status history rows dropped because the database was unavailable",
+        )
+        self.snapshot_seconds = self.histogram(
+            "snapshot_seconds", "Time to copy and write a snapshot of the registry"
+        )
+        self.gauge(
+            "client_connections_active",
+            "Open connections from clients sending heartbeats",
+            lambda: len(server.clients),
+        )
+        self.gauge(
+            "scheduled_polls",
+            "Clients waiting for their next status request",
+            lambda: len(server.poll_wheel) if server.poll_wheel is not None else 0,
+        )
+        self.gauge(
+            "heartbeat_writes_pending",
+            "Clients whose latest heartbeat is waiting to be saved in the database",
+            lambda: len(server.heartbeat_writer)
+            if server.heartbeat_writer is not None
+            else 0,
+        )
+        self.gauge(
+            "registry_clients",
+            "Clients in the registry",
+            lambda: len(server.registry),
+        )
+        self.gauge(
+            "registry_clients_connected",
+            "Clients which answered their last status request",
+            lambda: server.registry.connected_count(),
+        )
+
 
 class Server:
     def __init__(
@@ -19,33 +133,136 @@ class Server:
         server_ip: str,
         server_port: int,
         loop=None,
+        sweep_concurrency: int = 100,
+        client_timeout_seconds: float = 5.0,
+        sweep_timeout_seconds: float = 60.0,
+        client_pool_max_connections: int = 1000,
+        client_pool_idle_timeout_seconds: float = 120.0,
+        pipeline_status_requests: bool = False,
+        batch_status_requests: bool = False,
+        reuse_port: bool = False,
+        heartbeat_router=None,
+        poll_tick_seconds: float = 0.1,
+        max_poll_interval_seconds: float = 300.0,
+        poll_backoff_factor: float = 2.0,
+        transport: str = "stream",
+        message_cache_size: int = 100000,
+        negotiated_codecs: dict = None,
+        heartbeat_writer=None,
+        snapshot_path: str = None,
+        snapshot_interval_seconds: float = 60.0,
+        status_history: bool = False,
+        status_history_max_rows: int = 1000000,
+        admission=None,
     ):
+        if transport not in TRANSPORTS:
+            raise ValueError(
+                f"Unknown transport {transport}, expected one of {TRANSPORTS}"
+            )
         self.encoder_decoder = encoder_decoder
         self.db_op_manager = db_op_manager
         self.query_seconds_interval_lower = query_seconds_interval_lower
         self.query_seconds_interval_upper = query_seconds_interval_upper
         self.clients = {}  # to handle multiple clients
-        self.active_clients_in_cache = {}  # save all client information
+        # save all client information, stable clients are polled less often
+        self.registry = ClientRegistry(
+            min_poll_interval=query_seconds_interval_lower,
+            max_poll_interval=max_poll_interval_seconds,
+            backoff_factor=poll_backoff_factor,
+        )
         self.server_ip = server_ip
         self.server_port = server_port
         self.loop = loop
+        self.sweep_concurrency = sweep_concurrency  # max status requests in flight
+        self.client_timeout_seconds = client_timeout_seconds  # connect/read deadline
+        self.sweep_timeout_seconds = sweep_timeout_seconds  # deadline for one sweep
+        # pipeline the status requests of client identifiers sharing an address
+        self.pipeline_status_requests = pipeline_status_requests
+        # send them as one BatchStatus message instead
+        self.batch_status_requests = batch_status_requests
+        # connections to clients are kept open between sweeps
+        self.client_connections = ClientConnectionPool(
+            max_connections=client_pool_max_connections,
+            idle_timeout_seconds=client_pool_idle_timeout_seconds,
+        )
+        self.metrics = ServerMetrics(self)
+        # with several worker processes or nodes: only keep and sweep the clients owned by this one, see
+        # workers.HeartbeatRouter and cluster.ShardCluster
+        self.reuse_port = reuse_port
+        self.heartbeat_router = heartbeat_router
+        self.swept_shards = (
+            None  # the shards owned when the registry was last handed over
+        )
+        self.poll_tick_seconds = poll_tick_seconds  # resolution of the poll scheduler
+        self.poll_wheel = (
+            None  # next poll of every client, see send_status_request_to_clients()
+        )
+        self.poll_semaphore = None  # created on first use, inside the event loop
+        self.transport = transport
+        # serialized acks and status requests of every client, see MessageCache
+        self.message_cache = MessageCache(encoder_decoder, message_cache_size)
+        # with negotiated_codecs, a codec byte -> EncodeDecodeExecutor mapping, every heartbeat connection
+        # starts with the byte of its codec, see codec_negotiation.py
+        self.codec_negotiation = negotiated_codecs is not None
+        self.codecs = {None: (encoder_decoder, self.message_cache)}
+        for codec, codec_encoder_decoder in (negotiated_codecs or {}).items():
+            self.codecs[codec] = (
+                codec_encoder_decoder,
+                self.message_cache
+                if codec_encoder_decoder is encoder_decoder
+                else MessageCache(codec_encoder_decoder, message_cache_size),
+            )
+        # saves the heartbeats of the owned clients soon after they are received, see
+        # write_behind.HeartbeatWriteBehind
+        self.heartbeat_writer = heartbeat_writer
+        # the registry is saved in this file every snapshot_interval_seconds and loaded from it at startup,
+        # see registry_snapshot.py
+        self.snapshot_path = snapshot_path
+        self.snapshot_interval_seconds = snapshot_interval_seconds
+        # with status_history, the result of every status request is kept here and appended to the
+        # database history by flush_clients(), at most status_history_max_rows are kept while the database
+        # is unavailable
+        self.status_history = [] if status_history else None
+        self.status_history_max_rows = status_history_max_rows
+        # limits the connections and the heartbeat rate of the clients, see admission.AdmissionControl
+        self.admission = admission
 
     async def start_server(self):
         """
         Wrapper function of asyncio.start_server. This method starts a server to handle status message
-        request from the client.
+        request from the client. With the "protocol" transport, connections are served by a
+        heartbeat_protocol.HeartbeatProtocol instead.
 
         :return: return a coroutine
         """
-        if self.loop:
+        if self.transport == "protocol":
+            loop = self.loop or asyncio.get_event_loop()
+            await loop.create_server(
+                lambda: HeartbeatProtocol(self),
+                self.server_ip,
+                self.server_port,
+                reuse_port=self.reuse_port,
+            )
+        elif self.loop:
             # Testing case
             await asyncio.start_server(
-                self.accept_client, self.server_ip, self.server_port, loop=self.loop
+                self.accept_client,
+                self.server_ip,
+                self.server_port,
+                loop=self.loop,
+                reuse_port=self.reuse_port,
             )
         else:
             await asyncio.start_server(
-                self.accept_client, self.server_ip, self.server_port
+                self.accept_client,
+                self.server_ip,
+                self.server_port,
+                reuse_port=self.reuse_port,
             )
+        if self.heartbeat_router is not None:
+            self.heartbeat_router.start(self.registry, self.heartbeat_writer)
+        if self.heartbeat_writer is not None:
+            self.heartbeat_writer.start(self.registry)
 
     def accept_client(
         self, client_reader: asyncio.StreamReader, client_writer: asyncio.StreamWriter
@@ -55,23 +272,82 @@ class Server:
         :param client_reader: StreamReader object to read data from client.
         :param client_writer: StreamWriter object to write data to client.
         """
-        print("accept_client..................")
+        log.debug("accept_client")
+        if not self.admit_connection():
+            client_writer.close()
+            return
         task = asyncio.Task(self.handle_client(client_reader, client_writer))
         self.clients[task] = (client_reader, client_writer)
 
         def client_disconnected(task_del):
             del self.clients[task_del]
             client_writer.close()
-            log.info("client disconnected")
+            log.debug("client disconnected")
 
-        log.info("client connected")
+        log.debug("client connected")
         task.add_done_callback(client_disconnected)
 
+    def admit_connection(self) -> bool:
+        """
+        :return: True if a new connection is accepted by self.admission.
+        """
+        if self.admission is None or self.admission.admit(
+            len(self.clients), time.monotonic()
+        ):
+            return True
+        self.metrics.connections_rejected.inc()
+        log.debug("connection rejected")
+        return False
+
+    async def with_client_connection(self, host: str, port: int, exchange):
+        """
+        This method runs an exchange of messages on a connection from self.client_connections and gives the
+        connection back afterwards. If a reused connection turns out to be broken, the exchange runs again
+        on a new connection.
+
+        :param host: client's host address.
+        :param port: client's port number
+        :param exchange: coroutine function called with the connection's StreamReader and StreamWriter.
+        :return: the result of exchange.
+        """
+        while True:
+            start = time.perf_counter()
+            connection = await self.client_connections.acquire(
+                host, port, connect_timeout=self.client_timeout_seconds
+            )
+            client_reader, client_writer, reused = connection
+            if not reused:
+                self.metrics.client_connect_seconds.observe(time.perf_counter() - start)
+            try:
+                start = time.perf_counter()
+                result = await exchange(client_reader, client_writer)
+            except (ConnectionError, OSError, framing.FrameError) as e:
+                self.client_connections.release(
+                    host, port, client_reader, client_writer, reusable=False
+                )
+                # a timeout is an OSError since Python 3.11, retrying it would double the deadline
+                if not reused or isinstance(e, asyncio.TimeoutError):
+                    raise
+                log.info("Reconnecting to client %s:%s after %r", host, port, e)
+                continue
+            except BaseException:
+                self.client_connections.release(
+                    host, port, client_reader, client_writer, reusable=False
+                )
+                raise
+            self.metrics.status_rtt_seconds.observe(time.perf_counter() - start)
+            self.client_connections.release(
+                host, port, client_reader, client_writer, reusable=True
+            )
+            return result
+
     async def send_a_message_to_client(
         self, host: str, port: int, msg: dict
     ) -> (bool, int):
         """
         This method sends a message to a given client and try to get message count from the client.
+        The connection stays open for the next status request, see with_client_connection().
+        Connecting and reading the reply are each bounded by self.client_timeout_seconds.
 
         :param host: client's host address.
         :param port: client's port number
@@ -79,172 +355,823 @@ class Server:
         :return: status of client as True or False and heartbeat message count from this client.
         """
         try:
-            log.info(f"send_a_message_to_client host{host} port{port} ")
+            log.debug("send_a_message_to_client host %s port %s", host, port)
 
-            client_reader, client_writer = await asyncio.open_connection(host, port)
-            log.info("Client connected sending first data %s", msg)
+            count = await self.with_client_connection(
+                host,
+                port,
+                lambda client_reader, client_writer: self.exchange_status(
+                    client_reader, client_writer, host, port, msg
+                ),
+            )
+            return True, count
+        except asyncio.TimeoutError:
+            log.error(
+                "Timed out while sending status request to client %s:%s", host, port
+            )
+            return False, 0
+        except (ConnectionError, OSError, framing.FrameError) as e:
+            log.error(
+                "Connection error while sending status request to client %s:%s %s",
+                host,
+                port,
+                e,
+            )
+            return False, 0
 
-            serialized_bnr = self.encoder_decoder.encode_status(msg_dict=msg)
+    async def send_messages_to_client(self, host: str, port: int, msgs: dict) -> dict:
+        """
+        This method sends the status messages of many client identifiers served at the same address, e.g.
+        by a relay, pipelined on one connection, or in one BatchStatus message with
+        self.batch_status_requests. See exchange_statuses() and exchange_status_batch().
 
-            client_writer.write(serialized_bnr)
-            await client_writer.drain()
+        :param host: client's host address.
+        :param port: client's port number
+        :param msgs: a mapping of client_id to the message to send.
+        :return: a mapping of client_id to (client_status, count).
+        """
+        results = {}
+        try:
+            log.debug(
+                "send_messages_to_client host %s port %s %d messages",
+                host,
+                port,
+                len(msgs),
+            )
+            exchange = (
+                self.exchange_status_batch
+                if self.batch_status_requests
+                else self.exchange_statuses
+            )
+            await self.with_client_connection(
+                host,
+                port,
+                lambda client_reader, client_writer: exchange(
+                    client_reader, client_writer, host, port, msgs, results
+                ),
+            )
+        except asyncio.TimeoutError:
+            log.error(
+                "Timed out while sending status requests to client %s:%s", host, port
+            )
+        except (ConnectionError, OSError, framing.FrameError) as e:
+            log.error(
+                "Connection error while sending status requests to client %s:%s %s",
+                host,
+                port,
+                e,
+            )
+        return {client_id: results.get(client_id, (False, 0)) for client_id in msgs}
 
-            data = await client_reader.read(1024)
+    async def exchange_status(
+        self,
+        client_reader: asyncio.StreamReader,
+        client_writer: asyncio.StreamWriter,
+        host: str,
+        port: int,
+        msg: dict,
+    ) -> int:
+        """
+        This method sends a status message on an open connection, reads the client's status reply and acks
+        it.
 
-            if data is None:
-                log.error("Expected status msg, received None")
-                return False, 0
+        :param client_reader: StreamReader object to read data from client.
+        :param client_writer: StreamWriter object to write data to client.
+        :param host: client's host address.
+        :param port: client's port number
+        :param msg: message to send
+        :return: heartbeat message count from this client.
+        """
+        log.debug("Sending status request to client %s", msg.get("identifier"))
 
-            deserialized_dict = self.encoder_decoder.decode_status(binary_data=data)
+        serialized_bnr = self.message_cache.status_request(
+            msg["identifier"], msg["message_count"], msg.get("request_id", 0)
+        )
 
-            log.info(f"deserialized_dict STATUS COUNT is  from {deserialized_dict}")
+        client_writer.write(framing.encode_frame(serialized_bnr))
+        await client_writer.drain()
+
+        data = await asyncio.wait_for(
+            framing.read_frame(client_reader), timeout=self.client_timeout_seconds
+        )
+
+        if data is None:
+            raise ConnectionResetError("Expected status msg, connection closed")
+
+        reply = self.encoder_decoder.decode_status_record(binary_data=data)
+        if reply is None:
+            raise framing.FrameError("Expected status msg, got another message")
+
+        log.debug("Received status reply %s", reply)
+
+        # send 'ack' to client
+        serialized_bnr = self.message_cache.ack(reply.identifier, host, port)
+        client_writer.write(framing.encode_frame(serialized_bnr))
+        await client_writer.drain()
+
+        return reply.message_count
+
+    async def exchange_statuses(
+        self,
+        client_reader: asyncio.StreamReader,
+        client_writer: asyncio.StreamWriter,
+        host: str,
+        port: int,
+        msgs: dict,
+        results: dict,
+    ) -> None:
+        """
+        This method writes all status messages without waiting for replies, each one with its own
+        request_id, and then matches the replies by request_id in whatever order they arrive. Every reply
+        is acked with the request_id it carries. Replies without a request_id are matched by identifier.
+        Reading each reply is bounded by self.client_timeout_seconds.
+
+        :param client_reader: StreamReader object to read data from client.
+        :param client_writer: StreamWriter object to write data to client.
+        :param host: client's host address.
+        :param port: client's port number
+        :param msgs: a mapping of client_id to the message to send.
+        :param results: a mapping of client_id to (client_status, count), completed as replies arrive.
+        Clients which already have a result are skipped.
+        """
+        pending = {}  # request_id -> client_id
+        frames = []
+        for request_id, (client_id, msg) in enumerate(msgs.items(), start=1):
+            if client_id in results:
+                continue
+            pending[request_id] = client_id
+            serialized_bnr = self.message_cache.status_request(
+                msg["identifier"], msg["message_count"], request_id
+            )
+            frames.append(framing.encode_frame(serialized_bnr))
+        request_ids = {
+            client_id: request_id for request_id, client_id in pending.items()
+        }
+
+        client_writer.write(b"".join(frames))
+        await client_writer.drain()
+
+        while pending:
+            data = await asyncio.wait_for(
+                framing.read_frame(client_reader), timeout=self.client_timeout_seconds
+            )
+            if data is None:
+                raise ConnectionResetError("Expected status msg, connection closed")
+
+            reply = self.encoder_decoder.decode_status_record(binary_data=data)
+            client_id = None
+            if reply is not None:
+                request_id = reply.request_id or request_ids.get(reply.identifier)
+                client_id = pending.pop(request_id, None)
+            if client_id is None:
+                log.error("Unexpected status reply from %s:%s %s", host, port, reply)
+                continue
+            results[client_id] = (True, reply.message_count)
 
             # send 'ack' to client
-            msg = {
-                "type": messages.MessageType.MESSAGE_TYPE_HEARTBEAT,
-                "msg": "ack",
-                "client_host": host,
-                "client_port": port,
-                "identifier": deserialized_dict.get("identifier"),
-            }
-            serialized_bnr = self.encoder_decoder.encode_heartbeat(msg_dict=msg)
-            client_writer.write(serialized_bnr)
-            await client_writer.drain()
+            serialized_bnr = self.message_cache.ack(
+                reply.identifier, host, port, request_id
+            )
+            client_writer.write(framing.encode_frame(serialized_bnr))
+        await client_writer.drain()
 
-            client_writer.close()
-            return True, deserialized_dict.get("message_count", 0)
-        except (ConnectionError, OSError) as e:
-            log.error(f"Connection error while sending status request to client{e}")
-            return False, 0
+    async def exchange_status_batch(
+        self,
+        client_reader: asyncio.StreamReader,
+        client_writer: asyncio.StreamWriter,
+        host: str,
+        port: int,
+        msgs: dict,
+        results: dict,
+    ) -> None:
+        """
+        This method sends all status messages in one BatchStatus message, each one with its own request_id,
+        reads the BatchStatus reply and acks all replies with one BatchHeartbeat message. Replies are matched
+        like in exchange_statuses(), clients missing from the reply are left without a result.
+        Reading the reply is bounded by self.client_timeout_seconds.
+
+        :param client_reader: StreamReader object to read data from client.
+        :param client_writer: StreamWriter object to write data to client.
+        :param host: client's host address.
+        :param port: client's port number
+        :param msgs: a mapping of client_id to the message to send.
+        :param results: a mapping of client_id to (client_status, count), completed with the reply.
+        Clients which already have a result are skipped.
+        """
+        pending = {}  # request_id -> client_id
+        batch = []
+        for request_id, (client_id, msg) in enumerate(msgs.items(), start=1):
+            if client_id in results:
+                continue
+            pending[request_id] = client_id
+            batch.append(dict(msg, request_id=request_id))
+        if not pending:
+            return
+        request_ids = {
+            client_id: request_id for request_id, client_id in pending.items()
+        }
+
+        serialized_bnr = self.encoder_decoder.encode_status_batch(msg_dicts=batch)
+        client_writer.write(framing.encode_frame(serialized_bnr))
+        await client_writer.drain()
+
+        data = await asyncio.wait_for(
+            framing.read_frame(client_reader), timeout=self.client_timeout_seconds
+        )
+        if data is None:
+            raise ConnectionResetError("Expected status msg, connection closed")
+
+        acks = []
+        for deserialized_dict in self.encoder_decoder.decode_status_batch(
+            binary_data=data
+        ):
+            request_id = deserialized_dict.get("request_id") or request_ids.get(
+                deserialized_dict.get("identifier")
+            )
+            client_id = pending.pop(request_id, None)
+            if client_id is None:
+                log.error(
+                    "Unexpected status reply from %s:%s %s",
+                    host,
+                    port,
+                    deserialized_dict,
+                )
+                continue
+            results[client_id] = (True, deserialized_dict.get("message_count", 0))
+            acks.append(
+                {
+                    "type": messages.MessageType.MESSAGE_TYPE_HEARTBEAT,
+                    "msg": "ack",
+                    "client_host": host,
+                    "client_port": port,
+                    "identifier": deserialized_dict.get("identifier"),
+                    "request_id": request_id,
+                }
+            )
+        if pending:
+            log.error(
+                "Batched status reply from %s:%s misses %d clients",
+                host,
+                port,
+                len(pending),
+            )
+
+        # send 'ack' to client
+        serialized_bnr = self.encoder_decoder.encode_heartbeat_batch(msg_dicts=acks)
+        client_writer.write(framing.encode_frame(serialized_bnr))
+        await client_writer.drain()
+
+    async def poll_clients(self, targets: list, deadline: float) -> dict:
+        """
+        This method sends status requests to many clients concurrently. At most self.sweep_concurrency
+        connections are busy at the same time, across all running calls. With self.pipeline_status_requests
+        or self.batch_status_requests, the requests for client identifiers sharing a host and port are
+        pipelined on one connection or batched in one message.
+        Requests still running at the deadline are cancelled and their clients are reported as not
+        connected.
+
+        :param targets: a list of (client_id, host, port, msg) tuples.
+        :param deadline: event loop time by which all requests have to be finished.
+        :return: a mapping of client_id to (client_status, count).
+        """
+        # shared by the polls running at the same time
+        if self.poll_semaphore is None:
+            self.poll_semaphore = asyncio.Semaphore(self.sweep_concurrency)
+        semaphore = self.poll_semaphore
+
+        batches = {}  # (host, port) or client_id -> (host, port, {client_id: msg})
+        for client_id, host, port, msg in targets:
+            key = (
+                (host, port)
+                if self.pipeline_status_requests or self.batch_status_requests
+                else client_id
+            )
+            batches.setdefault(key, (host, port, {}))[2][client_id] = msg
+
+        async def poll(host, port, msgs):
+            async with semaphore:
+                if len(msgs) > 1:
+                    return await self.send_messages_to_client(host, port, msgs)
+                ((client_id, msg),) = msgs.items()
+                return {client_id: await self.send_a_message_to_client(host, port, msg)}
+
+        tasks = [
+            (msgs, asyncio.ensure_future(poll(host, port, msgs)))
+            for host, port, msgs in batches.values()
+        ]
+        if not tasks:
+            return {}
+
+        timeout = max(deadline - asyncio.get_event_loop().time(), 0)
+        done, pending = await asyncio.wait([task for _, task in tasks], timeout=timeout)
+        if pending:
+            log.error(
+                "Status sweep deadline reached, %d clients did not answer in time",
+                len(pending),
+            )
+            for task in pending:
+                task.cancel()
+            await asyncio.gather(*pending, return_exceptions=True)
+
+        results = {}
+        for msgs, task in tasks:
+            if task in done and task.exception() is None:
+                results.update(task.result())
+                continue
+            if task in done:
+                log.error(
+                    "Status request to %d clients failed %r",
+                    len(msgs),
+                    task.exception(),
+                )
+            for client_id in msgs:
+                results[client_id] = (False, 0)
+        return results
+
+    async def flush_clients(self) -> None:
+        """
+        This method saves the latest clients information to the database. Only the clients which are new,
+        gone or have a different host, port or status count since the last flush are written. Clients which
+        are gone and only known from the database are removed from the registry afterwards.
+        """
+        changed_clients, removed_client_ids = self.registry.changes()
+        with self.metrics.db_write_seconds.time():
+            saved = await self.db_op_manager.update_changed_clients_to_db(
+                changed_clients, removed_client_ids
+            )
+        if saved:
+            self.registry.forget_lost_clients(removed_client_ids)
+        else:
+            self.registry.restore_changes(changed_clients, removed_client_ids)
+        await self.flush_status_history()
+
+    async def flush_status_history(self) -> None:
+        """
+        This method appends the status requests recorded since the last flush to the status history in the
+        database. They are kept for the next flush if the database is unavailable, up to
+        self.status_history_max_rows, the oldest ones are dropped beyond.
+        """
+        if not self.status_history:
+            return
+        statuses, self.status_history = self.status_history, []
+        with self.metrics.db_write_seconds.time():
+            saved = await self.db_op_manager.save_status_history(statuses)
+        if not saved:
+            statuses.extend(self.status_history)
+            dropped = len(statuses) - self.status_history_max_rows
+            if dropped > 0:
+                self.metrics.status_history_dropped.inc(dropped)
+                log.error("Dropped %d status history rows", dropped)
+                del statuses[:dropped]
+            self.status_history = statuses
+
+    def hand_over_clients(self, shards: frozenset) -> None:
+        """
+        This method removes the clients of the shards this server does not own anymore from the registry,
+        the ones known from a heartbeat are forwarded to their new owner.
+
+        :param shards: the shards owned by this server.
+        """
+        shard_count = self.heartbeat_router.shard_count
+        lost_clients = self.registry.remove_clients(
+            lambda identifier: identifier % shard_count not in shards
+        )
+        for identifier, host, port, last_seen in lost_clients:
+            self.heartbeat_router.forward(identifier, host, port, last_seen)
+        if lost_clients:
+            log.info("Handed over %d clients", len(lost_clients))
+
+    def update_owned_shards(self) -> bool:
+        """
+        This method hands over the clients of the shards this server does not own anymore, see
+        hand_over_clients(). It is called every poll tick, so that a released or expired shard is not
+        polled or saved by this server anymore once its new owner may take it.
+
+        :return: True if shards were gained, their clients are read by the next refresh_clients().
+        """
+        shards = self.heartbeat_router.owned_shards()
+        if shards == self.swept_shards:
+            return False
+        gained = shards - (self.swept_shards or frozenset())
+        self.hand_over_clients(shards)
+        self.swept_shards = shards
+        return bool(gained)
 
     async def send_status_request_to_clients(self) -> None:
         """
-        This method runs an infinite loop and send status message
-        to all active clients in the cache and saved in the database.
-        The interval is determined randomly between 2 configured values saved in self.query_seconds_interval_lower and
-        self.query_seconds_interval_upper
-        Then it updates the database with the latest information from the clients.
+        This method runs an infinite loop which polls every client on its own schedule instead of all of
+        them at once: after a status request, a client is polled again after its poll interval plus a random
+        jitter of up to self.query_seconds_interval_upper - self.query_seconds_interval_lower, and new
+        clients are spread over the upper interval. The poll interval of a client starts at
+        self.query_seconds_interval_lower and backs off while the client is stable, see
+        ClientRegistry.record_status(). The next poll of every client is a timer in a scheduler.TimingWheel,
+        which is advanced every self.poll_tick_seconds; the clients which are due are polled in the
+        background, see poll_due_clients().
+        The saved clients are read from the database and the changes are written to it at random intervals
+        between the same 2 values, and right away when this server gained shards. With a snapshot_path, a
+        snapshot of the registry is written every self.snapshot_interval_seconds, see save_snapshot().
         """
+        loop = asyncio.get_event_loop()
+        # the wheel spans the longest poll interval with its jitter
+        self.poll_wheel = TimingWheel(
+            self.poll_tick_seconds,
+            self.registry.max_poll_interval
+            + self.query_seconds_interval_upper
+            - self.query_seconds_interval_lower,
+            loop.time(),
+        )
+        polls = set()
+        refresh = None
+        next_refresh = loop.time()
+        snapshot = None
+        next_snapshot = loop.time() + self.snapshot_interval_seconds
         while True:
-            log.info(
-                f"send_status_request_to_clients.........{self.active_clients_in_cache}"
+            now = loop.time()
+            if self.heartbeat_router is not None and self.update_owned_shards():
+                next_refresh = now
+            if now >= next_refresh and (refresh is None or refresh.done()):
+                refresh = asyncio.ensure_future(self.refresh_and_flush_clients())
+                refresh.add_done_callback(log_task_failure)
+                next_refresh = now + random.randint(
+                    self.query_seconds_interval_lower, self.query_seconds_interval_upper
+                )
+            if (
+                self.snapshot_path
+                and now >= next_snapshot
+                and (snapshot is None or snapshot.done())
+            ):
+                snapshot = asyncio.ensure_future(self.save_snapshot())
+                snapshot.add_done_callback(log_task_failure)
+                next_snapshot = now + self.snapshot_interval_seconds
+
+            for client_id in self.registry.take_unscheduled():
+                self.schedule_poll(
+                    client_id,
+                    now + random.uniform(0, self.query_seconds_interval_upper),
+                )
+            targets = self.registry.due_poll_targets(
+                self.poll_wheel.advance(now), now + self.poll_tick_seconds
             )
-            clients_from_db = await self.db_op_manager.query_saved_clients_from_db()
-            log.info(f"clients_from_db =  {clients_from_db}")
-            updated_clients_mapping = {}
+            if targets:
+                poll = asyncio.ensure_future(self.poll_due_clients(targets))
+                polls.add(poll)
+                poll.add_done_callback(polls.discard)
+                poll.add_done_callback(log_task_failure)
+            await asyncio.sleep(self.poll_tick_seconds)
 
-            # send message to all saved clients in the cache
-            for client_id in self.active_clients_in_cache:
-                host = self.active_clients_in_cache[client_id].get("client_host")
-                port = self.active_clients_in_cache[client_id].get("client_port")
+    def schedule_poll(self, client_id: int, deadline: float) -> None:
+        if self.registry.schedule_poll(client_id, deadline):
+            self.poll_wheel.schedule(client_id, deadline)
 
-                msg = {
-                    "type": messages.MessageType.MESSAGE_TYPE_STATUS,
-                    "message_count": 0,
-                    "identifier": client_id,
-                }
+    async def poll_due_clients(self, targets: list) -> None:
+        """
+        This method sends status requests to the clients which are due and schedules their next poll after
+        their adapted poll interval. The clients are scheduled again even if the round failed, otherwise they
+        would never be polled again.
 
-                client_status, count = await self.send_a_message_to_client(
-                    host, port, msg
+        :param targets: a list of (client_id, host, port, status_count) tuples.
+        """
+        loop = asyncio.get_event_loop()
+        start = time.perf_counter()
+        results = {}
+        try:
+            results = await self.poll_clients(
+                self.status_targets(targets), loop.time() + self.sweep_timeout_seconds
+            )
+            self.record_statuses(results)
+            self.metrics.sweep_seconds.observe(time.perf_counter() - start)
+        finally:
+            now = loop.time()
+            jitter = (
+                self.query_seconds_interval_upper - self.query_seconds_interval_lower
+            )
+            for client_id in results or [target[0] for target in targets]:
+                self.schedule_poll(
+                    client_id,
+                    now
+                    + self.registry.poll_interval(client_id)
+                    + random.uniform(0, jitter),
                 )
-                if client_status:
-                    updated_clients_mapping[client_id] = {
-                        "client_identifier": client_id,
-                        "is_connected": True,
-                        "client_host": host,
-                        "client_port": port,
-                        "status_count": count,
-                    }
-                log.info(
-                    f"Client status for {host}, {port} is {client_status} after status check, map is "
-                    f"{updated_clients_mapping}"
+
+    def load_snapshot(self) -> int:
+        """
+        This method fills the registry from the snapshot at self.snapshot_path before the server starts, the
+        clients can then be polled without waiting for the database. They are reconciled with the database
+        by the first refresh_and_flush_clients(), in the background.
+
+        :return: the number of clients loaded.
+        """
+        if not self.snapshot_path:
+            return 0
+        start = time.perf_counter()
+        loaded = registry_snapshot.load(self.snapshot_path, self.registry)
+        log.info(
+            "Loaded %d clients from %s in %.3f s",
+            loaded,
+            self.snapshot_path,
+            time.perf_counter() - start,
+        )
+        return loaded
+
+    async def save_snapshot(self) -> bool:
+        """
+        This method writes a snapshot of the registry to self.snapshot_path. The registry is copied in the
+        event loop and the copy is written from a thread.
+
+        :return: True if the snapshot is written.
+        """
+        start = time.perf_counter()
+        chunks = registry_snapshot.dump(self.registry)
+        try:
+            await asyncio.get_event_loop().run_in_executor(
+                None, registry_snapshot.write, self.snapshot_path, chunks
+            )
+        except OSError as e:
+            log.error("Snapshot %s cannot be written %s", self.snapshot_path, e)
+            return False
+        self.metrics.snapshot_seconds.observe(time.perf_counter() - start)
+        return True
+
+    async def refresh_and_flush_clients(self) -> None:
+        await self.flush_clients()
+        await self.refresh_clients()
+        log.info("Status of %r", self.registry)
+
+    async def refresh_clients(self) -> None:
+        """
+        This method adds the clients saved in the database to the registry. With a heartbeat_router, only
+        the clients of the shards owned by this server are read, and the clients of the shards it does not
+        own anymore are handed over first.
+        """
+        with self.metrics.db_query_seconds.time():
+            if self.heartbeat_router is None:
+                clients_from_db = await self.db_op_manager.query_saved_clients_from_db()
+            else:
+                self.update_owned_shards()
+                clients_from_db = await self.db_op_manager.query_saved_clients_from_db(
+                    self.heartbeat_router.shard_count, self.swept_shards
                 )
+        log.info("clients_from_db = %d clients", len(clients_from_db))
+        self.registry.merge_saved_clients(clients_from_db)
+
+    @staticmethod
+    def status_targets(poll_targets: list) -> list[tuple]:
+        """
+        :param poll_targets: a list of (client_id, host, port, status_count) tuples.
+        :return: a list of (client_id, host, port, msg) tuples, the status message to send to each client.
+        """
+        return [
+            (
+                client_id,
+                host,
+                port,
+                {
+                    "type": messages.MessageType.MESSAGE_TYPE_STATUS,
+                    "message_count": status_count,
+                    "identifier": client_id,
+                },
+            )
+            for client_id, host, port, status_count in poll_targets
+        ]
 
-            # send message to all saved clients from the database
-            for client in clients_from_db:
-                log.info(client)
-                host = client.get("client_host").strip()
-                port = client.get("client_port")
-                client_id = client.get("client_identifier")
-                existing_status_count = client.get("status_count", 0)
-                log.info(f"from db: {host}{port}{client_id}")
-                # avoid sending duplicate message to client_id existing in cache and database
-                if client_id not in updated_clients_mapping:
-                    msg = {
-                        "type": messages.MessageType.MESSAGE_TYPE_STATUS,
-                        "message_count": existing_status_count,
-                        "identifier": client_id,
-                    }
-                    client_status, count = await self.send_a_message_to_client(
-                        host, port, msg
+    def record_statuses(self, results: dict) -> None:
+        """
+        :param results: a mapping of client_id to (client_status, count), see poll_clients().
+        """
+        now = time.time()
+        self.metrics.status_requests.inc(len(results))
+        history = self.status_history
+        for client_id, (client_status, count) in results.items():
+            if not client_status:
+                self.metrics.status_request_failures.inc()
+            if history is not None:
+                previous_count = self.registry.status_count(client_id)
+                if previous_count is not None:
+                    history.append(
+                        (client_id, now, client_status, count, previous_count)
                     )
-                    if client_status:
-                        updated_clients_mapping[client_id] = {
-                            "client_identifier": client_id,
-                            "is_connected": True,
-                            "client_host": host,
-                            "client_port": port,
-                            "status_count": count,
-                        }
-                        if count != existing_status_count:
-                            log.error(
-                                f"Status count for client id {client_id} is different from database and actual from "
-                                f"client "
-                            )
-                else:
-                    # this client is already communicated from active_clients_in_cache cache info
-                    if existing_status_count != updated_clients_mapping[client_id].get(
-                        "status_count"
-                    ):
-                        log.error(
-                            f"Status count for client id {client_id} is different from database and actual from client"
-                        )
-
-                log.info(f"updated_clients_mapping is {updated_clients_mapping}")
-            await self.db_op_manager.update_client_list_to_db(updated_clients_mapping)
-            await asyncio.sleep(
-                random.randint(
-                    self.query_seconds_interval_lower, self.query_seconds_interval_upper
+            if self.registry.record_status(client_id, client_status, count, now):
+                log.error(
+                    "Status count for client id %s is different from database and actual from client",
+                    client_id,
                 )
-            )
+
+    async def sweep(self) -> None:
+        """
+        This method sends a status message to all clients in the registry at once, which includes the ones
+        saved in the database.
+        Status requests are sent concurrently (see poll_clients()) and a whole sweep is bounded by
+        self.sweep_timeout_seconds.
+        Then it updates the database with the latest information from the clients.
+        """
+        log.info("send_status_request_to_clients %r", self.registry)
+        sweep_start = time.perf_counter()
+        await self.refresh_clients()
+        # every client is polled now
+        self.registry.take_unscheduled()
+        deadline = asyncio.get_event_loop().time() + self.sweep_timeout_seconds
+
+        results = await self.poll_clients(
+            self.status_targets(self.registry.poll_targets()), deadline
+        )
+        self.record_statuses(results)
+
+        log.info("Status sweep done %r", self.registry)
+        await self.flush_clients()
+        self.metrics.sweep_seconds.observe(time.perf_counter() - sweep_start)
 
     async def handle_client(
         self, client_reader: asyncio.StreamReader, client_writer: asyncio.StreamWriter
     ) -> None:
         """
-        To serve connectivity request from a client.
+        To serve connectivity request from a client. The client can send any number of heartbeat messages
+        on the connection, each one is acked in order until the client closes the connection. A gateway can
+        send the heartbeats of many clients in one BatchHeartbeat message, acked with one BatchHeartbeat.
+        With self.admission, a frame over the rate limit of the client's address is read once its token is
+        there, before it is decoded.
         :param client_reader: StreamReader object to read data from client.
         :param client_writer: StreamWriter object to write data to client.
         """
-        data = await client_reader.read(1024)
-        if not data:
-            raise Exception("socket closed")
+        log.debug("handle_client: got a new connection request")
+
+        ip = peer_ip(client_writer) if self.admission is not None else None
+        codec = None
+        if self.codec_negotiation:
+            codec = await client_reader.read(1)
+            if not codec:
+                # client closed the connection before choosing a codec
+                return
+            if codec not in self.codecs:
+                log.error("Unknown codec %r from client", codec)
+                return
 
-        log.info(f"handle_client: got a new connection request")
+        while True:
+            try:
+                data = await framing.read_frame(client_reader)
+            except framing.FrameError as e:
+                log.error("Invalid frame from client %s", e)
+                return
+            if data is None:
+                # client closed the connection
+                return
+            if ip is not None:
+                delay = self.admission.frame_delay(ip, time.monotonic())
+                if delay:
+                    self.metrics.heartbeat_frames_throttled.inc()
+                    await asyncio.sleep(delay)
 
-        deserialized_dict = self.encoder_decoder.decode_heartbeat(binary_data=data)
+            binary_data = self.ingest_heartbeat(data, codec)
+            encoded = time.perf_counter()
+            client_writer.write(framing.encode_frame(binary_data))
+            await client_writer.drain()
+            self.metrics.heartbeat_ack_seconds.observe(time.perf_counter() - encoded)
+            if self.heartbeat_writer is not None and self.heartbeat_writer.full:
+                # the next heartbeat is read once the saved ones made room for it
+                await self.heartbeat_writer.wait_for_room()
 
-        log.info(f"Received deserialized data is {deserialized_dict}")
+    def ingest_heartbeat(self, data, codec: bytes = None) -> bytes:
+        """
+        This method registers a heartbeat message, or the heartbeats of a BatchHeartbeat message, and
+        encodes the ack. It does not depend on the transport, see handle_client() and
+        heartbeat_protocol.HeartbeatProtocol. A heartbeat over the rate limit of its client in self.admission
+        is acked without being registered, with the client's cached ack and without being decoded when the
+        codec can read its identifier in place.
 
-        if deserialized_dict.get("type") == messages.MessageType.MESSAGE_TYPE_HEARTBEAT:
-            client_identifier = deserialized_dict.get("identifier")
-            client_host = deserialized_dict.get("client_host")
-            client_port = deserialized_dict.get("client_port")
-            log.info(
-                f"Client info: ip {client_host} port {client_port} identifier {client_identifier} "
-            )
-            self.active_clients_in_cache[client_identifier] = {
-                "client_host": client_host,
-                "client_port": client_port,
-                "identifier": client_identifier,
-            }
-            log.info(f"active_clients_in_cache is {self.active_clients_in_cache}")
-        else:
+        :param data: the message, bytes or a memoryview of the receive buffer.
+        :param codec: the codec byte negotiated by the connection, None for self.encoder_decoder.
+        :return: the ack message to send back.
+        """
+        start = time.perf_counter()
+        encoder_decoder, message_cache = self.codecs[codec]
+        message_type = encoder_decoder.decode_message_type(binary_data=data)
+        if message_type == messages.MESSAGE_TYPE_BATCH_HEARTBEAT:
+            return self.ingest_heartbeat_batch(data, start, encoder_decoder)
+        allowed = True
+        if self.admission is not None and self.admission.limits_clients:
+            allowed = None  # decided after decoding
+            peeked = None
+            if message_type == messages.MESSAGE_TYPE_HEARTBEAT:
+                peeked = encoder_decoder.peek_heartbeat_identifier(binary_data=data)
+            if peeked is not None:
+                allowed = self.admission.allow_heartbeat(peeked[0], time.monotonic())
+                ack = None if allowed else message_cache.cached_ack(*peeked)
+                if ack is not None:
+                    self.metrics.heartbeats.inc()
+                    self.metrics.heartbeats_coalesced.inc()
+                    return ack
+        record = encoder_decoder.decode_heartbeat_record(binary_data=data)
+        self.metrics.heartbeat_decode_seconds.observe(time.perf_counter() - start)
+
+        if record is None:
             # do nothing as we are only expecting heartbeat message. So far we do not expect any other
             # message here. In the future, we might support other message types
-            pass
-        deserialized_dict["type"] = messages.MessageType.MESSAGE_TYPE_HEARTBEAT
-        deserialized_dict["msg"] = "ack"
-        binary_data = self.encoder_decoder.encode_heartbeat(deserialized_dict)
-        client_writer.write(binary_data)
-        await client_writer.drain()
+            deserialized_dict = encoder_decoder.decode_heartbeat(binary_data=data)
+            deserialized_dict["type"] = messages.MESSAGE_TYPE_HEARTBEAT
+            deserialized_dict["msg"] = "ack"
+            return encoder_decoder.encode_heartbeat(deserialized_dict)
+
+        client_identifier = record.identifier
+        client_host = record.client_host
+        client_port = record.client_port
+        self.metrics.heartbeats.inc()
+        if allowed is None:
+            allowed = self.admission.allow_heartbeat(
+                client_identifier, time.monotonic()
+            )
+        if not allowed:
+            self.metrics.heartbeats_coalesced.inc()
+            return message_cache.ack(
+                client_identifier, client_host, client_port, record.request_id
+            )
+        log.debug(
+            "Heartbeat from client ip %s port %s identifier %s",
+            client_host,
+            client_port,
+            client_identifier,
+        )
+        if self.heartbeat_router is None or self.heartbeat_router.owns(
+            client_identifier
+        ):
+            now = time.time()
+            self.registry.heartbeat(client_identifier, client_host, client_port, now)
+            if self.heartbeat_writer is not None:
+                self.heartbeat_writer.add(
+                    client_identifier, client_host, client_port, now
+                )
+        else:
+            self.heartbeat_router.forward(
+                client_identifier, client_host, client_port, time.time()
+            )
+        start = time.perf_counter()
+        binary_data = message_cache.ack(
+            client_identifier, client_host, client_port, record.request_id
+        )
+        self.metrics.heartbeat_encode_seconds.observe(time.perf_counter() - start)
+        return binary_data
+
+    def ingest_heartbeat_batch(
+        self, data, start: float, encoder_decoder: EncodeDecodeExecutor
+    ) -> bytes:
+        """
+        This method registers the heartbeats of a BatchHeartbeat message with one registry update and acks
+        them with one BatchHeartbeat message.
+
+        :param data: the BatchHeartbeat message.
+        :param start: time.perf_counter() when decoding started.
+        :param encoder_decoder: the codec of the connection.
+        :return: the ack message to send back.
+        """
+        heartbeats = encoder_decoder.decode_heartbeat_batch(binary_data=data)
+        self.metrics.heartbeat_decode_seconds.observe(time.perf_counter() - start)
+
+        now = time.time()
+        allow_heartbeat = None
+        if self.admission is not None:
+            allow_heartbeat = self.admission.allow_heartbeat
+            monotonic = time.monotonic()
+        heartbeat_type = messages.MessageType.MESSAGE_TYPE_HEARTBEAT
+        owned = []
+        received = 0
+        for heartbeat in heartbeats:
+            is_heartbeat = heartbeat["type"] == heartbeat_type
+            # every message is acked, like in handle_client()
+            heartbeat["type"] = heartbeat_type
+            heartbeat["msg"] = "ack"
+            if not is_heartbeat:
+                continue
+            received += 1
+            client_identifier = heartbeat["identifier"]
+            if allow_heartbeat is not None and not allow_heartbeat(
+                client_identifier, monotonic
+            ):
+                self.metrics.heartbeats_coalesced.inc()
+                continue
+            if self.heartbeat_router is None or self.heartbeat_router.owns(
+                client_identifier
+            ):
+                owned.append(
+                    (
+                        client_identifier,
+                        heartbeat["client_host"],
+                        heartbeat["client_port"],
+                    )
+                )
+            else:
+                self.heartbeat_router.forward(
+                    client_identifier,
+                    heartbeat["client_host"],
+                    heartbeat["client_port"],
+                    now,
+                )
+        log.debug("Batch of %d heartbeats", len(heartbeats))
+        self.registry.heartbeat_batch(owned, now)
+        if self.heartbeat_writer is not None:
+            add = self.heartbeat_writer.add
+            for client_identifier, client_host, client_port in owned:
+                add(client_identifier, client_host, client_port, now)
+        self.metrics.heartbeats.inc(received)
+
+        start = time.perf_counter()
+        binary_data = encoder_decoder.encode_heartbeat_batch(msg_dicts=heartbeats)
+        self.metrics.heartbeat_encode_seconds.observe(time.perf_counter() - start)
+        return binary_data
@@ -0,0 +1,89 @@
+from unittest import TestCase
+
+from admission import AdmissionControl, TokenBuckets
+
+
+class TokenBucketsTestCase(TestCase):
+    def test_burst_then_rate(self):
+        buckets = TokenBuckets(rate=2, burst=3)
+        self.assertEqual(
+            [buckets.take("a", 0.0) for _ in range(4)], [True] * 3 + [False]
+        )
+        # the other keys have their own bucket
+        self.assertTrue(buckets.take("b", 0.0))
+
+        self.assertFalse(buckets.take("a", 0.25))
+        self.assertTrue(buckets.take("a", 0.5))
+        self.assertFalse(buckets.take("a", 0.5))
+        # never more than the burst
+        self.assertEqual(
+            [buckets.take("a", 100.0) for _ in range(4)], [True] * 3 + [False]
+        )
+
+    def test_reserve_goes_into_debt(self):
+        buckets = TokenBuckets(rate=10, burst=1)
+        self.assertEqual(buckets.reserve("a", 0.0), 0.0)
+        self.assertAlmostEqual(buckets.reserve("a", 0.0), 0.1)
+        self.assertAlmostEqual(buckets.reserve("a", 0.0), 0.2)
+        # the reserved tokens are paid back first
+        self.assertFalse(buckets.take("a", 0.15))
+        self.assertTrue(buckets.take("a", 0.3))
+
+    def test_keys_are_bounded(self):
+        buckets = TokenBuckets(rate=1, burst=1, max_keys=10)
+        for key in range(25):
+            buckets.take(key, 0.0)
+        self.assertLessEqual(len(buckets), 10)
+
+    def test_limited_keys_keep_their_bucket(self):
+        buckets = TokenBuckets(rate=1, burst=2, max_keys=100)
+        self.assertTrue(buckets.take("storm", 0.0))
+        self.assertTrue(buckets.take("storm", 0.0))
+        # a storm of new keys, the limited key keeps being used
+        for key in range(1000):
+            self.assertFalse(buckets.take("storm", 0.0))
+            buckets.take(key, 0.0)
+        self.assertLessEqual(len(buckets), 100)
+        self.assertFalse(buckets.take("storm", 0.5))
+
+        # the buckets which are full again are dropped first
+        buckets = TokenBuckets(rate=1, burst=2, max_keys=10)
+        buckets.take("idle", 0.0)
+        for key in range(9):
+            buckets.take(key, 5.0)
+            buckets.take(key, 5.0)
+        buckets.take("new", 5.0)
+        self.assertNotIn("idle", buckets.buckets)
+        self.assertEqual(len(buckets), 10)
+
+
+class AdmissionControlTestCase(TestCase):
+    def test_disabled_limits(self):
+        admission = AdmissionControl()
+        self.assertTrue(
+            all(admission.admit(connections, 0.0) for connections in range(1000))
+        )
+        self.assertEqual(admission.frame_delay("10.0.0.1", 0.0), 0.0)
+        self.assertTrue(all(admission.allow_heartbeat(1, 0.0) for _ in range(1000)))
+
+    def test_connections(self):
+        admission = AdmissionControl(max_connections=10, accept_rate=1, accept_burst=2)
+        self.assertFalse(admission.admit(10, 0.0))
+        self.assertTrue(admission.admit(0, 0.0))
+        self.assertTrue(admission.admit(1, 0.0))
+        self.assertFalse(admission.admit(2, 0.5))
+        self.assertTrue(admission.admit(2, 1.0))
+
+    def test_heartbeats(self):
+        admission = AdmissionControl(
+            ip_rate=10, ip_burst=1, client_rate=1, client_burst=1
+        )
+        self.assertEqual(admission.frame_delay("10.0.0.1", 0.0), 0.0)
+        self.assertGreater(admission.frame_delay("10.0.0.1", 0.0), 0.0)
+        # unix sockets have no address
+        self.assertEqual(admission.frame_delay(None, 0.0), 0.0)
+
+        self.assertTrue(admission.allow_heartbeat(1, 0.0))
+        self.assertFalse(admission.allow_heartbeat(1, 0.5))
+        self.assertTrue(admission.allow_heartbeat(2, 0.5))
+        self.assertTrue(admission.allow_heartbeat(1, 1.0))
@@ -1,17 +1,93 @@
+import asyncio
+import math
+import os
 import socket
+import tempfile
+import time
 import uvloop
-from unittest import TestCase
+from unittest import TestCase, mock
 
+from admission import AdmissionControl
 from db_operations import AsyncPgPostgresManager
 from encode_decode_executor import EncodeDecodeExecutor
+from json_encoder_decoder import JsonEncoderDecoder
+import framing
 from loop_runner import LoopRunner
 from protobuf_encode_decoder import ProtobufEncoderDecoder
-from server import Server
+from scheduler import TimingWheel
+import server as server_module
+from server import Server, log_task_failure
 import messages_pb2 as messages
+from test_write_behind import HeartbeatStore
+from workers import HeartbeatRouter
+from write_behind import HeartbeatWriteBehind
 
 TESTING_PORT = 8888
 
 
+class ClientStore:
+    """
+    The client operations of AsyncPgPostgresManager on a dictionary.
+    """
+
+    def __init__(self):
+        self.clients = {}
+        self.status_history = []
+        self.failing = False
+
+    async def query_saved_clients_from_db(self, shard_count=1, shards=None):
+        return list(self.clients.values())
+
+    async def update_changed_clients_to_db(self, changed_clients, removed_client_ids):
+        self.clients.update(changed_clients)
+        for client_id in removed_client_ids:
+            self.clients.pop(client_id, None)
+        return True
+
+    async def save_status_history(self, statuses):
+        if self.failing:
+            return False
+        self.status_history.extend(statuses)
+        return True
+
+
+class ShardRouter:
+    """
+    A cluster.ShardCluster whose shards are set by the test.
+    """
+
+    def __init__(self, shard_count: int, shards: frozenset):
+        self.shard_count = shard_count
+        self.shards = shards
+        self.forwarded = []
+
+    def owned_shards(self) -> frozenset:
+        return self.shards
+
+    def owns(self, identifier: int) -> bool:
+        return identifier % self.shard_count in self.shards
+
+    def forward(self, identifier: int, host: str, port: int, now: float) -> None:
+        self.forwarded.append(identifier)
+
+    def start(self, registry, heartbeat_writer=None) -> None:
+        pass
+
+
+def recv_frame(sock: socket.socket) -> bytes:
+    length, shift = 0, 0
+    while True:
+        byte = sock.recv(1)[0]
+        length |= (byte & 0x7F) << shift
+        shift += 7
+        if not byte & 0x80:
+            break
+    data = b""
+    while len(data) < length:
+        data += sock.recv(length - len(data))
+    return data
+
+
 class TestServer(TestCase):
     def setUp(self):
         db_host = "0.0.0.0"
@@ -65,9 +141,9 @@ class TestServer(TestCase):
             "identifier": 4567,
         }
         protobuf_binary_data = self.encoder_decoder.encode_heartbeat(msg_dict=msg)
-        sock.send(protobuf_binary_data)
+        sock.send(framing.encode_frame(protobuf_binary_data))
 
-        data = sock.recv(1000)
+        data = recv_frame(sock)
         decoded_data = self.encoder_decoder.decode_heartbeat(binary_data=data)
 
         self.assertEqual(
@@ -78,7 +154,864 @@ class TestServer(TestCase):
                 "identifier": 4567,
                 "msg": "ack",
                 "type": messages.MessageType.MESSAGE_TYPE_HEARTBEAT,
+                "request_id": 0,
             },
         )
 
         sock.close()
+
+    def test_poll_clients_concurrently(self):
+        server = Server(
+            encoder_decoder=self.encoder_decoder,
+            db_op_manager=self.db_op_manager,
+            query_seconds_interval_lower=self.query_seconds_interval_lower,
+            query_seconds_interval_upper=self.query_seconds_interval_upper,
+            server_ip="localhost",
+            loop=self.loop,
+            server_port=TESTING_PORT,
+            client_timeout_seconds=0.5,
+        )
+
+        async def answering_client(reader, writer):
+            data = await framing.read_frame(reader)
+            status = self.encoder_decoder.decode_status(binary_data=data)
+            status["message_count"] = 7
+            status_data = self.encoder_decoder.encode_status(msg_dict=status)
+            writer.write(framing.encode_frame(status_data))
+            await writer.drain()
+            await framing.read_frame(reader)  # ack
+            writer.close()
+
+        async def silent_client(reader, writer):
+            await framing.read_frame(reader)
+            await reader.read()  # never answers, waits for the server to hang up
+
+        async def poll():
+            responders = [
+                await asyncio.start_server(
+                    answering_client, "localhost", TESTING_PORT + 2
+                ),
+                await asyncio.start_server(
+                    silent_client, "localhost", TESTING_PORT + 3
+                ),
+            ]
+            msg = {"type": messages.MessageType.MESSAGE_TYPE_STATUS, "message_count": 0}
+            targets = [
+                (1, "localhost", TESTING_PORT + 2, dict(msg, identifier=1)),
+                (2, "localhost", TESTING_PORT + 3, dict(msg, identifier=2)),
+                (3, "localhost", TESTING_PORT + 2, dict(msg, identifier=3)),
+            ]
+            started = self.loop.time()
+            results = await server.poll_clients(targets, started + 10)
+            elapsed = self.loop.time() - started
+            for responder in responders:
+                responder.close()
+            return results, elapsed
+
+        results, elapsed = self.runner.run_coroutine(poll())
+
+        self.assertEqual(results, {1: (True, 7), 2: (False, 0), 3: (True, 7)})
+        # the silent client only costs its own read deadline
+        self.assertLess(elapsed, 2)
+
+    def test_clients_are_polled_on_their_own_schedule(self):
+        server = Server(
+            encoder_decoder=self.encoder_decoder,
+            db_op_manager=ClientStore(),
+            query_seconds_interval_lower=1,
+            query_seconds_interval_upper=1,
+            server_ip="localhost",
+            loop=self.loop,
+            server_port=TESTING_PORT,
+            client_timeout_seconds=0.5,
+            poll_tick_seconds=0.05,
+        )
+        polls = []
+
+        async def client(reader, writer):
+            while True:
+                data = await framing.read_frame(reader)
+                if data is None:
+                    break
+                status = self.encoder_decoder.decode_status(binary_data=data)
+                polls.append(status["identifier"])
+                status_data = self.encoder_decoder.encode_status(msg_dict=status)
+                writer.write(framing.encode_frame(status_data))
+                await writer.drain()
+                await framing.read_frame(reader)  # ack
+            writer.close()
+
+        async def run():
+            responder = await asyncio.start_server(
+                client, "localhost", TESTING_PORT + 8
+            )
+            for client_id in (1, 2):
+                server.registry.heartbeat(
+                    client_id, "localhost", TESTING_PORT + 8, time.time()
+                )
+            scheduler = asyncio.ensure_future(server.send_status_request_to_clients())
+            await asyncio.sleep(2.6)
+            scheduled_polls = len(server.poll_wheel)
+            scheduler.cancel()
+            server.client_connections.close()
+            responder.close()
+            return scheduled_polls
+
+        scheduled_polls = self.runner.run_coroutine(run())
+
+        # first poll within a second, then one per second
+        self.assertIn(polls.count(1), (2, 3))
+        self.assertIn(polls.count(2), (2, 3))
+        self.assertEqual(scheduled_polls, 2)
+        self.assertEqual(server.metrics.status_requests.value, len(polls))
+        # every round of status requests is timed
+        self.assertGreaterEqual(sum(server.metrics.sweep_seconds.counts), 2)
+
+    def test_clients_are_rescheduled_after_a_failed_round(self):
+        server = Server(
+            encoder_decoder=self.encoder_decoder,
+            db_op_manager=ClientStore(),
+            query_seconds_interval_lower=1,
+            query_seconds_interval_upper=1,
+            server_ip="localhost",
+            loop=self.loop,
+            server_port=TESTING_PORT,
+            poll_tick_seconds=0.05,
+        )
+        for client_id in (1, 2):
+            server.registry.heartbeat(
+                client_id, "localhost", TESTING_PORT + 9, time.time()
+            )
+
+        async def fail(status_targets, deadline):
+            raise RuntimeError("poll failed")
+
+        server.poll_clients = fail
+
+        async def run():
+            server.poll_wheel = TimingWheel(0.05, 60, self.loop.time())
+            targets = server.registry.due_poll_targets((1, 2), math.inf)
+            with self.assertRaises(RuntimeError):
+                await server.poll_due_clients(targets)
+            return len(server.poll_wheel)
+
+        self.assertEqual(self.runner.run_coroutine(run()), 2)
+        self.assertTrue(
+            all(deadline < math.inf for deadline in server.registry.next_poll)
+        )
+
+    def test_lost_shards_are_handed_over_at_the_next_tick(self):
+        router = ShardRouter(2, frozenset((0, 1)))
+        server = Server(
+            encoder_decoder=self.encoder_decoder,
+            db_op_manager=ClientStore(),
+            query_seconds_interval_lower=60,
+            query_seconds_interval_upper=60,
+            server_ip="localhost",
+            loop=self.loop,
+            server_port=TESTING_PORT,
+            poll_tick_seconds=0.05,
+            heartbeat_router=router,
+        )
+        for client_id in range(1, 5):
+            server.registry.heartbeat(
+                client_id, "localhost", TESTING_PORT + 9, time.time()
+            )
+
+        async def run():
+            scheduler = asyncio.ensure_future(server.send_status_request_to_clients())
+            await asyncio.sleep(0.1)
+            router.shards = frozenset((0,))
+            await asyncio.sleep(0.1)
+            scheduler.cancel()
+
+        self.runner.run_coroutine(run())
+
+        # long before the next refresh
+        self.assertEqual(sorted(server.registry.index), [2, 4])
+        self.assertEqual(sorted(router.forwarded), [1, 3])
+        self.assertEqual(server.swept_shards, frozenset((0,)))
+
+    def test_background_task_failures_are_logged(self):
+        async def fail():
+            raise RuntimeError("database unavailable")
+
+        async def run():
+            task = asyncio.ensure_future(fail())
+            task.add_done_callback(log_task_failure)
+            await asyncio.sleep(0.01)
+
+        with self.assertLogs("__main__.server", "ERROR") as logs:
+            self.runner.run_coroutine(run())
+        self.assertIn("database unavailable", logs.output[0])
+
+    def test_many_heartbeats_on_one_connection(self):
+        server = Server(
+            encoder_decoder=self.encoder_decoder,
+            db_op_manager=self.db_op_manager,
+            query_seconds_interval_lower=self.query_seconds_interval_lower,
+            query_seconds_interval_upper=self.query_seconds_interval_upper,
+            server_ip="localhost",
+            loop=self.loop,
+            server_port=TESTING_PORT + 1,
+        )
+
+        self.runner.run_coroutine(server.start_server())
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.connect(("localhost", TESTING_PORT + 1))
+
+        frames = b""
+        for identifier in range(3):
+            msg = {
+                "type": messages.MessageType.MESSAGE_TYPE_HEARTBEAT,
+                "msg": "Heartbeat",
+                "client_host": "localhost",
+                "client_port": 1000 + identifier,
+                "identifier": identifier,
+            }
+            frames += framing.encode_frame(
+                self.encoder_decoder.encode_heartbeat(msg_dict=msg)
+            )
+        # the heartbeats arrive in segments which do not match the frames
+        for start in range(0, len(frames), 7):
+            sock.sendall(frames[start : start + 7])
+
+        for identifier in range(3):
+            decoded_data = self.encoder_decoder.decode_heartbeat(
+                binary_data=recv_frame(sock)
+            )
+            self.assertEqual(decoded_data["identifier"], identifier)
+            self.assertEqual(decoded_data["msg"], "ack")
+
+        sock.close()
+        self.assertEqual(len(server.registry), 3)
+        self.assertEqual(server.registry.get(2)["client_port"], 1002)
+        self.assertEqual(server.metrics.heartbeats.value, 3)
+        self.assertEqual(sum(server.metrics.heartbeat_decode_seconds.counts), 3)
+
+    def test_protocol_transport(self):
+        server = Server(
+            encoder_decoder=self.encoder_decoder,
+            db_op_manager=self.db_op_manager,
+            query_seconds_interval_lower=self.query_seconds_interval_lower,
+            query_seconds_interval_upper=self.query_seconds_interval_upper,
+            server_ip="localhost",
+            loop=self.loop,
+            server_port=TESTING_PORT + 13,
+            transport="protocol",
+        )
+
+        self.runner.run_coroutine(server.start_server())
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.connect(("localhost", TESTING_PORT + 13))
+
+        msgs = [
+            {
+                "type": messages.MessageType.MESSAGE_TYPE_HEARTBEAT,
+                "msg": "Heartbeat",
+                "client_host": "localhost",
+                "client_port": 1000 + identifier,
+                "identifier": identifier,
+                "request_id": 0,
+            }
+            for identifier in range(3)
+        ]
+        frames = b"".join(
+            framing.encode_frame(self.encoder_decoder.encode_heartbeat(msg_dict=msg))
+            for msg in msgs
+        )
+        frames += framing.encode_frame(
+            self.encoder_decoder.encode_heartbeat_batch(msgs)
+        )
+        # the heartbeats arrive in segments which do not match the frames
+        for start in range(0, len(frames), 7):
+            sock.sendall(frames[start : start + 7])
+
+        for identifier in range(3):
+            decoded_data = self.encoder_decoder.decode_heartbeat(
+                binary_data=recv_frame(sock)
+            )
+            self.assertEqual(decoded_data["identifier"], identifier)
+            self.assertEqual(decoded_data["msg"], "ack")
+        acks = self.encoder_decoder.decode_heartbeat_batch(binary_data=recv_frame(sock))
+        self.assertEqual(acks, [dict(msg, msg="ack") for msg in msgs])
+        self.assertEqual(len(server.clients), 1)
+
+        # an invalid frame closes the connection
+        sock.sendall(b"\xff" * 11)
+        self.assertEqual(sock.recv(1), b"")
+        sock.close()
+        self.assertEqual(len(server.registry), 3)
+        self.assertEqual(server.registry.get(2)["client_port"], 1002)
+        self.assertEqual(server.metrics.heartbeats.value, 6)
+
+    def test_codec_negotiation(self):
+        json_encoder_decoder = EncodeDecodeExecutor(JsonEncoderDecoder())
+        codecs = {b"P": self.encoder_decoder, b"J": json_encoder_decoder}
+        for port, transport in (
+            (TESTING_PORT + 14, "stream"),
+            (TESTING_PORT + 15, "protocol"),
+        ):
+            server = Server(
+                encoder_decoder=self.encoder_decoder,
+                db_op_manager=self.db_op_manager,
+                query_seconds_interval_lower=self.query_seconds_interval_lower,
+                query_seconds_interval_upper=self.query_seconds_interval_upper,
+                server_ip="localhost",
+                loop=self.loop,
+                server_port=port,
+                transport=transport,
+                negotiated_codecs=codecs,
+            )
+            self.runner.run_coroutine(server.start_server())
+
+            for identifier, (codec, encoder_decoder) in enumerate(codecs.items()):
+                sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+                sock.connect(("localhost", port))
+                msg = {
+                    "type": messages.MessageType.MESSAGE_TYPE_HEARTBEAT,
+                    "msg": "Heartbeat",
+                    "client_host": "localhost",
+                    "client_port": 1000,
+                    "identifier": identifier,
+                }
+                sock.sendall(
+                    codec + framing.encode_frame(encoder_decoder.encode_heartbeat(msg))
+                )
+                ack = encoder_decoder.decode_heartbeat(binary_data=recv_frame(sock))
+                self.assertEqual(ack, dict(msg, msg="ack", request_id=0), transport)
+                sock.close()
+
+            # an unknown codec closes the connection
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.connect(("localhost", port))
+            sock.sendall(b"X")
+            self.assertEqual(sock.recv(1), b"", transport)
+            sock.close()
+            self.assertEqual(len(server.registry), 2, transport)
+
+    def test_closing_before_the_codec_is_not_an_error(self):
+        server = Server(
+            encoder_decoder=self.encoder_decoder,
+            db_op_manager=self.db_op_manager,
+            query_seconds_interval_lower=self.query_seconds_interval_lower,
+            query_seconds_interval_upper=self.query_seconds_interval_upper,
+            server_ip="localhost",
+            loop=self.loop,
+            server_port=TESTING_PORT,
+            negotiated_codecs={b"P": self.encoder_decoder},
+        )
+
+        async def close_at_once():
+            client_reader = asyncio.StreamReader()
+            client_reader.feed_eof()
+            await server.handle_client(client_reader, None)
+
+        with mock.patch.object(server_module.log, "error") as error:
+            self.runner.run_coroutine(close_at_once())
+        error.assert_not_called()
+
+    def test_heartbeats_are_written_behind(self):
+        for port, transport in (
+            (TESTING_PORT + 16, "stream"),
+            (TESTING_PORT + 17, "protocol"),
+        ):
+            store = HeartbeatStore()
+            heartbeat_writer = HeartbeatWriteBehind(
+                store, batch_size=5, flush_interval_seconds=0.05, max_pending=10
+            )
+            server = Server(
+                encoder_decoder=self.encoder_decoder,
+                db_op_manager=self.db_op_manager,
+                query_seconds_interval_lower=self.query_seconds_interval_lower,
+                query_seconds_interval_upper=self.query_seconds_interval_upper,
+                server_ip="localhost",
+                loop=self.loop,
+                server_port=port,
+                transport=transport,
+                heartbeat_writer=heartbeat_writer,
+            )
+            self.runner.run_coroutine(server.start_server())
+
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.connect(("localhost", port))
+            for identifier in range(30):
+                msg = {
+                    "type": messages.MessageType.MESSAGE_TYPE_HEARTBEAT,
+                    "msg": "Heartbeat",
+                    "client_host": "localhost",
+                    "client_port": 1000 + identifier,
+                    "identifier": identifier,
+                }
+                sock.sendall(
+                    framing.encode_frame(self.encoder_decoder.encode_heartbeat(msg))
+                )
+                recv_frame(sock)
+            sock.close()
+
+            self.assertTrue(self.runner.run_coroutine(heartbeat_writer.close()))
+            # the connection waited for room instead of dropping heartbeats
+            self.assertEqual(heartbeat_writer.dropped, 0, transport)
+            self.assertEqual(len(store.heartbeats), 30, transport)
+            self.assertEqual(store.heartbeats[7][:2], ("localhost", 1007), transport)
+
+    def test_admission_control(self):
+        for port, transport in (
+            (TESTING_PORT + 18, "stream"),
+            (TESTING_PORT + 19, "protocol"),
+        ):
+            server = Server(
+                encoder_decoder=self.encoder_decoder,
+                db_op_manager=self.db_op_manager,
+                query_seconds_interval_lower=self.query_seconds_interval_lower,
+                query_seconds_interval_upper=self.query_seconds_interval_upper,
+                server_ip="localhost",
+                loop=self.loop,
+                server_port=port,
+                transport=transport,
+                admission=AdmissionControl(
+                    max_connections=1,
+                    ip_rate=50,
+                    ip_burst=5,
+                    client_rate=0.1,
+                    client_burst=1,
+                ),
+            )
+            self.runner.run_coroutine(server.start_server())
+
+            sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            sock.connect(("localhost", port))
+            start = time.perf_counter()
+            for port_offset in range(10):
+                msg = {
+                    "type": messages.MessageType.MESSAGE_TYPE_HEARTBEAT,
+                    "msg": "Heartbeat",
+                    "client_host": "localhost",
+                    "client_port": 1000 + port_offset,
+                    "identifier": 7,
+                }
+                sock.sendall(
+                    framing.encode_frame(self.encoder_decoder.encode_heartbeat(msg))
+                )
+                ack = self.encoder_decoder.decode_heartbeat(recv_frame(sock))
+                # every heartbeat is acked, the coalesced ones with the ack of the registered one
+                self.assertEqual(ack["identifier"], 7, transport)
+                self.assertEqual(ack["client_port"], 1000, transport)
+            # 5 frames over the burst at 50 per second
+            self.assertGreater(time.perf_counter() - start, 0.08, transport)
+            self.assertGreater(
+                server.metrics.heartbeat_frames_throttled.value, 0, transport
+            )
+
+            # the later heartbeats were coalesced with the first one, without being decoded
+            self.assertEqual(
+                sum(server.metrics.heartbeat_decode_seconds.counts), 1, transport
+            )
+            self.assertEqual(server.metrics.heartbeats.value, 10, transport)
+            self.assertEqual(server.metrics.heartbeats_coalesced.value, 9, transport)
+            self.assertEqual(server.registry.get(7)["client_port"], 1000, transport)
+
+            # over max_connections
+            second_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            second_sock.connect(("localhost", port))
+            self.assertEqual(second_sock.recv(1), b"", transport)
+            second_sock.close()
+            sock.close()
+            self.assertEqual(server.metrics.connections_rejected.value, 1, transport)
+
+    def test_registry_snapshot(self):
+        with tempfile.TemporaryDirectory() as directory:
+            servers = [
+                Server(
+                    encoder_decoder=self.encoder_decoder,
+                    db_op_manager=self.db_op_manager,
+                    query_seconds_interval_lower=self.query_seconds_interval_lower,
+                    query_seconds_interval_upper=self.query_seconds_interval_upper,
+                    server_ip="localhost",
+                    loop=self.loop,
+                    server_port=TESTING_PORT,
+                    snapshot_path=os.path.join(directory, "registry.bin"),
+                )
+                for _ in range(2)
+            ]
+            for identifier in range(10):
+                servers[0].registry.heartbeat(
+                    identifier, "localhost", 1000 + identifier, time.time()
+                )
+            self.assertTrue(self.runner.run_coroutine(servers[0].save_snapshot()))
+
+            # after a restart
+            self.assertEqual(servers[1].load_snapshot(), 10)
+            self.assertEqual(servers[1].registry.get(7)["client_port"], 1007)
+            self.assertEqual(sum(servers[1].metrics.snapshot_seconds.counts), 0)
+            self.assertEqual(sum(servers[0].metrics.snapshot_seconds.counts), 1)
+
+    def test_status_history(self):
+        store = ClientStore()
+        server = Server(
+            encoder_decoder=self.encoder_decoder,
+            db_op_manager=store,
+            query_seconds_interval_lower=self.query_seconds_interval_lower,
+            query_seconds_interval_upper=self.query_seconds_interval_upper,
+            server_ip="localhost",
+            loop=self.loop,
+            server_port=TESTING_PORT,
+            status_history=True,
+            status_history_max_rows=3,
+        )
+        for identifier in range(3):
+            server.registry.heartbeat(identifier, "localhost", 1000, time.time())
+        server.record_statuses({0: (True, 5), 1: (False, 0), 99: (True, 1)})
+        server.record_statuses({0: (True, 6)})
+
+        store.failing = True
+        self.runner.run_coroutine(server.flush_clients())
+        self.assertEqual(len(server.status_history), 3)
+
+        # the oldest rows are dropped beyond status_history_max_rows
+        server.record_statuses({2: (True, 1)})
+        self.runner.run_coroutine(server.flush_clients())
+        self.assertEqual(server.metrics.status_history_dropped.value, 1)
+
+        store.failing = False
+        self.runner.run_coroutine(server.flush_clients())
+        self.assertEqual(server.status_history, [])
+        self.assertEqual(
+            [(client_id, *row[1:]) for client_id, *row in store.status_history],
+            [(1, False, 0, 0), (0, True, 6, 5), (2, True, 1, 0)],
+        )
+
+        server = Server(
+            encoder_decoder=self.encoder_decoder,
+            db_op_manager=self.db_op_manager,
+            query_seconds_interval_lower=self.query_seconds_interval_lower,
+            query_seconds_interval_upper=self.query_seconds_interval_upper,
+            server_ip="localhost",
+            loop=self.loop,
+            server_port=TESTING_PORT + 11,
+        )
+
+        self.runner.run_coroutine(server.start_server())
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.connect(("localhost", TESTING_PORT + 11))
+
+        heartbeats = [
+            {
+                "type": messages.MessageType.MESSAGE_TYPE_HEARTBEAT,
+                "msg": "Heartbeat",
+                "client_host": "localhost",
+                "client_port": 1000 + identifier,
+                "identifier": identifier,
+                "request_id": identifier + 1,
+            }
+            for identifier in range(100)
+        ]
+        # a message which is not a heartbeat is acked without being counted
+        heartbeats.append(
+            dict(
+                heartbeats[-1],
+                type=messages.MessageType.MESSAGE_TYPE_STATUS,
+                identifier=100,
+            )
+        )
+        sock.sendall(
+            framing.encode_frame(
+                self.encoder_decoder.encode_heartbeat_batch(heartbeats)
+            )
+        )
+
+        # one ack for the whole batch
+        acks = self.encoder_decoder.decode_heartbeat_batch(binary_data=recv_frame(sock))
+        self.assertEqual(
+            acks,
+            [
+                dict(msg, type=messages.MessageType.MESSAGE_TYPE_HEARTBEAT, msg="ack")
+                for msg in heartbeats
+            ],
+        )
+
+        sock.close()
+        self.assertEqual(len(server.registry), 100)
+        self.assertEqual(server.registry.get(42)["client_port"], 1042)
+        self.assertEqual(server.metrics.heartbeats.value, 100)
+        self.assertEqual(sum(server.metrics.heartbeat_decode_seconds.counts), 1)
+
+    def test_batched_status_requests(self):
+        server = Server(
+            encoder_decoder=self.encoder_decoder,
+            db_op_manager=self.db_op_manager,
+            query_seconds_interval_lower=self.query_seconds_interval_lower,
+            query_seconds_interval_upper=self.query_seconds_interval_upper,
+            server_ip="localhost",
+            loop=self.loop,
+            server_port=TESTING_PORT,
+            client_timeout_seconds=0.5,
+            batch_status_requests=True,
+        )
+        frames = []
+
+        async def gateway(reader, writer):
+            data = await framing.read_frame(reader)
+            frames.append(data)
+            statuses = self.encoder_decoder.decode_status_batch(binary_data=data)
+            # client 3 is not behind the gateway anymore
+            replies = [
+                dict(status, message_count=status["identifier"] * 10)
+                for status in reversed(statuses)
+                if status["identifier"] != 3
+            ]
+            writer.write(
+                framing.encode_frame(self.encoder_decoder.encode_status_batch(replies))
+            )
+            await writer.drain()
+            frames.append(await framing.read_frame(reader))  # ack
+            writer.close()
+
+        async def poll():
+            responder = await asyncio.start_server(
+                gateway, "localhost", TESTING_PORT + 12
+            )
+            msg = {"type": messages.MessageType.MESSAGE_TYPE_STATUS, "message_count": 0}
+            targets = [
+                (
+                    client_id,
+                    "localhost",
+                    TESTING_PORT + 12,
+                    dict(msg, identifier=client_id),
+                )
+                for client_id in (1, 2, 3)
+            ]
+            results = await server.poll_clients(targets, self.loop.time() + 10)
+            responder.close()
+            return results
+
+        results = self.runner.run_coroutine(poll())
+
+        self.assertEqual(results, {1: (True, 10), 2: (True, 20), 3: (False, 0)})
+        # one request and one ack
+        self.assertEqual(len(frames), 2)
+        acks = self.encoder_decoder.decode_heartbeat_batch(binary_data=frames[1])
+        self.assertEqual(
+            [(ack["identifier"], ack["request_id"], ack["msg"]) for ack in acks],
+            [(2, 2, "ack"), (1, 1, "ack")],
+        )
+
+    def test_status_requests_reuse_connections(self):
+        server = Server(
+            encoder_decoder=self.encoder_decoder,
+            db_op_manager=self.db_op_manager,
+            query_seconds_interval_lower=self.query_seconds_interval_lower,
+            query_seconds_interval_upper=self.query_seconds_interval_upper,
+            server_ip="localhost",
+            loop=self.loop,
+            server_port=TESTING_PORT,
+            client_timeout_seconds=0.5,
+        )
+        connections = []
+
+        async def client(reader, writer, hang_up):
+            connections.append(writer)
+            while True:
+                data = await framing.read_frame(reader)
+                if data is None:
+                    break
+                status = self.encoder_decoder.decode_status(binary_data=data)
+                status["message_count"] = len(connections)
+                status_data = self.encoder_decoder.encode_status(msg_dict=status)
+                writer.write(framing.encode_frame(status_data))
+                await writer.drain()
+                await framing.read_frame(reader)  # ack
+                if hang_up:
+                    break
+            writer.close()
+
+        async def poll(port, hang_up):
+            connections.clear()
+            responder = await asyncio.start_server(
+                lambda reader, writer: client(reader, writer, hang_up),
+                "localhost",
+                port,
+            )
+            msg = {
+                "type": messages.MessageType.MESSAGE_TYPE_STATUS,
+                "message_count": 0,
+                "identifier": 1,
+            }
+            results = []
+            for _ in range(3):
+                results.append(
+                    await server.send_a_message_to_client("localhost", port, msg)
+                )
+                await asyncio.sleep(0.05)
+            server.client_connections.close()
+            responder.close()
+            return results
+
+        # the connection stays open between status requests
+        results = self.runner.run_coroutine(poll(TESTING_PORT + 4, hang_up=False))
+        self.assertEqual(results, [(True, 1)] * 3)
+        self.assertEqual(len(connections), 1)
+
+        # a client which hangs up is reconnected transparently
+        results = self.runner.run_coroutine(poll(TESTING_PORT + 5, hang_up=True))
+        self.assertEqual(results, [(True, 1), (True, 2), (True, 3)])
+        self.assertEqual(sum(server.metrics.client_connect_seconds.counts), 4)
+        self.assertEqual(sum(server.metrics.status_rtt_seconds.counts), 6)
+
+    def test_timeouts_of_reused_connections_are_not_retried(self):
+        server = Server(
+            encoder_decoder=self.encoder_decoder,
+            db_op_manager=self.db_op_manager,
+            query_seconds_interval_lower=self.query_seconds_interval_lower,
+            query_seconds_interval_upper=self.query_seconds_interval_upper,
+            server_ip="localhost",
+            loop=self.loop,
+            server_port=TESTING_PORT,
+        )
+        acquired = []
+
+        async def acquire(host, port, connect_timeout):
+            acquired.append((host, port))
+            return None, None, True
+
+        server.client_connections.acquire = acquire
+        server.client_connections.release = lambda *args, **kwargs: None
+
+        class Timeout(asyncio.TimeoutError, OSError):
+            # what asyncio.TimeoutError is since Python 3.11
+            pass
+
+        async def exchange(client_reader, client_writer):
+            raise Timeout()
+
+        with self.assertRaises(asyncio.TimeoutError):
+            self.runner.run_coroutine(
+                server.with_client_connection("localhost", TESTING_PORT + 9, exchange)
+            )
+        self.assertEqual(len(acquired), 1)
+
+    def test_pipelined_status_requests(self):
+        server = Server(
+            encoder_decoder=self.encoder_decoder,
+            db_op_manager=self.db_op_manager,
+            query_seconds_interval_lower=self.query_seconds_interval_lower,
+            query_seconds_interval_upper=self.query_seconds_interval_upper,
+            server_ip="localhost",
+            loop=self.loop,
+            server_port=TESTING_PORT,
+            client_timeout_seconds=0.5,
+            pipeline_status_requests=True,
+        )
+        connections = []
+        acks = []
+
+        async def relay(reader, writer):
+            # a relay fronting many identifiers answers once it has all requests, in reverse order
+            connections.append(writer)
+            requests = [
+                self.encoder_decoder.decode_status(
+                    binary_data=await framing.read_frame(reader)
+                )
+                for _ in range(3)
+            ]
+            for status in reversed(requests):
+                status["message_count"] = status["identifier"] * 10
+                status_data = self.encoder_decoder.encode_status(msg_dict=status)
+                writer.write(framing.encode_frame(status_data))
+            await writer.drain()
+            for _ in range(3):
+                ack = self.encoder_decoder.decode_heartbeat(
+                    binary_data=await framing.read_frame(reader)
+                )
+                acks.append((ack["identifier"], ack["request_id"]))
+            writer.close()
+
+        async def poll():
+            responder = await asyncio.start_server(relay, "localhost", TESTING_PORT + 6)
+            targets = [
+                (
+                    client_id,
+                    "localhost",
+                    TESTING_PORT + 6,
+                    {
+                        "type": messages.MessageType.MESSAGE_TYPE_STATUS,
+                        "message_count": 0,
+                        "identifier": client_id,
+                    },
+                )
+                for client_id in (1, 2, 3)
+            ]
+            results = await server.poll_clients(targets, self.loop.time() + 10)
+            server.client_connections.close()
+            responder.close()
+            return results
+
+        results = self.runner.run_coroutine(poll())
+
+        self.assertEqual(results, {1: (True, 10), 2: (True, 20), 3: (True, 30)})
+        self.assertEqual(len(connections), 1)
+        self.assertEqual(acks, [(3, 3), (2, 2), (1, 1)])
+
+    def test_heartbeats_are_routed_to_the_owning_worker(self):
+        inboxes = []
+        for _ in range(2):
+            receiving_socket, sending_socket = socket.socketpair(
+                socket.AF_UNIX, socket.SOCK_DGRAM
+            )
+            receiving_socket.setblocking(False)
+            sending_socket.setblocking(False)
+            inboxes.append((receiving_socket, sending_socket))
+        heartbeat_writers = [
+            HeartbeatWriteBehind(HeartbeatStore(), flush_interval_seconds=3600)
+            for _ in range(2)
+        ]
+        workers = [
+            Server(
+                encoder_decoder=self.encoder_decoder,
+                db_op_manager=self.db_op_manager,
+                query_seconds_interval_lower=self.query_seconds_interval_lower,
+                query_seconds_interval_upper=self.query_seconds_interval_upper,
+                server_ip="localhost",
+                loop=self.loop,
+                server_port=TESTING_PORT + 7,
+                reuse_port=True,
+                heartbeat_router=HeartbeatRouter(worker_index, inboxes),
+                heartbeat_writer=heartbeat_writers[worker_index],
+            )
+            for worker_index in range(2)
+        ]
+        for worker in workers:
+            self.runner.run_coroutine(worker.start_server())
+
+        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        sock.connect(("localhost", TESTING_PORT + 7))
+        for identifier in range(1, 5):
+            msg = {
+                "type": messages.MessageType.MESSAGE_TYPE_HEARTBEAT,
+                "msg": "Heartbeat",
+                "client_host": "localhost",
+                "client_port": 1000 + identifier,
+                "identifier": identifier,
+            }
+            sock.sendall(
+                framing.encode_frame(
+                    self.encoder_decoder.encode_heartbeat(msg_dict=msg)
+                )
+            )
+            recv_frame(sock)
+        sock.close()
+        self.runner.run_coroutine(asyncio.sleep(0.05))
+
+        # whichever worker accepted the connection, every client is registered by its owner only
+        self.assertEqual(sorted(workers[0].registry.index), [2, 4])
+        self.assertEqual(sorted(workers[1].registry.index), [1, 3])
+        # and written behind by its owner
+        self.assertEqual(sorted(heartbeat_writers[0].pending), [2, 4])
+        self.assertEqual(sorted(heartbeat_writers[1].pending), [1, 3])
+        self.assertEqual(heartbeat_writers[1].pending[3][:2], ("localhost", 1003))
+        for receiving_socket, sending_socket in inboxes:
+            receiving_socket.close()
+            sending_socket.close()
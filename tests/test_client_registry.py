@@ -0,0 +1,226 @@
+from unittest import TestCase
+
+from client_registry import ClientRegistry
+
+
+def saved_client(client_id, host="localhost", port=1000, status_count=0):
+    return {
+        "client_identifier": client_id,
+        "is_connected": True,
+        "client_host": host,
+        "client_port": port,
+        "status_count": status_count,
+    }
+
+
+class ClientRegistryTestCase(TestCase):
+    def setUp(self) -> None:
+        self.registry = ClientRegistry()
+
+    def test_heartbeat_registers_client(self):
+        self.registry.heartbeat(1, "localhost", 1000, now=5.0)
+        self.registry.heartbeat(2, "localhost", 1001, now=6.0)
+        self.registry.heartbeat(1, "localhost", 1002, now=7.0)
+
+        self.assertEqual(len(self.registry), 2)
+        self.assertEqual(self.registry.hosts, ["localhost"])
+        self.assertEqual(
+            self.registry.get(1),
+            {
+                "client_identifier": 1,
+                "client_host": "localhost",
+                "client_port": 1002,
+                "status_count": 0,
+                "last_seen": 7.0,
+                "is_connected": False,
+            },
+        )
+        # only clients which answered a status request are written
+        self.assertEqual(self.registry.changes(), ({}, []))
+
+    def test_only_changes_are_written(self):
+        self.registry.merge_saved_clients(
+            [saved_client(1), saved_client(2), saved_client(3), saved_client(4)]
+        )
+        self.registry.heartbeat(5, "localhost", 1005, now=1.0)
+        self.assertEqual(self.registry.changes(), ({}, []))
+
+        self.assertFalse(self.registry.record_status(1, True, 0, now=2.0))
+        self.assertTrue(self.registry.record_status(2, True, 5, now=2.0))
+        self.registry.heartbeat(3, "10.0.0.3", 2000, now=2.0)
+        self.assertFalse(self.registry.record_status(3, True, 0, now=2.0))
+        self.assertFalse(self.registry.record_status(4, False, 0, now=2.0))
+        self.assertFalse(self.registry.record_status(5, True, 0, now=2.0))
+
+        changed_clients, removed_client_ids = self.registry.changes()
+
+        self.assertEqual(sorted(changed_clients), [2, 3, 5])
+        self.assertEqual(changed_clients[3]["client_host"], "10.0.0.3")
+        self.assertEqual(removed_client_ids, [4])
+        self.assertEqual(self.registry.changes(), ({}, []))
+
+    def test_failed_write_is_retried(self):
+        self.registry.merge_saved_clients([saved_client(1)])
+        self.registry.record_status(1, True, 3, now=1.0)
+        changes = self.registry.changes()
+
+        self.registry.restore_changes(*changes)
+
+        self.assertEqual(self.registry.changes(), changes)
+
+    def test_forget_lost_clients(self):
+        self.registry.merge_saved_clients(
+            [saved_client(1), saved_client(2), saved_client(3)]
+        )
+        self.registry.heartbeat(2, "localhost", 1000, now=1.0)
+        for client_id in (1, 2):
+            self.registry.record_status(client_id, False, 0, now=1.0)
+
+        _, removed_client_ids = self.registry.changes()
+        self.registry.forget_lost_clients(removed_client_ids)
+
+        # client 1 was only known from the database, client 2 keeps sending heartbeats
+        self.assertNotIn(1, self.registry)
+        self.assertEqual(sorted(self.registry.index), [2, 3])
+        self.assertEqual(
+            sorted(client_id for client_id, *_ in self.registry.poll_targets()),
+            [2, 3],
+        )
+        self.assertEqual(self.registry.get(3)["client_identifier"], 3)
+
+    def test_repr_is_a_summary(self):
+        for client_id in range(1000):
+            self.registry.heartbeat(client_id, "localhost", 1000, now=5.0)
+        self.registry.record_status(1, True, 3, now=6.0)
+
+        self.assertEqual(
+            repr(self.registry),
+            "<ClientRegistry clients=1000 connected=1 changed=1000 hosts=1>",
+        )
+
+    def test_invalid_values_leave_the_rows_aligned(self):
+        self.registry.heartbeat(1, "localhost", 1001, now=5.0)
+        for identifier, port in ((2, -1), (3, 2**32), (-1, 1000)):
+            with self.assertRaises(OverflowError):
+                self.registry.heartbeat(identifier, "localhost", port, now=5.0)
+        with self.assertRaises(OverflowError):
+            self.registry.heartbeat(1, "localhost", -1, now=6.0)
+        # a saved client which does not fit is skipped, the other ones are merged
+        self.registry.merge_saved_clients(
+            [
+                saved_client(4, status_count=-1),
+                saved_client(6, port=None),
+                saved_client(7),
+            ]
+        )
+        self.assertEqual(self.registry.get(7)["client_port"], 1000)
+        self.registry.remove_clients(lambda identifier: identifier == 7)
+
+        self.assertEqual(len(self.registry), 1)
+        self.assertEqual(list(self.registry.index), [1])
+        self.assertEqual(self.registry.get(1)["client_port"], 1001)
+        self.assertEqual(list(self.registry.take_unscheduled()), [1, 7])
+        # new clients are added as usual
+        self.registry.heartbeat(5, "localhost", 1005, now=7.0)
+        self.assertEqual(self.registry.get(5)["client_port"], 1005)
+        self.assertEqual(self.registry.poll_targets()[-1], (5, "localhost", 1005, 0))
+
+    def test_clients_saved_by_heartbeat_are_removed_after_a_failure(self):
+        self.registry.heartbeat(1, "localhost", 1001, now=5.0)
+        self.registry.heartbeat(2, "localhost", 1002, now=5.0)
+        self.registry.mark_saved([1, 3])
+
+        # new clients are written once, with what the database holds already
+        self.assertEqual(list(self.registry.changes()[0]), [1])
+        self.registry.record_status(1, False, 0, 6.0)
+        self.registry.record_status(2, False, 0, 6.0)
+        self.assertEqual(self.registry.changes(), ({}, [1]))
+
+    def test_remove_clients(self):
+        self.registry.heartbeat(1, "localhost", 1001, now=5.0)
+        self.registry.heartbeat(2, "localhost", 1002, now=5.0)
+        self.registry.merge_saved_clients([saved_client(3), saved_client(4)])
+
+        removed = self.registry.remove_clients(lambda identifier: identifier % 2)
+
+        # only the clients known from a heartbeat are returned
+        self.assertEqual(removed, [(1, "localhost", 1001, 5.0)])
+        self.assertEqual(sorted(self.registry.index), [2, 4])
+        self.assertEqual(self.registry.get(4)["client_port"], 1000)
+
+    def test_unused_hosts_are_dropped(self):
+        for client_id in range(10):
+            self.registry.heartbeat(client_id, f"10.0.0.{client_id}", 1000, now=5.0)
+        self.registry.merge_saved_clients([saved_client(10, host="10.0.1.10")])
+        # a reconnection from another host releases the previous one
+        self.registry.heartbeat(9, "10.0.1.9", 1000, now=6.0)
+        self.assertEqual(len(self.registry.hosts), 12)
+        self.assertEqual(self.registry.unused_hosts, 1)
+
+        self.registry.remove_clients(lambda identifier: identifier < 5)
+        self.assertEqual(len(self.registry.hosts), 12)
+        self.registry.remove_clients(lambda identifier: identifier == 5)
+
+        self.assertEqual(
+            self.registry.hosts,
+            ["10.0.0.6", "10.0.0.7", "10.0.0.8", "10.0.1.10", "10.0.1.9"],
+        )
+        self.assertEqual(list(self.registry.host_refs), [1, 1, 1, 1, 1])
+        self.assertEqual(self.registry.unused_hosts, 0)
+        self.assertEqual(
+            [self.registry.get(client_id)["client_host"] for client_id in (6, 9, 10)],
+            ["10.0.0.6", "10.0.1.9", "10.0.1.10"],
+        )
+        # the hosts are interned again when they come back
+        self.registry.heartbeat(1, "10.0.0.1", 1000, now=7.0)
+        self.registry.heartbeat(2, "10.0.0.6", 1000, now=7.0)
+        self.assertEqual(self.registry.get(1)["client_host"], "10.0.0.1")
+        self.assertEqual(list(self.registry.host_refs), [2, 1, 1, 1, 1, 1])
+
+    def test_due_poll_targets(self):
+        for client_id in (1, 2, 3):
+            self.registry.heartbeat(client_id, "localhost", 1000 + client_id, now=5.0)
+        self.assertEqual(list(self.registry.take_unscheduled()), [1, 2, 3])
+        self.assertEqual(list(self.registry.take_unscheduled()), [])
+        self.registry.schedule_poll(1, 10.0)
+        self.registry.schedule_poll(2, 10.0)
+        # rescheduled later, its expired timer is stale
+        self.registry.schedule_poll(3, 20.0)
+
+        targets = self.registry.due_poll_targets([1, 2, 3, 4], until=11.0)
+
+        self.assertEqual(
+            targets, [(1, "localhost", 1001, 0), (2, "localhost", 1002, 0)]
+        )
+        # being polled, a duplicate timer is ignored
+        self.assertEqual(self.registry.due_poll_targets([1], until=12.0), [])
+        self.assertFalse(self.registry.schedule_poll(4, 10.0))
+
+    def test_poll_interval_adapts_to_the_client(self):
+        registry = ClientRegistry(
+            min_poll_interval=10.0, max_poll_interval=50.0, backoff_factor=2.0
+        )
+        registry.heartbeat(1, "localhost", 1000, now=5.0)
+        registry.take_unscheduled()
+        self.assertEqual(registry.poll_interval(1), 10.0)
+
+        # stable clients back off up to the maximum
+        registry.record_status(1, True, 0, now=6.0)
+        self.assertEqual(registry.poll_interval(1), 10.0)  # it was not connected
+        for expected in (20.0, 40.0, 50.0, 50.0):
+            registry.record_status(1, True, 0, now=7.0)
+            self.assertEqual(registry.poll_interval(1), expected)
+
+        # a changed count, a failure or a reconnection bring it back to the minimum
+        registry.record_status(1, True, 3, now=8.0)
+        self.assertEqual(registry.poll_interval(1), 10.0)
+        registry.record_status(1, True, 3, now=9.0)
+        registry.record_status(1, False, 0, now=10.0)
+        self.assertEqual(registry.poll_interval(1), 10.0)
+        registry.record_status(1, True, 3, now=11.0)
+        registry.record_status(1, True, 3, now=12.0)
+        self.assertEqual(registry.poll_interval(1), 20.0)
+        registry.heartbeat(1, "localhost", 1001, now=13.0)
+        self.assertEqual(registry.poll_interval(1), 10.0)
+        # and its backed off poll is replaced by one soon
+        self.assertEqual(list(registry.take_unscheduled()), [1])
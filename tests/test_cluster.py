@@ -0,0 +1,104 @@
+import asyncio
+from unittest import TestCase
+
+from cluster import ShardCluster, assign_shards
+
+
+class LeaseStore:
+    """
+    The lease operations of AsyncPgPostgresManager on dictionaries, leases never expire.
+    """
+
+    def __init__(self):
+        self.nodes = set()
+        self.shards = {}  # shard -> node_id
+        self.announced_clients = {}
+
+    async def create_cluster_tables(self):
+        return True
+
+    async def renew_node_lease(self, node_id, lease_seconds):
+        self.nodes.add(node_id)
+        return sorted(self.nodes)
+
+    async def claim_shards(self, node_id, shards, lease_seconds):
+        for shard, owner in list(self.shards.items()):
+            if owner == node_id and shard not in shards:
+                del self.shards[shard]
+        for shard in shards:
+            self.shards.setdefault(shard, node_id)
+        return [shard for shard, owner in self.shards.items() if owner == node_id]
+
+    async def leave_cluster(self, node_id):
+        self.nodes.discard(node_id)
+        self.shards = {s: n for s, n in self.shards.items() if n != node_id}
+        return True
+
+    async def announce_clients(self, clients):
+        self.announced_clients.update(clients)
+        return True
+
+
+class AssignShardsTestCase(TestCase):
+    def test_every_shard_has_one_node(self):
+        nodes = ["node-a", "node-b", "node-c"]
+        assignments = [assign_shards(node, nodes, 256) for node in nodes]
+
+        self.assertEqual(sorted(sum(assignments, [])), list(range(256)))
+        for shards in assignments:
+            # roughly a third each
+            self.assertGreater(len(shards), 50)
+
+    def test_only_the_shards_of_a_new_node_move(self):
+        before = assign_shards("node-a", ["node-a", "node-b"], 256)
+        after = assign_shards("node-a", ["node-a", "node-b", "node-c"], 256)
+        taken = assign_shards("node-c", ["node-a", "node-b", "node-c"], 256)
+
+        self.assertTrue(set(after) <= set(before))
+        self.assertEqual(set(before) - set(after), set(before) & set(taken))
+
+
+class ShardClusterTestCase(TestCase):
+    def setUp(self) -> None:
+        self.store = LeaseStore()
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self) -> None:
+        self.loop.close()
+
+    def refresh(self, *nodes):
+        for node in nodes:
+            self.loop.run_until_complete(node.refresh())
+
+    def test_nodes_share_the_shards(self):
+        node_a = ShardCluster(self.store, "node-a", shard_count=16)
+        node_b = ShardCluster(self.store, "node-b", shard_count=16)
+
+        self.refresh(node_a)
+        self.assertEqual(len(node_a.owned_shards()), 16)
+        # node-a holds every shard until it releases the ones of node-b
+        self.refresh(node_b)
+        self.assertEqual(node_b.owned_shards(), frozenset())
+        self.refresh(node_a, node_b)
+        self.assertEqual(node_a.owned_shards() & node_b.owned_shards(), frozenset())
+        self.assertEqual(len(node_a.owned_shards() | node_b.owned_shards()), 16)
+        for identifier in range(100):
+            self.assertNotEqual(node_a.owns(identifier), node_b.owns(identifier))
+
+        self.loop.run_until_complete(node_a.leave())
+        self.refresh(node_b)
+        self.assertEqual(len(node_b.owned_shards()), 16)
+
+    def test_expired_leases_own_nothing(self):
+        node_a = ShardCluster(self.store, "node-a", shard_count=16, lease_seconds=0)
+        self.refresh(node_a)
+        self.assertEqual(node_a.owned_shards(), frozenset())
+        self.assertFalse(node_a.owns(1))
+
+    def test_forwarded_heartbeats_are_announced(self):
+        node_a = ShardCluster(self.store, "node-a", shard_count=16)
+        node_a.forward(7, "localhost", 1007, 5.0)
+        self.refresh(node_a)
+
+        self.assertEqual(self.store.announced_clients, {7: ("localhost", 1007)})
+        self.assertEqual(node_a.announced_clients, {})
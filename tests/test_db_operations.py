@@ -0,0 +1,414 @@
+import asyncio
+import datetime
+import json
+import re
+import time
+from unittest import TestCase, mock
+
+import asyncpg
+
+from db_operations import (
+    SELECT_STATUS_HISTORY,
+    STATUS_PARTITION_PREFIX,
+    AsyncPgPostgresManager,
+    utc_datetime,
+)
+
+
+def notification(op: str, client_id: int = 0, **columns) -> str:
+    if op == "TRUNCATE":
+        return json.dumps({"op": op})
+    return json.dumps(
+        {
+            "op": op,
+            "client_identifier": client_id,
+            "is_connected": columns.get("is_connected", True),
+            "client_host": columns.get("client_host", "localhost"),
+            "client_port": columns.get("client_port", 9000),
+            "status_count": columns.get("status_count", 0),
+        }
+    )
+
+
+class ClientCacheTestCase(TestCase):
+    def setUp(self) -> None:
+        self.db_op_manager = AsyncPgPostgresManager(
+            user="devuser",
+            password="devpwd",
+            database_name="devdb",
+            db_host="0.0.0.0",
+            db_port=5432,
+            cache_clients=True,
+        )
+        # as after the first read
+        self.db_op_manager.saved_clients = {}
+
+    def notify(self, payload: str) -> None:
+        self.db_op_manager.client_record_changed(
+            None, 1, "client_record_changes", payload
+        )
+
+    def test_changes_are_applied_row_by_row(self):
+        self.notify(notification("INSERT", 1, status_count=3))
+        self.notify(notification("INSERT", 2))
+        self.notify(notification("UPDATE", 1, client_host="10.0.0.1", status_count=4))
+        self.notify(notification("DELETE", 2))
+        # rows of disconnected clients are not saved clients
+        self.notify(notification("INSERT", 3, is_connected=False))
+
+        self.assertEqual(
+            self.db_op_manager.saved_clients,
+            {
+                1: {
+                    "client_identifier": 1,
+                    "is_connected": True,
+                    "client_host": "10.0.0.1",
+                    "client_port": 9000,
+                    "status_count": 4,
+                }
+            },
+        )
+
+        self.notify(notification("TRUNCATE"))
+        self.assertEqual(self.db_op_manager.saved_clients, {})
+
+    def test_changes_during_the_first_read_are_applied_after_it(self):
+        self.db_op_manager.saved_clients = None
+        self.db_op_manager.notifications = []
+        self.notify(notification("UPDATE", 1, status_count=7))
+
+        self.assertEqual(len(self.db_op_manager.notifications), 1)
+        self.assertIsNone(self.db_op_manager.saved_clients)
+
+    def test_own_writes_update_the_cache(self):
+        self.notify(notification("INSERT", 1, status_count=3))
+
+        # a heartbeat keeps the saved status count
+        self.db_op_manager.cache_clients_saved(
+            {1: ("10.0.0.1", 9001, 0), 2: ("10.0.0.2", 9002, 0)}, True
+        )
+        self.assertEqual(self.db_op_manager.saved_clients[1]["status_count"], 3)
+        self.assertEqual(self.db_op_manager.saved_clients[1]["client_port"], 9001)
+        self.assertEqual(self.db_op_manager.saved_clients[2]["status_count"], 0)
+
+        self.db_op_manager.cache_clients_saved({1: ("10.0.0.1", 9001, 5)}, False)
+        self.assertEqual(self.db_op_manager.saved_clients[1]["status_count"], 5)
+
+    def test_lost_listener_invalidates_the_cache(self):
+        listener = object()
+        self.db_op_manager.listener = listener
+        self.db_op_manager.listener_lost(listener)
+
+        self.assertIsNone(self.db_op_manager.listener)
+        self.assertIsNone(self.db_op_manager.saved_clients)
+
+
+class StartTestCase(TestCase):
+    def setUp(self) -> None:
+        self.db_op_manager = AsyncPgPostgresManager(
+            user="devuser",
+            password="devpwd",
+            database_name="devdb",
+            db_host="0.0.0.0",
+            db_port=5432,
+        )
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self) -> None:
+        self.loop.close()
+
+    def test_concurrent_starts_open_one_pool(self):
+        pool = object()
+
+        async def create_pool(**kwargs):
+            await asyncio.sleep(0.01)
+            return pool
+
+        async def start_all():
+            return await asyncio.gather(*(self.db_op_manager.start() for _ in range(3)))
+
+        with mock.patch("asyncpg.connect", mock.AsyncMock()), mock.patch(
+            "migrations.migrate", mock.AsyncMock()
+        ), mock.patch("asyncpg.create_pool", side_effect=create_pool) as create:
+            self.assertEqual(self.loop.run_until_complete(start_all()), [True] * 3)
+        self.assertEqual(create.call_count, 1)
+        self.assertIs(self.db_op_manager.pool, pool)
+
+
+class HeartbeatConnection:
+    """
+    An asyncpg connection and its pool, which rejects the identifiers which do not fit a BIGINT.
+    """
+
+    def __init__(self):
+        self.saved = {}
+        self.statements = 0
+
+    def acquire(self):
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def execute(self, statement, client_ids, hosts, ports, times):
+        self.statements += 1
+        if any(client_id >= 2**63 for client_id in client_ids):
+            raise asyncpg.DataError("value out of int64 range")
+        self.saved.update(zip(client_ids, zip(hosts, ports, times)))
+
+
+class SaveHeartbeatsTestCase(TestCase):
+    def setUp(self) -> None:
+        self.db_op_manager = AsyncPgPostgresManager(
+            user="devuser",
+            password="devpwd",
+            database_name="devdb",
+            db_host="0.0.0.0",
+            db_port=5432,
+        )
+        self.db_op_manager.pool = self.conn = HeartbeatConnection()
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self) -> None:
+        self.loop.close()
+
+    def test_invalid_heartbeats_are_dropped(self):
+        heartbeats = {
+            1: ("localhost", 9001, 1.0),
+            2**63: ("localhost", 9002, 1.0),
+            2**32 - 1: ("localhost", 9003, 1.0),
+        }
+        self.assertTrue(
+            self.loop.run_until_complete(self.db_op_manager.save_heartbeats(heartbeats))
+        )
+        # the batch, then one statement per heartbeat
+        self.assertEqual(self.conn.statements, 4)
+        self.assertEqual(sorted(self.conn.saved), [1, 2**32 - 1])
+
+
+class HistoryConnection:
+    """
+    An asyncpg connection and its pool, which keeps the partitions of client_status_history by day and
+    rejects the statuses without a partition, like a partitioned table without a default partition.
+    """
+
+    def __init__(self, partition_days=()):
+        self.partitions = {
+            f"{STATUS_PARTITION_PREFIX}{day:%Y%m%d}" for day in partition_days
+        }
+        self.statements = []
+        self.staged = []
+        self.history = []
+        self.rows = []
+
+    def acquire(self):
+        return self
+
+    def transaction(self):
+        return self
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+    async def execute(self, statement, *args):
+        self.statements.append((statement, args))
+        created = re.search(r"CREATE TABLE IF NOT EXISTS (\w+)", statement)
+        if created:
+            self.partitions.add(created.group(1))
+        elif statement.startswith("DROP TABLE "):
+            self.partitions.remove(statement[len("DROP TABLE ") :])
+        elif "INSERT INTO client_status_history" in statement:
+            staged, self.staged = self.staged, []
+            for record in staged:
+                if (
+                    f"{STATUS_PARTITION_PREFIX}{record[1]:%Y%m%d}"
+                    not in self.partitions
+                ):
+                    raise asyncpg.CheckViolationError(
+                        "no partition of relation found for row"
+                    )
+            self.history.extend(staged)
+
+    async def fetch(self, query, *args):
+        self.statements.append((query, args))
+        if "pg_inherits" in query:
+            return [{"relname": name} for name in self.partitions]
+        return self.rows
+
+    async def copy_records_to_table(self, table, records, columns):
+        self.staged.extend(records)
+
+    def created(self) -> list:
+        return sorted(
+            statement.split()[5][len(STATUS_PARTITION_PREFIX) :]
+            for statement, _ in self.statements
+            if statement.strip().startswith("CREATE TABLE")
+        )
+
+
+class StatusHistoryTestCase(TestCase):
+    def setUp(self) -> None:
+        self.db_op_manager = AsyncPgPostgresManager(
+            user="devuser",
+            password="devpwd",
+            database_name="devdb",
+            db_host="0.0.0.0",
+            db_port=5432,
+            history_retention_days=7,
+            minute_rollup_retention_days=30,
+            hour_rollup_retention_days=365,
+        )
+        self.today = utc_datetime(time.time()).date()
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self) -> None:
+        self.loop.close()
+
+    def use(self, conn: HistoryConnection) -> HistoryConnection:
+        self.db_op_manager.pool = conn
+        return conn
+
+    def days(self, *offsets) -> list:
+        return [
+            f"{self.today + datetime.timedelta(days=offset):%Y%m%d}"
+            for offset in offsets
+        ]
+
+    def test_partitions_are_created_ahead(self):
+        conn = self.use(HistoryConnection())
+        self.assertTrue(
+            self.loop.run_until_complete(self.db_op_manager.maintain_status_history())
+        )
+        self.assertEqual(conn.created(), self.days(-1, 0, 1, 2))
+        self.assertIn("pg_advisory_xact_lock", conn.statements[0][0])
+        # once per hour
+        conn.statements.clear()
+        self.assertTrue(
+            self.loop.run_until_complete(self.db_op_manager.maintain_status_history())
+        )
+        self.assertEqual(conn.statements, [])
+
+    def test_expired_history_is_dropped(self):
+        expired = self.today - datetime.timedelta(days=8)
+        kept = self.today - datetime.timedelta(days=7)
+        conn = self.use(HistoryConnection([expired, kept]))
+        self.assertTrue(
+            self.loop.run_until_complete(
+                self.db_op_manager.maintain_status_history(force=True)
+            )
+        )
+        self.assertNotIn(f"{STATUS_PARTITION_PREFIX}{expired:%Y%m%d}", conn.partitions)
+        self.assertIn(f"{STATUS_PARTITION_PREFIX}{kept:%Y%m%d}", conn.partitions)
+        self.assertEqual(
+            self.db_op_manager.history_partition_days,
+            {kept} | {self.today + datetime.timedelta(days=d) for d in range(-1, 3)},
+        )
+        cutoffs = {
+            statement.split()[2]: args[0].timestamp()
+            for statement, args in conn.statements
+            if statement.startswith("DELETE")
+        }
+        self.assertEqual(set(cutoffs), {"client_status_minute", "client_status_hour"})
+        self.assertAlmostEqual(
+            cutoffs["client_status_minute"], time.time() - 30 * 86400, delta=60
+        )
+        self.assertAlmostEqual(
+            cutoffs["client_status_hour"], time.time() - 365 * 86400, delta=60
+        )
+
+    def test_other_partitions_are_left_alone(self):
+        conn = self.use(HistoryConnection())
+        conn.partitions.update(
+            ("client_status_history_default", f"{STATUS_PARTITION_PREFIX}old")
+        )
+        self.assertTrue(
+            self.loop.run_until_complete(
+                self.db_op_manager.maintain_status_history(force=True)
+            )
+        )
+        self.assertIn("client_status_history_default", conn.partitions)
+        self.assertIn(f"{STATUS_PARTITION_PREFIX}old", conn.partitions)
+        self.assertEqual(len(self.db_op_manager.history_partition_days), 4)
+
+    def test_statuses_buffered_for_days_are_saved(self):
+        conn = self.use(HistoryConnection())
+        now = time.time()
+        statuses = [(1, now - 4 * 86400, True, 3, 3), (2, now, False, 0, 5)]
+        self.assertTrue(
+            self.loop.run_until_complete(
+                self.db_op_manager.save_status_history(statuses)
+            )
+        )
+        self.assertEqual(sorted(row[0] for row in conn.history), [1, 2])
+        self.assertIn(self.days(-4)[0], conn.created())
+        # the next batch of known days does not maintain again
+        conn.statements.clear()
+        self.assertTrue(
+            self.loop.run_until_complete(
+                self.db_op_manager.save_status_history([(3, now, True, 1, 1)])
+            )
+        )
+        self.assertEqual(conn.created(), [])
+
+    def test_expired_statuses_are_dropped(self):
+        conn = self.use(HistoryConnection())
+        now = time.time()
+        statuses = [(1, now - 10 * 86400, True, 3, 3), (2, now, True, 4, 4)]
+        self.assertTrue(
+            self.loop.run_until_complete(
+                self.db_op_manager.save_status_history(statuses)
+            )
+        )
+        self.assertEqual([row[0] for row in conn.history], [2])
+        self.assertEqual(conn.created(), self.days(-1, 0, 1, 2))
+        # nothing left to save
+        conn.statements.clear()
+        self.assertTrue(
+            self.loop.run_until_complete(
+                self.db_op_manager.save_status_history(statuses[:1])
+            )
+        )
+        self.assertEqual(conn.statements, [])
+
+    def query(self, start: float, end: float, resolution: str = None):
+        return self.loop.run_until_complete(
+            self.db_op_manager.query_status_history(7, start, end, resolution)
+        )
+
+    def test_query_status_history_resolution(self):
+        conn = self.use(HistoryConnection())
+        conn.rows = [{"bucket": utc_datetime(0), "samples": 2}]
+        self.assertEqual(self.query(0, 86400), conn.rows)
+        self.assertIn("FROM client_status_minute", conn.statements[-1][0])
+        self.assertEqual(
+            conn.statements[-1][1], (7, utc_datetime(0), utc_datetime(86400))
+        )
+        self.query(0, 3 * 86400)
+        self.assertIn("FROM client_status_hour", conn.statements[-1][0])
+        self.query(0, 3 * 86400, "raw")
+        self.assertEqual(conn.statements[-1][0], SELECT_STATUS_HISTORY)
+        with self.assertRaises(ValueError):
+            self.query(0, 86400, "day")
+
+    def test_query_status_mismatches(self):
+        conn = self.use(HistoryConnection())
+        conn.rows = [{"client_identifier": 7, "mismatches": 3, "samples": 10}]
+        self.assertEqual(
+            self.loop.run_until_complete(
+                self.db_op_manager.query_status_mismatches(0, 3600, limit=5)
+            ),
+            conn.rows,
+        )
+        query, args = conn.statements[-1]
+        self.assertIn("FROM client_status_hour", query)
+        self.assertEqual(args, (utc_datetime(0), utc_datetime(3600), 5))
+        self.loop.run_until_complete(
+            self.db_op_manager.query_status_mismatches(0, 3600, resolution="minute")
+        )
+        self.assertIn("FROM client_status_minute", conn.statements[-1][0])
@@ -0,0 +1,64 @@
+import asyncio
+from unittest import TestCase
+
+import framing
+
+
+class FramingTestCase(TestCase):
+    def read_frames(self, data: bytes, max_frame_size=framing.MAX_FRAME_SIZE):
+        async def read():
+            reader = asyncio.StreamReader()
+            reader.feed_data(data)
+            reader.feed_eof()
+            frames = []
+            while True:
+                frame = await framing.read_frame(reader, max_frame_size)
+                if frame is None:
+                    return frames
+                frames.append(frame)
+
+        return asyncio.run(read())
+
+    def test_encode_varint(self):
+        self.assertEqual(framing.encode_varint(0), b"\x00")
+        self.assertEqual(framing.encode_varint(127), b"\x7f")
+        self.assertEqual(framing.encode_varint(300), b"\xac\x02")
+
+    def test_read_frames(self):
+        payloads = [b"", b"first", b"x" * 1000]
+        data = b"".join(framing.encode_frame(payload) for payload in payloads)
+        self.assertEqual(self.read_frames(data), payloads)
+
+    def test_truncated_frame(self):
+        with self.assertRaises(framing.FrameError):
+            self.read_frames(framing.encode_frame(b"payload")[:-1])
+
+    def test_frame_too_large(self):
+        with self.assertRaises(framing.FrameError):
+            self.read_frames(framing.encode_frame(b"x" * 11), max_frame_size=10)
+
+    def test_find_frame(self):
+        payloads = [b"", b"first", b"x" * 1000]
+        buffer = bytearray(
+            b"".join(framing.encode_frame(payload) for payload in payloads)
+        )
+
+        frames, start = [], 0
+        while True:
+            frame = framing.find_frame(buffer, start, len(buffer))
+            if frame is None:
+                break
+            payload_start, start = frame
+            frames.append(bytes(buffer[payload_start:start]))
+        self.assertEqual(frames, payloads)
+        self.assertEqual(start, len(buffer))
+
+        # incomplete length or payload
+        self.assertIsNone(framing.find_frame(buffer, 7, 8))
+        self.assertIsNone(framing.find_frame(buffer, 7, len(buffer) - 1))
+        with self.assertRaises(framing.FrameError):
+            framing.find_frame(buffer, 7, len(buffer), max_frame_size=10)
+
+        # the size of an incomplete frame is known once its length is
+        self.assertIsNone(framing.frame_bounds(buffer, 7, 8))
+        self.assertEqual(framing.frame_bounds(buffer, 7, 10), (9, 1009))
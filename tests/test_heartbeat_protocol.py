@@ -0,0 +1,121 @@
+from unittest import TestCase
+
+from admission import AdmissionControl
+from encode_decode_executor import EncodeDecodeExecutor
+import framing
+from heartbeat_protocol import HeartbeatProtocol
+import messages_pb2 as messages
+from protobuf_encode_decoder import ProtobufEncoderDecoder
+from server import Server
+
+
+class Transport:
+    """
+    The part of an asyncio.Transport used by HeartbeatProtocol.
+    """
+
+    def __init__(self):
+        self.written = b""
+        self.closed = False
+
+    def write(self, data):
+        self.written += data
+
+    def get_extra_info(self, name, default=None):
+        return ("127.0.0.1", 50000) if name == "peername" else default
+
+    def pause_reading(self):
+        pass
+
+    def resume_reading(self):
+        pass
+
+    def is_closing(self):
+        return self.closed
+
+    def close(self):
+        self.closed = True
+
+
+class HeartbeatProtocolTestCase(TestCase):
+    def setUp(self) -> None:
+        self.encoder_decoder = EncodeDecodeExecutor(ProtobufEncoderDecoder())
+        self.server = Server(
+            encoder_decoder=self.encoder_decoder,
+            db_op_manager=None,
+            query_seconds_interval_lower=10,
+            query_seconds_interval_upper=20,
+            server_ip="localhost",
+            server_port=0,
+        )
+
+    def heartbeat(self, identifier: int, host: str = "localhost") -> bytes:
+        return framing.encode_frame(
+            self.encoder_decoder.encode_heartbeat(
+                {
+                    "type": messages.MessageType.MESSAGE_TYPE_HEARTBEAT,
+                    "msg": "Heartbeat",
+                    "client_host": host,
+                    "client_port": 1000,
+                    "identifier": identifier,
+                }
+            )
+        )
+
+    def receive(self, protocol: HeartbeatProtocol, data: bytes) -> None:
+        # in pieces as large as the buffer offers, like the event loop
+        while data:
+            buffer = protocol.get_buffer(-1)
+            self.assertGreater(len(buffer), 0)
+            size = min(len(buffer), len(data))
+            buffer[:size] = data[:size]
+            protocol.buffer_updated(size)
+            data = data[size:]
+
+    def test_buffer_grows_for_large_frames_only(self):
+        transport = Transport()
+        protocol = HeartbeatProtocol(self.server, initial_buffer_size=64)
+        protocol.connection_made(transport)
+        self.assertEqual(len(protocol.buffer), 64)
+
+        self.receive(
+            protocol, b"".join(self.heartbeat(identifier) for identifier in range(10))
+        )
+        self.assertEqual(len(protocol.buffer), 64)
+
+        # a frame larger than the buffer
+        large = self.heartbeat(10, "h" * 1000)
+        self.receive(protocol, large[:100])
+        self.assertEqual(len(protocol.buffer), len(large))
+        self.receive(protocol, large[100:] + self.heartbeat(11)[:5])
+        self.assertEqual(self.server.registry.get(10)["client_host"], "h" * 1000)
+        self.assertEqual(protocol.end, 5)
+
+        # and back to the initial size once the buffer is empty
+        self.receive(protocol, self.heartbeat(11)[5:])
+        self.assertEqual(len(self.server.registry), 12)
+        self.assertEqual(len(protocol.buffer), 64)
+        self.assertFalse(transport.closed)
+
+    def test_buffer_is_bounded_by_the_frame_size(self):
+        transport = Transport()
+        protocol = HeartbeatProtocol(
+            self.server, max_frame_size=100, initial_buffer_size=64
+        )
+        protocol.connection_made(transport)
+        self.receive(protocol, self.heartbeat(1, "h" * 1000)[:50])
+        self.assertTrue(transport.closed)
+        self.assertEqual(len(protocol.buffer), 64)
+
+    def test_rejected_connection_has_no_buffer(self):
+        self.server.admission = AdmissionControl(max_connections=1)
+        protocols = [HeartbeatProtocol(self.server) for _ in range(2)]
+        transports = [Transport(), Transport()]
+        for protocol, transport in zip(protocols, transports):
+            protocol.connection_made(transport)
+
+        self.assertFalse(transports[0].closed)
+        self.assertIsNotNone(protocols[0].buffer)
+        self.assertTrue(transports[1].closed)
+        self.assertIsNone(protocols[1].buffer)
+        self.assertEqual(self.server.metrics.connections_rejected.value, 1)
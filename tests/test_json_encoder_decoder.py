@@ -1,10 +1,11 @@
+import json
 from unittest import TestCase
 
 from encode_decode_executor import EncodeDecodeExecutor
-import pytest
 
 from json_encoder_decoder import JsonEncoderDecoder
 import messages_pb2 as messages
+from records import HeartbeatRecord, StatusRecord
 
 
 class JsonBufEncodeDecodeTestCase(TestCase):
@@ -18,9 +19,11 @@ class JsonBufEncodeDecodeTestCase(TestCase):
             "message_count": 100,
             "identifier": 1234,
         }
-        # JSON encode/decode functions are not implemented yet and expect NotImplementedError raise
-        with pytest.raises(NotImplementedError):
-            encoder_decoder.encode_heartbeat(msg_dict)
+        # a status message is not a valid heartbeat, an error message is returned like with protobuf
+        data = encoder_decoder.encode_heartbeat(msg_dict)
+        self.assertEqual(
+            json.loads(data)["type"], messages.MessageType.MESSAGE_TYPE_ERROR
+        )
 
     def test_encode_status_message(self):
         encoder_decoder = EncodeDecodeExecutor(self.json_buffer_enc_dec)
@@ -29,6 +32,156 @@ class JsonBufEncodeDecodeTestCase(TestCase):
             "message_count": 100,
             "identifier": 1234,
         }
-        # JSON encode/decode functions are not implemented yet and expect NotImplementedError raise
-        with pytest.raises(NotImplementedError):
-            encoder_decoder.encode_status(msg_dict)
+        data = encoder_decoder.encode_status(msg_dict)
+        self.assertEqual(
+            encoder_decoder.decode_message_type(data),
+            messages.MessageType.MESSAGE_TYPE_STATUS,
+        )
+        self.assertEqual(
+            encoder_decoder.decode_status(data), dict(msg_dict, request_id=0)
+        )
+
+    def test_heartbeat(self):
+        encoder_decoder = EncodeDecodeExecutor(self.json_buffer_enc_dec)
+        msg_dict = {
+            "type": messages.MessageType.MESSAGE_TYPE_HEARTBEAT,
+            "msg": "Heartbeat",
+            "client_host": "localhost",
+            "client_port": 1000,
+            "identifier": 1234,
+            "request_id": 5,
+        }
+        data = encoder_decoder.encode_heartbeat(msg_dict)
+
+        self.assertEqual(encoder_decoder.decode_heartbeat(data), msg_dict)
+        self.assertEqual(
+            encoder_decoder.decode_heartbeat_record(memoryview(data)),
+            HeartbeatRecord(**msg_dict),
+        )
+        self.assertEqual(
+            encoder_decoder.encode_heartbeat_record(HeartbeatRecord(**msg_dict)), data
+        )
+        self.assertIsNone(encoder_decoder.decode_status_record(data))
+        # missing fields take their default value
+        self.assertEqual(
+            encoder_decoder.decode_heartbeat(b'{"identifier": 7}'),
+            {
+                "type": messages.MessageType.MESSAGE_TYPE_HEARTBEAT,
+                "msg": "",
+                "client_host": "",
+                "client_port": 0,
+                "identifier": 7,
+                "request_id": 0,
+            },
+        )
+
+    def test_peek_heartbeat_identifier(self):
+        encoder_decoder = EncodeDecodeExecutor(self.json_buffer_enc_dec)
+        data = encoder_decoder.encode_heartbeat(
+            {
+                "type": messages.MessageType.MESSAGE_TYPE_HEARTBEAT,
+                "msg": "Heartbeat",
+                "client_host": "localhost",
+                "client_port": 1000,
+                "identifier": 1234,
+                "request_id": 5,
+            }
+        )
+        self.assertEqual(
+            encoder_decoder.peek_heartbeat_identifier(memoryview(data)), (1234, 5)
+        )
+        self.assertEqual(
+            encoder_decoder.peek_heartbeat_identifier(b'{"identifier" : 7}'), (7, 0)
+        )
+        # a key inside a string is not a key
+        self.assertEqual(
+            encoder_decoder.peek_heartbeat_identifier(
+                b'{"client_host": "\\"identifier\\":1,", "identifier": 7}'
+            ),
+            (7, 0),
+        )
+        # the decoder decides for anything else
+        for data in (
+            b"{}",
+            b'{"identifier": "7"}',
+            b'{"identifier": 7, "request_id": null}',
+            b'{"identifier": 7, "identifier": 8}',
+        ):
+            self.assertIsNone(encoder_decoder.peek_heartbeat_identifier(data), data)
+
+    def test_values_out_of_range(self):
+        encoder_decoder = EncodeDecodeExecutor(self.json_buffer_enc_dec)
+        # the uint32 fields of the protobuf messages
+        for data in (
+            b'{"type": 0, "client_port": -1, "identifier": 7}',
+            b'{"type": 0, "client_port": 1000, "identifier": 4294967296}',
+            b'{"type": 0, "identifier": 7, "request_id": -5}',
+        ):
+            with self.assertRaises(ValueError):
+                encoder_decoder.decode_heartbeat(data)
+            with self.assertRaises(ValueError):
+                encoder_decoder.decode_heartbeat_record(data)
+        with self.assertRaises(ValueError):
+            encoder_decoder.decode_status_record(
+                b'{"type": 1, "message_count": -1, "identifier": 7}'
+            )
+        with self.assertRaises(ValueError):
+            encoder_decoder.decode_heartbeat_batch(
+                b'{"type": 4, "heartbeats": [{"identifier": -1}]}'
+            )
+        self.assertEqual(
+            encoder_decoder.decode_heartbeat(b'{"identifier": 4294967295}')[
+                "identifier"
+            ],
+            4294967295,
+        )
+
+        # an error message is returned like with protobuf
+        data = encoder_decoder.encode_heartbeat(
+            {
+                "type": 0,
+                "msg": "",
+                "client_host": "",
+                "client_port": -1,
+                "identifier": 1,
+            }
+        )
+        self.assertEqual(
+            json.loads(data)["type"], messages.MessageType.MESSAGE_TYPE_ERROR
+        )
+
+    def test_batches(self):
+        encoder_decoder = EncodeDecodeExecutor(self.json_buffer_enc_dec)
+        heartbeats = [
+            {
+                "type": messages.MessageType.MESSAGE_TYPE_HEARTBEAT,
+                "msg": "Heartbeat",
+                "client_host": "localhost",
+                "client_port": 1000,
+                "identifier": identifier,
+                "request_id": 0,
+            }
+            for identifier in range(3)
+        ]
+        statuses = [
+            StatusRecord(messages.MessageType.MESSAGE_TYPE_STATUS, 7, identifier, 1)
+            for identifier in range(3)
+        ]
+
+        heartbeat_data = encoder_decoder.encode_heartbeat_batch(heartbeats)
+        status_data = encoder_decoder.encode_status_batch(
+            [status._asdict() for status in statuses]
+        )
+
+        self.assertEqual(
+            encoder_decoder.decode_message_type(heartbeat_data),
+            messages.MessageType.MESSAGE_TYPE_BATCH_HEARTBEAT,
+        )
+        self.assertEqual(
+            encoder_decoder.decode_heartbeat_batch(heartbeat_data), heartbeats
+        )
+        self.assertEqual(
+            encoder_decoder.decode_status_batch(status_data),
+            [status._asdict() for status in statuses],
+        )
+        self.assertEqual(encoder_decoder.decode_status_batch(heartbeat_data), [])
@@ -0,0 +1,77 @@
+import logging
+import logging.handlers
+import queue
+import threading
+from unittest import TestCase
+
+from log_pipeline import NonBlockingQueueHandler, RateLimitFilter
+
+
+def make_record(msg, lineno=10, created=100.0, args=()):
+    record = logging.LogRecord(
+        "test", logging.INFO, "server.py", lineno, msg, args, None
+    )
+    record.created = created
+    return record
+
+
+class FormattedIn:
+    # remembers the thread which formatted it
+    def __init__(self):
+        self.thread = None
+
+    def __str__(self):
+        self.thread = threading.current_thread()
+        return "formatted"
+
+
+class RateLimitFilterTestCase(TestCase):
+    def test_limits_each_call_site(self):
+        rate_limit_filter = RateLimitFilter(max_records=2, interval_seconds=1.0)
+
+        passed = [
+            rate_limit_filter.filter(make_record("a", created=100.0 + i * 0.1))
+            for i in range(5)
+        ]
+        self.assertEqual(passed, [True, True, False, False, False])
+        # another call site has its own limit
+        self.assertTrue(rate_limit_filter.filter(make_record("b", lineno=11)))
+
+        record = make_record("a %s", created=101.5, args=("x",))
+        self.assertTrue(rate_limit_filter.filter(record))
+        self.assertEqual(record.getMessage(), "a x (3 similar messages suppressed)")
+
+    def test_decision_is_shared_by_handlers(self):
+        rate_limit_filter = RateLimitFilter(max_records=1, interval_seconds=1.0)
+        record = make_record("a")
+
+        self.assertTrue(rate_limit_filter.filter(record))
+        self.assertTrue(rate_limit_filter.filter(record))
+        self.assertFalse(rate_limit_filter.filter(make_record("a")))
+
+
+class NonBlockingQueueHandlerTestCase(TestCase):
+    def test_formats_in_listener_thread(self):
+        handler = NonBlockingQueueHandler(queue.Queue())
+        stream = []
+        target = logging.Handler()
+        target.emit = lambda record: stream.append(target.format(record))
+        listener = logging.handlers.QueueListener(handler.queue, target)
+        argument = FormattedIn()
+
+        listener.start()
+        handler.handle(make_record("value %s", args=(argument,)))
+        listener.stop()
+
+        self.assertEqual(stream, ["value formatted"])
+        self.assertIsNotNone(argument.thread)
+        self.assertIsNot(argument.thread, threading.current_thread())
+
+    def test_drops_records_when_queue_is_full(self):
+        handler = NonBlockingQueueHandler(queue.Queue(2))
+
+        for i in range(5):
+            handler.handle(make_record(f"record {i}"))
+
+        self.assertEqual(handler.queue.qsize(), 2)
+        self.assertEqual(handler.dropped, 3)
@@ -0,0 +1,47 @@
+import os
+from unittest import TestCase, mock
+
+import main
+from workers import HeartbeatRouter
+
+
+class BuildServerTestCase(TestCase):
+    def test_server_is_configured_from_the_environment(self):
+        environment = {
+            "REGISTRY_SNAPSHOT_PATH": "snapshot/registry.bin",
+            "REGISTRY_SNAPSHOT_INTERVAL_SECONDS": "30",
+            "SERVER_PORT": "4100",
+            "METRICS_PORT": "4101",
+            "HEARTBEAT_WRITE_BEHIND": "true",
+            "CLUSTER_ENABLED": "false",
+        }
+        with mock.patch.dict(os.environ, environment):
+            server, cluster, _, metrics_port = main.build_server()
+
+        self.assertIsNone(cluster)
+        self.assertEqual(server.server_port, 4100)
+        self.assertEqual(metrics_port, 4101)
+        self.assertEqual(server.snapshot_path, "snapshot/registry.bin")
+        self.assertEqual(server.snapshot_interval_seconds, 30.0)
+        self.assertIsNotNone(server.heartbeat_writer)
+        self.assertIsNotNone(server.admission)
+
+    def test_worker_has_its_own_snapshot_and_metrics_port(self):
+        environment = {
+            "REGISTRY_SNAPSHOT_PATH": "snapshot/registry.bin",
+            "METRICS_PORT": "4101",
+            "CLUSTER_ENABLED": "false",
+        }
+        with mock.patch.dict(os.environ, environment):
+            server, _, _, metrics_port = main.build_server(
+                HeartbeatRouter(1, [None, None])
+            )
+
+        self.assertEqual(server.snapshot_path, "snapshot/registry.bin.1")
+        self.assertEqual(metrics_port, 4102)
+        self.assertTrue(server.reuse_port)
+
+    def test_snapshots_can_be_disabled(self):
+        with mock.patch.dict(os.environ, {"REGISTRY_SNAPSHOT_PATH": ""}):
+            server, _, _, _ = main.build_server()
+        self.assertFalse(server.snapshot_path)
@@ -0,0 +1,68 @@
+from unittest import TestCase
+
+from encode_decode_executor import EncodeDecodeExecutor
+from message_cache import MessageCache
+from protobuf_encode_decoder import ProtobufEncoderDecoder
+import messages_pb2 as messages
+
+
+class MessageCacheTestCase(TestCase):
+    def setUp(self) -> None:
+        self.encoder_decoder = EncodeDecodeExecutor(ProtobufEncoderDecoder())
+        self.cache = MessageCache(self.encoder_decoder, max_entries=2)
+
+    def test_ack(self):
+        ack = self.cache.ack(1, "localhost", 1000)
+
+        self.assertEqual(
+            self.encoder_decoder.decode_heartbeat(ack),
+            {
+                "type": messages.MessageType.MESSAGE_TYPE_HEARTBEAT,
+                "msg": "ack",
+                "client_host": "localhost",
+                "client_port": 1000,
+                "identifier": 1,
+                "request_id": 0,
+            },
+        )
+        # the same bytes until the address or request_id change
+        self.assertIs(self.cache.ack(1, "localhost", 1000), ack)
+        moved = self.cache.ack(1, "localhost", 1001)
+        self.assertEqual(
+            self.encoder_decoder.decode_heartbeat(moved)["client_port"], 1001
+        )
+        self.assertIsNot(self.cache.ack(1, "localhost", 1001, request_id=5), moved)
+
+    def test_status_request(self):
+        request = self.cache.status_request(1, 7)
+
+        self.assertEqual(
+            self.encoder_decoder.decode_status(request),
+            {
+                "type": messages.MessageType.MESSAGE_TYPE_STATUS,
+                "message_count": 7,
+                "identifier": 1,
+                "request_id": 0,
+            },
+        )
+        self.assertIs(self.cache.status_request(1, 7), request)
+        self.assertEqual(
+            self.encoder_decoder.decode_status(self.cache.status_request(1, 8))[
+                "message_count"
+            ],
+            8,
+        )
+
+    def test_cache_is_bounded(self):
+        for identifier in range(5):
+            self.cache.ack(identifier, "localhost", 1000)
+            self.assertLessEqual(len(self.cache.acks), 2)
+
+    def test_least_recently_used_entries_are_dropped(self):
+        first = self.cache.status_request(1, 7)
+        self.cache.status_request(2, 7)
+        self.assertIs(self.cache.status_request(1, 7), first)
+        self.cache.status_request(3, 7)
+        # 2 was dropped for 3, 1 was used since
+        self.assertEqual(list(self.cache.status_requests), [1, 3])
+        self.assertIs(self.cache.status_request(1, 7), first)
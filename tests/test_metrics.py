@@ -0,0 +1,76 @@
+import asyncio
+from unittest import TestCase
+
+from metrics import MetricsRegistry, start_metrics_server
+
+TESTING_PORT = 8898
+
+
+class MetricsTestCase(TestCase):
+    def setUp(self) -> None:
+        self.metrics = MetricsRegistry()
+
+    def test_expose(self):
+        counter = self.metrics.counter("messages_total", "Messages")
+        items = []
+        self.metrics.gauge("items", "Items", lambda: len(items))
+        histogram = self.metrics.histogram("latency_seconds", "Latency", (0.1, 1.0))
+
+        counter.inc()
+        counter.inc(2)
+        items.extend([1, 2])
+        for value in (0.05, 0.1, 0.5, 3.0):
+            histogram.observe(value)
+
+        self.assertEqual(
+            self.metrics.expose(),
+            "# HELP messages_total Messages\n"
+            "# TYPE messages_total counter\n"
+            "messages_total 3\n"
+            "# HELP items Items\n"
+            "# TYPE items gauge\n"
+            "items 2\n"
+            "# HELP latency_seconds Latency\n"
+            "# TYPE latency_seconds histogram\n"
+            'latency_seconds_bucket{le="0.1"} 2\n'
+            'latency_seconds_bucket{le="1"} 3\n'
+            'latency_seconds_bucket{le="+Inf"} 4\n'
+            "latency_seconds_sum 3.65\n"
+            "latency_seconds_count 4\n",
+        )
+
+    def test_register_twice(self):
+        self.metrics.counter("messages_total", "Messages")
+        with self.assertRaises(ValueError):
+            self.metrics.gauge("messages_total", "Messages")
+
+    def test_timer(self):
+        histogram = self.metrics.histogram("latency_seconds", "Latency")
+        with histogram.time():
+            pass
+        self.assertEqual(sum(histogram.counts), 1)
+        self.assertLess(histogram.sum, 0.1)
+
+    def test_metrics_server(self):
+        self.metrics.counter("messages_total", "Messages").inc()
+
+        async def scrape():
+            server = await start_metrics_server(self.metrics, "127.0.0.1", TESTING_PORT)
+            reader, writer = await asyncio.open_connection("127.0.0.1", TESTING_PORT)
+            writer.write(b"GET /metrics HTTP/1.1\r\nHost: localhost\r\n\r\n")
+            response = await reader.read()
+            writer.close()
+            server.close()
+            await server.wait_closed()
+            return response
+
+        loop = asyncio.new_event_loop()
+        try:
+            response = loop.run_until_complete(scrape())
+        finally:
+            loop.close()
+
+        headers, body = response.split(b"\r\n\r\n", 1)
+        self.assertTrue(headers.startswith(b"HTTP/1.1 200 OK"))
+        self.assertIn(b"Content-Type: text/plain; version=0.0.4", headers)
+        self.assertIn(b"messages_total 1\n", body)
@@ -0,0 +1,69 @@
+import asyncio
+from unittest import TestCase
+
+import migrations
+
+
+class Transaction:
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *exc_info):
+        return False
+
+
+class MigrationConnection:
+    """
+    The statements run by migrations.migrate() on an asyncpg connection, with the applied versions in a set.
+    """
+
+    def __init__(self, applied=()):
+        self.applied = set(applied)
+        self.statements = []
+
+    def transaction(self):
+        return Transaction()
+
+    async def execute(self, statement, *args):
+        if statement.startswith("INSERT INTO schema_migrations"):
+            self.applied.add(args[0])
+        else:
+            self.statements.append(statement)
+
+    async def fetch(self, statement, *args):
+        return [{"version": version} for version in self.applied]
+
+
+class MigrateTestCase(TestCase):
+    def setUp(self) -> None:
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self) -> None:
+        self.loop.close()
+
+    def test_versions_are_ordered(self):
+        versions = [version for version, _, _ in migrations.MIGRATIONS]
+        self.assertEqual(versions, list(range(1, len(versions) + 1)))
+
+    def test_all_migrations_are_applied_in_order(self):
+        conn = MigrationConnection()
+        version = self.loop.run_until_complete(migrations.migrate(conn, "SETUP"))
+
+        self.assertEqual(version, migrations.MIGRATIONS[-1][0])
+        self.assertEqual(conn.applied, set(range(1, version + 1)))
+        self.assertEqual(
+            conn.statements[2:],
+            [statements for _, _, statements in migrations.MIGRATIONS] + ["SETUP"],
+        )
+
+    def test_only_missing_migrations_are_applied(self):
+        conn = MigrationConnection(applied={1})
+        self.loop.run_until_complete(migrations.migrate(conn))
+
+        self.assertNotIn(migrations.MIGRATIONS[0][2], conn.statements)
+        self.assertIn(migrations.MIGRATIONS[1][2], conn.statements)
+
+        conn = MigrationConnection(applied=conn.applied)
+        self.loop.run_until_complete(migrations.migrate(conn))
+        # the lock and the schema_migrations table only
+        self.assertEqual(len(conn.statements), 2)
@@ -0,0 +1,143 @@
+from unittest import TestCase
+
+from encode_decode_executor import EncodeDecodeExecutor
+from protobuf_encode_decoder import ProtobufEncoderDecoder
+import messages_pb2 as messages
+from records import HeartbeatRecord, StatusRecord
+
+
+class ProtobufEncodeDecodeTestCase(TestCase):
+    def setUp(self) -> None:
+        self.encoder_decoder = EncodeDecodeExecutor(ProtobufEncoderDecoder())
+
+    def test_heartbeat_batch(self):
+        heartbeats = [
+            {
+                "type": messages.MessageType.MESSAGE_TYPE_HEARTBEAT,
+                "msg": "Heartbeat",
+                "client_host": "localhost",
+                "client_port": 1000 + identifier,
+                "identifier": identifier,
+                "request_id": 0,
+            }
+            for identifier in range(3)
+        ]
+
+        data = self.encoder_decoder.encode_heartbeat_batch(heartbeats)
+
+        self.assertEqual(
+            self.encoder_decoder.decode_message_type(data),
+            messages.MessageType.MESSAGE_TYPE_BATCH_HEARTBEAT,
+        )
+        self.assertEqual(self.encoder_decoder.decode_heartbeat_batch(data), heartbeats)
+        # not a BatchStatus
+        self.assertEqual(self.encoder_decoder.decode_status_batch(data), [])
+
+    def test_status_batch(self):
+        statuses = [
+            {
+                "type": messages.MessageType.MESSAGE_TYPE_STATUS,
+                "message_count": 7,
+                "identifier": identifier,
+                "request_id": identifier + 1,
+            }
+            for identifier in range(3)
+        ]
+
+        data = self.encoder_decoder.encode_status_batch(statuses)
+
+        self.assertEqual(
+            self.encoder_decoder.decode_message_type(data),
+            messages.MessageType.MESSAGE_TYPE_BATCH_STATUS,
+        )
+        self.assertEqual(self.encoder_decoder.decode_status_batch(data), statuses)
+
+    def test_decode_message_type(self):
+        heartbeat = self.encoder_decoder.encode_heartbeat(
+            {
+                "type": messages.MessageType.MESSAGE_TYPE_HEARTBEAT,
+                "msg": "Heartbeat",
+                "client_host": "localhost",
+                "client_port": 1000,
+                "identifier": 1,
+            }
+        )
+        status = self.encoder_decoder.encode_status(
+            {
+                "type": messages.MessageType.MESSAGE_TYPE_STATUS,
+                "message_count": 0,
+                "identifier": 1,
+            }
+        )
+
+        self.assertEqual(
+            self.encoder_decoder.decode_message_type(heartbeat),
+            messages.MessageType.MESSAGE_TYPE_HEARTBEAT,
+        )
+        self.assertEqual(
+            self.encoder_decoder.decode_message_type(status),
+            messages.MessageType.MESSAGE_TYPE_STATUS,
+        )
+        self.assertEqual(
+            self.encoder_decoder.decode_message_type(b""),
+            messages.MessageType.MESSAGE_TYPE_HEARTBEAT,
+        )
+
+    def test_peek_heartbeat_identifier(self):
+        msg = {
+            "type": messages.MessageType.MESSAGE_TYPE_HEARTBEAT,
+            "msg": "Heartbeat",
+            "client_host": "localhost",
+            "client_port": 1000,
+            "identifier": 2**32 - 1,
+            "request_id": 300,
+        }
+        heartbeat = self.encoder_decoder.encode_heartbeat(msg)
+        self.assertEqual(
+            self.encoder_decoder.peek_heartbeat_identifier(memoryview(heartbeat)),
+            (2**32 - 1, 300),
+        )
+        # the fields left to their default are not written
+        self.assertEqual(
+            self.encoder_decoder.peek_heartbeat_identifier(
+                self.encoder_decoder.encode_heartbeat({**msg, "request_id": 0})
+            ),
+            (2**32 - 1, 0),
+        )
+        self.assertEqual(self.encoder_decoder.peek_heartbeat_identifier(b""), (0, 0))
+        # a truncated message, or a long host, is left to the decoder
+        self.assertIsNone(
+            self.encoder_decoder.peek_heartbeat_identifier(heartbeat[:-1])
+        )
+        self.assertIsNone(
+            self.encoder_decoder.peek_heartbeat_identifier(
+                self.encoder_decoder.encode_heartbeat({**msg, "client_host": "h" * 200})
+            )
+        )
+
+    def test_records(self):
+        heartbeat = HeartbeatRecord(
+            messages.MessageType.MESSAGE_TYPE_HEARTBEAT,
+            "Heartbeat",
+            "localhost",
+            1000,
+            1,
+            2,
+        )
+        status = StatusRecord(messages.MessageType.MESSAGE_TYPE_STATUS, 7, 1, 2)
+
+        heartbeat_data = self.encoder_decoder.encode_heartbeat_record(heartbeat)
+        status_data = self.encoder_decoder.encode_status_record(status)
+
+        self.assertEqual(
+            self.encoder_decoder.decode_heartbeat_record(heartbeat_data), heartbeat
+        )
+        self.assertEqual(
+            self.encoder_decoder.decode_heartbeat(heartbeat_data), heartbeat._asdict()
+        )
+        self.assertEqual(
+            self.encoder_decoder.decode_status_record(memoryview(status_data)), status
+        )
+        # not the expected type
+        self.assertIsNone(self.encoder_decoder.decode_heartbeat_record(status_data))
+        self.assertIsNone(self.encoder_decoder.decode_status_record(heartbeat_data))
@@ -0,0 +1,92 @@
+import os
+import tempfile
+from unittest import TestCase
+
+from client_registry import ClientRegistry
+import registry_snapshot
+
+
+class RegistrySnapshotTestCase(TestCase):
+    def setUp(self) -> None:
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, "snapshot", "registry.bin")
+
+    def tearDown(self) -> None:
+        self.directory.cleanup()
+
+    def registry(self) -> ClientRegistry:
+        registry = ClientRegistry(min_poll_interval=10, max_poll_interval=300)
+        for identifier in range(100):
+            registry.heartbeat(identifier, f"10.0.0.{identifier % 7}", 9000, 1.5)
+        registry.merge_saved_clients(
+            [
+                {
+                    "client_identifier": 1000,
+                    "client_host": "hôte.example",
+                    "client_port": 9001,
+                    "status_count": 4,
+                }
+            ]
+        )
+        registry.record_status(3, True, 0, 2.0)
+        registry.record_status(3, True, 0, 3.0)
+        registry.record_status(4, False, 0, 3.0)
+        registry.changes()
+        registry.record_status(5, True, 8, 4.0)
+        return registry
+
+    def test_round_trip(self):
+        registry = self.registry()
+        registry_snapshot.write(self.path, registry_snapshot.dump(registry))
+
+        loaded = ClientRegistry(min_poll_interval=10, max_poll_interval=300)
+        self.assertEqual(registry_snapshot.load(self.path, loaded), 101)
+        for identifier in [*range(100), 1000]:
+            self.assertEqual(loaded.get(identifier), registry.get(identifier))
+            self.assertEqual(
+                loaded.poll_interval(identifier), registry.poll_interval(identifier)
+            )
+        self.assertEqual(loaded.get(1000)["client_host"], "hôte.example")
+        # the unsaved change is still written with the next flush
+        self.assertEqual(loaded.changes(), registry.changes())
+
+    def test_loaded_clients_are_polled_like_new_ones(self):
+        registry_snapshot.write(self.path, registry_snapshot.dump(self.registry()))
+
+        loaded = ClientRegistry()
+        registry_snapshot.load(self.path, loaded)
+        self.assertEqual(sorted(loaded.take_unscheduled()), [*range(100), 1000])
+        self.assertEqual(len(loaded.due_poll_targets([1, 1000], 0.0)), 2)
+
+        # the registry works as usual
+        loaded.heartbeat(2000, "10.0.0.1", 9000, 5.0)
+        loaded.heartbeat(1, "10.0.0.99", 9000, 5.0)
+        self.assertEqual(len(loaded), 102)
+        self.assertEqual(loaded.get(1)["client_host"], "10.0.0.99")
+
+    def test_empty_registry(self):
+        registry_snapshot.write(self.path, registry_snapshot.dump(ClientRegistry()))
+
+        loaded = ClientRegistry()
+        self.assertEqual(registry_snapshot.load(self.path, loaded), 0)
+        self.assertEqual(len(loaded), 0)
+
+    def test_missing_or_invalid_snapshot(self):
+        loaded = ClientRegistry()
+        self.assertEqual(registry_snapshot.load(self.path, loaded), 0)
+
+        os.makedirs(os.path.dirname(self.path))
+        chunks = registry_snapshot.dump(self.registry())
+        snapshot = b"".join(chunks)
+        for data in (b"", snapshot[:10], snapshot[:-1], b"XXXX" + snapshot[4:]):
+            with open(self.path, "wb") as snapshot_file:
+                snapshot_file.write(data)
+            self.assertEqual(registry_snapshot.load(self.path, loaded), 0)
+            self.assertEqual(len(loaded), 0)
+
+    def test_registry_must_be_empty(self):
+        registry = self.registry()
+        registry_snapshot.write(self.path, registry_snapshot.dump(registry))
+
+        with self.assertRaises(ValueError):
+            registry_snapshot.load(self.path, registry)
@@ -0,0 +1,42 @@
+from unittest import TestCase
+
+from scheduler import TimingWheel
+
+
+class TimingWheelTestCase(TestCase):
+    def setUp(self) -> None:
+        self.wheel = TimingWheel(tick_seconds=1.0, span_seconds=10.0, now=100.0)
+
+    def test_timers_expire_at_their_tick(self):
+        self.wheel.schedule(1, 102.5)
+        self.wheel.schedule(2, 101.0)
+        self.wheel.schedule(3, 105.0)
+
+        self.assertEqual(list(self.wheel.advance(101.5)), [2])
+        self.assertEqual(list(self.wheel.advance(102.0)), [1])
+        self.assertEqual(list(self.wheel.advance(104.9)), [])
+        self.assertEqual(len(self.wheel), 1)
+        self.assertEqual(list(self.wheel.advance(105.0)), [3])
+        self.assertEqual(len(self.wheel), 0)
+
+    def test_past_deadlines_expire_at_the_next_tick(self):
+        self.wheel.schedule(1, 50.0)
+        self.assertEqual(list(self.wheel.advance(100.5)), [])
+        self.assertEqual(list(self.wheel.advance(101.0)), [1])
+
+    def test_deadlines_beyond_the_span_wait_for_their_round(self):
+        self.wheel.schedule(1, 125.0)
+        self.wheel.schedule(2, 103.0)
+
+        expired = []
+        for second in range(101, 125):
+            expired.extend(self.wheel.advance(second))
+        self.assertEqual(expired, [2])
+        self.assertEqual(list(self.wheel.advance(125.0)), [1])
+
+    def test_long_stall_expires_everything_due(self):
+        for identifier in range(20):
+            self.wheel.schedule(identifier, 100.0 + identifier)
+
+        self.assertEqual(sorted(self.wheel.advance(150.0)), list(range(20)))
+        self.assertEqual(len(self.wheel), 0)
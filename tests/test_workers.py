@@ -0,0 +1,62 @@
+import asyncio
+import socket
+from unittest import TestCase
+
+from client_registry import ClientRegistry
+from workers import HeartbeatRouter
+
+
+class HeartbeatRouterTestCase(TestCase):
+    def setUp(self) -> None:
+        self.inboxes = []
+        for _ in range(3):
+            receiving_socket, sending_socket = socket.socketpair(
+                socket.AF_UNIX, socket.SOCK_DGRAM
+            )
+            receiving_socket.setblocking(False)
+            sending_socket.setblocking(False)
+            self.inboxes.append((receiving_socket, sending_socket))
+
+    def tearDown(self) -> None:
+        for receiving_socket, sending_socket in self.inboxes:
+            receiving_socket.close()
+            sending_socket.close()
+
+    def test_every_client_has_one_owner(self):
+        routers = [HeartbeatRouter(index, self.inboxes) for index in range(3)]
+        for identifier in range(100):
+            owners = [
+                router.worker_index for router in routers if router.owns(identifier)
+            ]
+            self.assertEqual(owners, [identifier % 3])
+
+    def test_forwarded_heartbeats_reach_the_owner(self):
+        sender = HeartbeatRouter(0, self.inboxes)
+        owner = HeartbeatRouter(1, self.inboxes)
+        registry = ClientRegistry()
+
+        async def forward():
+            owner.start(registry)
+            sender.forward(4, "10.0.0.4", 2004, 5.0)
+            sender.forward(7, "host-7", 2007, 6.0)
+            await asyncio.sleep(0.05)
+
+        loop = asyncio.new_event_loop()
+        try:
+            loop.run_until_complete(forward())
+        finally:
+            loop.close()
+
+        self.assertEqual(len(registry), 2)
+        self.assertEqual(registry.get(4)["client_host"], "10.0.0.4")
+        self.assertEqual(registry.get(7)["client_port"], 2007)
+        self.assertEqual(registry.get(7)["last_seen"], 6.0)
+
+    def test_full_inbox_drops_heartbeats(self):
+        sender = HeartbeatRouter(0, self.inboxes)
+        # nobody reads the inbox of worker 1
+        for _ in range(100000):
+            sender.forward(1, "localhost", 2001, 5.0)
+            if sender.dropped:
+                break
+        self.assertEqual(sender.dropped, 1)
@@ -0,0 +1,180 @@
+import asyncio
+from unittest import TestCase
+
+from client_registry import ClientRegistry
+from write_behind import HeartbeatWriteBehind
+
+
+class HeartbeatStore:
+    """
+    The heartbeat operations of AsyncPgPostgresManager on a dictionary.
+    """
+
+    def __init__(self):
+        self.heartbeats = {}
+        self.writes = []
+        self.failing = False
+
+    async def save_heartbeats(self, heartbeats):
+        await asyncio.sleep(0)
+        if self.failing:
+            return False
+        self.writes.append(len(heartbeats))
+        self.heartbeats.update(heartbeats)
+        return True
+
+
+class HeartbeatWriteBehindTestCase(TestCase):
+    def setUp(self) -> None:
+        self.store = HeartbeatStore()
+        self.loop = asyncio.new_event_loop()
+
+    def tearDown(self) -> None:
+        self.loop.close()
+
+    def test_heartbeats_are_coalesced_per_client(self):
+        writer = HeartbeatWriteBehind(self.store, batch_size=10)
+        for now in range(5):
+            writer.add(1, "127.0.0.1", 9000 + now, now)
+        writer.add(2, "127.0.0.1", 9100, 4)
+
+        self.assertEqual(len(writer), 2)
+        self.assertTrue(self.loop.run_until_complete(writer.flush()))
+        self.assertEqual(
+            self.store.heartbeats,
+            {1: ("127.0.0.1", 9004, 4), 2: ("127.0.0.1", 9100, 4)},
+        )
+        self.assertEqual(len(writer), 0)
+
+    def test_flush_writes_batches(self):
+        writer = HeartbeatWriteBehind(self.store, batch_size=4)
+        for identifier in range(10):
+            writer.add(identifier, "127.0.0.1", 9000, 1)
+
+        self.loop.run_until_complete(writer.flush())
+        self.assertEqual(self.store.writes, [4, 4, 2])
+        self.assertEqual(writer.flushed, 10)
+
+    def test_saved_clients_are_marked_in_the_registry(self):
+        registry = ClientRegistry()
+        registry.heartbeat(1, "127.0.0.1", 9000, 1)
+        writer = HeartbeatWriteBehind(self.store)
+        writer.registry = registry
+        writer.add(1, "127.0.0.1", 9000, 1)
+
+        self.store.failing = True
+        self.loop.run_until_complete(writer.flush())
+        self.assertFalse(registry.get(1)["is_connected"])
+
+        self.store.failing = False
+        self.loop.run_until_complete(writer.flush())
+        # saved as connected, a failed status request deletes it
+        self.assertTrue(registry.get(1)["is_connected"])
+        registry.record_status(1, False, 0, 2)
+        self.assertEqual(registry.changes(), ({}, [1]))
+
+    def test_flush_when_batch_is_full(self):
+        writer = HeartbeatWriteBehind(
+            self.store, batch_size=3, flush_interval_seconds=60
+        )
+
+        async def run():
+            writer.start()
+            for identifier in range(3):
+                writer.add(identifier, "127.0.0.1", 9000, 1)
+            for _ in range(10):
+                await asyncio.sleep(0)
+            await writer.close()
+
+        self.loop.run_until_complete(run())
+        self.assertEqual(self.store.writes, [3])
+
+    def test_flush_after_interval(self):
+        writer = HeartbeatWriteBehind(
+            self.store, batch_size=100, flush_interval_seconds=0.01
+        )
+
+        async def run():
+            writer.start()
+            writer.add(1, "127.0.0.1", 9000, 1)
+            await asyncio.sleep(0.1)
+            saved = dict(self.store.heartbeats)
+            await writer.close()
+            return saved
+
+        self.assertEqual(
+            self.loop.run_until_complete(run()), {1: ("127.0.0.1", 9000, 1)}
+        )
+
+    def test_failed_write_is_retried_and_newer_heartbeats_win(self):
+        writer = HeartbeatWriteBehind(self.store, batch_size=10)
+        writer.add(1, "127.0.0.1", 9000, 1)
+        writer.add(2, "127.0.0.1", 9001, 1)
+        self.store.failing = True
+
+        async def fail():
+            flush = asyncio.ensure_future(writer.flush())
+            await asyncio.sleep(0)
+            # received while the write is running
+            writer.add(2, "127.0.0.2", 9002, 2)
+            return await flush
+
+        self.assertFalse(self.loop.run_until_complete(fail()))
+        self.assertEqual(
+            writer.pending,
+            {1: ("127.0.0.1", 9000, 1), 2: ("127.0.0.2", 9002, 2)},
+        )
+
+        self.store.failing = False
+        self.assertTrue(self.loop.run_until_complete(writer.flush()))
+        self.assertEqual(self.store.heartbeats[2], ("127.0.0.2", 9002, 2))
+
+    def test_pending_clients_are_bounded(self):
+        writer = HeartbeatWriteBehind(self.store, batch_size=2, max_pending=3)
+        for identifier in range(3):
+            self.assertTrue(writer.add(identifier, "127.0.0.1", 9000, 1))
+
+        self.assertTrue(writer.full)
+        # a pending client is still updated
+        self.assertTrue(writer.add(0, "127.0.0.1", 9001, 2))
+        self.assertFalse(writer.add(3, "127.0.0.1", 9000, 2))
+        self.assertEqual(writer.dropped, 1)
+        self.assertEqual(len(writer), 3)
+
+    def test_wait_for_room(self):
+        writer = HeartbeatWriteBehind(
+            self.store, batch_size=2, flush_interval_seconds=60, max_pending=2
+        )
+
+        async def run():
+            writer.start()
+            writer.add(1, "127.0.0.1", 9000, 1)
+            writer.add(2, "127.0.0.1", 9000, 1)
+            self.assertTrue(writer.full)
+            room = await asyncio.wait_for(writer.wait_for_room(), 1)
+            await writer.close()
+            return room
+
+        self.assertTrue(self.loop.run_until_complete(run()))
+        self.assertEqual(self.store.writes, [2])
+
+    def test_wait_for_room_gives_up_after_interval(self):
+        writer = HeartbeatWriteBehind(
+            self.store, batch_size=1, flush_interval_seconds=0.01, max_pending=1
+        )
+        writer.add(1, "127.0.0.1", 9000, 1)
+
+        self.assertFalse(self.loop.run_until_complete(writer.wait_for_room()))
+
+    def test_close_flushes_pending_heartbeats(self):
+        writer = HeartbeatWriteBehind(
+            self.store, batch_size=100, flush_interval_seconds=60
+        )
+
+        async def run():
+            writer.start()
+            writer.add(1, "127.0.0.1", 9000, 1)
+            return await writer.close()
+
+        self.assertTrue(self.loop.run_until_complete(run()))
+        self.assertEqual(self.store.heartbeats, {1: ("127.0.0.1", 9000, 1)})
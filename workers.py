@@ -0,0 +1,165 @@
+import asyncio
+import logging
+import multiprocessing
+import multiprocessing.connection
+import signal
+import socket
+import struct
+import time
+
+log = logging.getLogger("__main__." + __name__)
+
+# identifier, port, time of the heartbeat, followed by the host
+FORWARDED_HEARTBEAT = struct.Struct("!IId")
+
+
+class HeartbeatRouter:
+    """
+    This class splits the clients between the worker processes: a worker owns the clients with
+    identifier % worker_count == worker_index, only keeps those in its registry and only sends status
+    requests to those, so every client is swept by exactly one worker.
+
+    Heartbeats are accepted by whichever worker the kernel gave the connection to. A heartbeat of a client
+    owned by another worker is forwarded to the owner as one datagram on the owner's inbox, a unix socket
+    pair created by the Supervisor before forking. When an inbox is full the heartbeat is dropped, the
+    client sends another one soon.
+    """
+
+    def __init__(self, worker_index: int, inboxes: list):
+        self.worker_index = worker_index
+        self.worker_count = len(inboxes)
+        self.inboxes = inboxes  # worker index -> (receiving socket, sending socket)
+        self.dropped = 0
+
+    @property
+    def shard_count(self) -> int:
+        # every worker is one shard of the identifiers
+        return self.worker_count
+
+    def owned_shards(self) -> frozenset:
+        return frozenset((self.worker_index,))
+
+    def owns(self, identifier: int) -> bool:
+        """
+        :param identifier: client identifier.
+        :return: True if this worker owns the client.
+        """
+        return identifier % self.worker_count == self.worker_index
+
+    def forward(self, identifier: int, host: str, port: int, now: float) -> None:
+        """
+        This method sends a heartbeat to the worker owning the client.
+
+        :param identifier: client identifier.
+        :param host: client's host address.
+        :param port: client's port number
+        :param now: time of the heartbeat.
+        """
+        owner = identifier % self.worker_count
+        _, sending_socket = self.inboxes[owner]
+        try:
+            sending_socket.send(
+                FORWARDED_HEARTBEAT.pack(identifier, port, now) + host.encode("utf-8")
+            )
+        except (BlockingIOError, InterruptedError):
+            self.dropped += 1
+            log.warning("Inbox of worker %d is full, heartbeat dropped", owner)
+
+    def start(self, registry, heartbeat_writer=None) -> None:
+        """
+        This method registers the heartbeats forwarded by the other workers in the registry, and queues them
+        in the worker's write behind, from the running event loop.
+
+        :param registry: the worker's ClientRegistry.
+        :param heartbeat_writer: the worker's HeartbeatWriteBehind, None if heartbeats are not written behind.
+        """
+        receiving_socket, _ = self.inboxes[self.worker_index]
+
+        def receive():
+            while True:
+                try:
+                    datagram = receiving_socket.recv(FORWARDED_HEARTBEAT.size + 1024)
+                except (BlockingIOError, InterruptedError):
+                    return
+                identifier, port, now = FORWARDED_HEARTBEAT.unpack_from(datagram)
+                host = datagram[FORWARDED_HEARTBEAT.size :].decode("utf-8")
+                registry.heartbeat(identifier, host, port, now)
+                if heartbeat_writer is not None:
+                    heartbeat_writer.add(identifier, host, port, now)
+
+        asyncio.get_event_loop().add_reader(receiving_socket, receive)
+
+
+class Supervisor:
+    """
+    This class forks worker_count worker processes and restarts the ones which exit until it is asked to
+    stop with SIGTERM or SIGINT. Every worker runs target(router) with its own HeartbeatRouter, binds the
+    server port with SO_REUSEPORT and so gets its share of the client connections from the kernel.
+    """
+
+    def __init__(self, worker_count: int, target, restart_delay_seconds: float = 1.0):
+        self.worker_count = worker_count
+        self.target = target
+        self.restart_delay_seconds = restart_delay_seconds
+        self.context = multiprocessing.get_context("fork")
+        self.inboxes = []
+        self.workers = {}  # worker index -> Process
+        self.stopping = False
+
+    def run(self) -> None:
+        """
+        This method starts the workers and supervises them until they are all stopped.
+        """
+        for _ in range(self.worker_count):
+            receiving_socket, sending_socket = socket.socketpair(
+                socket.AF_UNIX, socket.SOCK_DGRAM
+            )
+            receiving_socket.setblocking(False)
+            sending_socket.setblocking(False)
+            self.inboxes.append((receiving_socket, sending_socket))
+        signal.signal(signal.SIGTERM, self.stop)
+        signal.signal(signal.SIGINT, self.stop)
+
+        for worker_index in range(self.worker_count):
+            self.start_worker(worker_index)
+        while self.workers:
+            sentinels = {
+                worker.sentinel: worker_index
+                for worker_index, worker in self.workers.items()
+            }
+            for sentinel in multiprocessing.connection.wait(list(sentinels)):
+                worker_index = sentinels[sentinel]
+                worker = self.workers.pop(worker_index)
+                worker.join()
+                if self.stopping:
+                    continue
+                log.error(
+                    "Worker %d exited with code %s, restarting it",
+                    worker_index,
+                    worker.exitcode,
+                )
+                time.sleep(self.restart_delay_seconds)
+                if not self.stopping:
+                    self.start_worker(worker_index)
+
+    def start_worker(self, worker_index: int) -> None:
+        worker = self.context.Process(
+            target=self.run_worker,
+            args=(HeartbeatRouter(worker_index, self.inboxes),),
+            name=f"worker-{worker_index}",
+        )
+        worker.start()
+        self.workers[worker_index] = worker
+        log.info("Started worker %d pid %d", worker_index, worker.pid)
+
+    def run_worker(self, router: HeartbeatRouter) -> None:
+        # the supervisor's signal handlers are inherited by the fork, a worker stops like on Ctrl-C instead
+        signal.signal(signal.SIGTERM, signal.default_int_handler)
+        signal.signal(signal.SIGINT, signal.default_int_handler)
+        self.target(router)
+
+    def stop(self, signum, frame) -> None:
+        log.info("Stopping %d workers", len(self.workers))
+        self.stopping = True
+        for worker in self.workers.values():
+            worker.terminate()
@@ -0,0 +1,175 @@
+import asyncio
+import logging
+import time
+
+from db_operations import AsyncPgPostgresManager
+
+log = logging.getLogger("__main__." + __name__)
+
+
+class HeartbeatWriteBehind:
+    """
+    This class saves the heartbeats of the clients owned by this server in the database soon after they are
+    received, so a crash only loses the last flush_interval_seconds of them instead of everything since the
+    last sweep, without a database write per heartbeat.
+
+    Heartbeats are coalesced per identifier: only the latest address and time of a client are pending, so
+    the cost of a flush depends on the number of clients heard from since the last one, not on the
+    heartbeat rate. A background task writes the pending heartbeats with save_heartbeats() once batch_size
+    clients are pending or every flush_interval_seconds, and close() writes the rest on shutdown. When a
+    write fails the heartbeats are pending again, newer ones win.
+
+    At most max_pending clients are pending. While full is True the server stops reading heartbeats until a
+    flush made room or flush_interval_seconds passed, see wait_for_room(); a heartbeat of a new client which
+    still arrives then is not queued (dropped counts them), the client stays in the registry and is saved by
+    the next Server.flush_clients().
+    """
+
+    def __init__(
+        self,
+        db_op_manager: AsyncPgPostgresManager,
+        batch_size: int = 1000,
+        flush_interval_seconds: float = 1.0,
+        max_pending: int = 100000,
+    ):
+        self.db_op_manager = db_op_manager
+        self.batch_size = batch_size
+        self.flush_interval_seconds = flush_interval_seconds
+        self.max_pending = max(max_pending, batch_size)
+        self.pending = {}  # client_id -> (host, port, time of the heartbeat)
+        self.dropped = 0
+        self.flushed = 0
+        # created on first use, inside the event loop
+        self.batch_ready = None  # set when batch_size clients are pending
+        self.room = None  # set when there is room for more clients
+        self.task = None
+        self.flushing = None  # the flush started by run()
+        self.registry = None  # the server's ClientRegistry, see start()
+
+    def __len__(self):
+        return len(self.pending)
+
+    @property
+    def full(self) -> bool:
+        return len(self.pending) >= self.max_pending
+
+    def events(self) -> tuple:
+        # the events belong to the running event loop
+        if self.batch_ready is None:
+            self.batch_ready = asyncio.Event()
+            self.room = asyncio.Event()
+            self.room.set()
+        return self.batch_ready, self.room
+
+    def add(self, identifier: int, host: str, port: int, now: float) -> bool:
+        """
+        This method queues the heartbeat of a client, it replaces the pending heartbeat of the same client.
+
+        :param identifier: client identifier.
+        :param host: client's host address.
+        :param port: client's port number
+        :param now: time of the heartbeat, time.time().
+        :return: False if the heartbeat is dropped because too many clients are pending.
+        """
+        pending = self.pending
+        if identifier not in pending and len(pending) >= self.max_pending:
+            self.dropped += 1
+            return False
+        pending[identifier] = (host, port, now)
+        if len(pending) >= self.batch_size and self.batch_ready is not None:
+            self.batch_ready.set()
+            if len(pending) >= self.max_pending:
+                self.room.clear()
+        return True
+
+    async def wait_for_room(self) -> bool:
+        """
+        This method returns once fewer than max_pending clients are pending, or after flush_interval_seconds
+        so heartbeats are not held up for long when the database is down.
+
+        :return: True if there is room.
+        """
+        _, room = self.events()
+        if not self.full:
+            return True
+        room.clear()
+        try:
+            await asyncio.wait_for(room.wait(), self.flush_interval_seconds)
+        except asyncio.TimeoutError:
+            pass
+        return not self.full
+
+    def start(self, registry=None) -> None:
+        """
+        This method starts flushing the pending heartbeats in the background, from the running event loop.
+
+        :param registry: the server's ClientRegistry, the saved clients are marked as saved and connected in
+        it like in the database, see ClientRegistry.mark_saved().
+        """
+        self.registry = registry
+        self.task = asyncio.ensure_future(self.run())
+
+    async def run(self) -> None:
+        batch_ready, _ = self.events()
+        if len(self.pending) >= self.batch_size:
+            batch_ready.set()
+        while True:
+            try:
+                await asyncio.wait_for(batch_ready.wait(), self.flush_interval_seconds)
+            except asyncio.TimeoutError:
+                pass
+            # a flush is not interrupted by close(), which waits for it instead
+            self.flushing = asyncio.ensure_future(self.flush())
+            if not await asyncio.shield(self.flushing):
+                # retry later instead of at every heartbeat while the database is down
+                await asyncio.sleep(self.flush_interval_seconds)
+
+    async def flush(self) -> bool:
+        """
+        This method writes the pending heartbeats to the database, batch_size clients per write.
+
+        :return: True if every pending heartbeat is saved.
+        """
+        batch_ready, room = self.events()
+        batch_ready.clear()
+        pending, self.pending = list(self.pending.items()), {}
+        room.set()
+        start = time.perf_counter()
+        for offset in range(0, len(pending), self.batch_size):
+            batch = dict(pending[offset : offset + self.batch_size])
+            if not await self.db_op_manager.save_heartbeats(batch):
+                log.error("Saving %d heartbeats failed", len(pending) - offset)
+                # the heartbeats of this and the later batches are pending again, newer heartbeats win
+                unsaved = dict(pending[offset:])
+                unsaved.update(self.pending)
+                self.pending = unsaved
+                if self.full:
+                    room.clear()
+                return False
+            self.flushed += len(batch)
+            if self.registry is not None:
+                self.registry.mark_saved(batch)
+        if pending:
+            log.debug(
+                "Saved %d heartbeats in %.3f s",
+                len(pending),
+                time.perf_counter() - start,
+            )
+        return True
+
+    async def close(self) -> bool:
+        """
+        This method stops the background task and writes the pending heartbeats.
+
+        :return: True if every pending heartbeat is saved.
+        """
+        if self.task is not None:
+            self.task.cancel()
+            try:
+                await self.task
+            except asyncio.CancelledError:
+                pass
+            self.task = None
+        if self.flushing is not None and not self.flushing.done():
+            await self.flushing
+        return await self.flush()